@@ -0,0 +1,56 @@
+"""
+benchmarks.__main__
+~~~~~~~~~~~~~~~~~~~
+
+This module runs every benchmark and writes the results to a JSON
+file, so that runs on different versions can be compared.
+
+Usage:
+
+    $ python -m benchmarks [--output benchmarks.json] [--only call,parse]
+"""
+
+import sys
+import json
+import time
+import argparse
+import platform
+
+import ergal
+from ergal import utils
+
+from . import bench_call, bench_parse, bench_profile
+
+
+SUITES = {
+    'call': bench_call.bench,
+    'parse': bench_parse.bench,
+    'profile': bench_profile.bench}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the benchmarks.')
+    parser.add_argument('--output', default='benchmarks.json')
+    parser.add_argument('--only', default=','.join(SUITES))
+    args = parser.parse_args(argv)
+
+    results = {
+        'version': ergal.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'json_backend': utils._json.__name__,
+        'timestamp': int(time.time()),
+        'results': {}}
+
+    for name in args.only.split(','):
+        print(f"Running {name} benchmarks...", file=sys.stderr)
+        results['results'][name] = SUITES[name]()
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print(f"Results written to {args.output}.", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+benchmarks.bench_call
+~~~~~~~~~~~~~~~~~~~~~
+
+This module benchmarks `Profile.call` against the local stand-in
+server, measuring throughput and latency percentiles at varying
+concurrency.
+
+Usage:
+
+    $ python -m benchmarks.bench_call
+"""
+
+import os
+import json
+import time
+import asyncio
+import tempfile
+
+from ergal import Profile
+
+from .server import Server
+
+
+def percentile(values, p):
+    """ Get the `p`th percentile of a sorted list of values. """
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+async def run(profile, concurrency, calls):
+    """ Make `calls` calls with at most `concurrency` in flight.
+
+    Returns the total duration and the sorted call latencies.
+    """
+    latencies = []
+    queue = iter(range(calls))
+
+    async def worker():
+        for i in queue:
+            start = time.perf_counter()
+            await profile.call('Items', params={'i': i})
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    return time.perf_counter() - start, sorted(latencies)
+
+
+async def measure(latency, items, levels, calls):
+    results = {}
+    async with Server(latency=latency, items=items) as server:
+        with tempfile.TemporaryDirectory() as tmp:
+            async with Profile(
+                    'bench', base=server.base,
+                    database=os.path.join(tmp, 'bench.db')) as profile:
+                profile.add_endpoint(
+                    'Items', '/json', 'GET',
+                    parse=True, targets=['data'])
+
+                await run(profile, 1, 10)
+                for concurrency in levels:
+                    duration, latencies = await run(
+                        profile, concurrency, calls)
+                    results[str(concurrency)] = {
+                        'calls': calls,
+                        'calls_per_second': round(calls / duration, 1),
+                        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+                        'p90_ms': round(percentile(latencies, 90) * 1000, 3),
+                        'p99_ms': round(percentile(latencies, 99) * 1000, 3)}
+
+    return results
+
+
+def bench(latency=0.005, items=100, levels=(1, 10, 50, 100), calls=500):
+    """ Measure call throughput and latency at each concurrency level.
+
+    :param latency: (optional) the server's response delay, in seconds
+    :param items: (optional) the number of items per response body
+    :param levels: (optional) the concurrency levels to measure
+    :param calls: (optional) the number of calls per level
+    """
+    return {
+        'latency_ms': latency * 1000, 'items': items,
+        'concurrency': asyncio.run(measure(latency, items, levels, calls))}
+
+
+if __name__ == '__main__':
+    print(json.dumps(bench(), indent=2))
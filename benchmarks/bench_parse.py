@@ -0,0 +1,129 @@
+"""
+benchmarks.bench_parse
+~~~~~~~~~~~~~~~~~~~~~~
+
+This module benchmarks response body decoding, comparing the
+content-type dispatched, bytes-native `utils.decode` with the
+previous str-based, exception-driven JSON/XML fallback, and measures
+the time and peak memory of `utils.parse` on large payloads.
+
+Usage:
+
+    $ python -m benchmarks.bench_parse
+"""
+
+import json
+import time
+import timeit
+import asyncio
+import tracemalloc
+
+from ergal import utils
+
+import xmltodict
+
+
+def build_json(items=5000):
+    return json.dumps({'data': [
+        {'id': i, 'name': f"item {i}", 'tags': ['a', 'b', 'c'],
+         'score': i * 0.5, 'active': i % 2 == 0}
+        for i in range(items)]}).encode()
+
+
+def build_xml(items=5000):
+    return (
+        '<data>' + ''.join(
+            f'<item id="{i}"><name>item {i}</name>'
+            f'<score>{i * 0.5}</score></item>'
+            for i in range(items)) + '</data>').encode()
+
+
+def legacy(body):
+    """ The previous decoding path: str decode, JSON, then XML. """
+    text = body.decode('utf-8')
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return xmltodict.parse(text)
+
+
+class Buffered:
+    """ A stand-in for a response whose body has been read. """
+    def __init__(self, body, content_type):
+        self.body = body
+        self.content_type = content_type
+        self.charset = None
+
+    async def read(self):
+        return self.body
+
+
+def bench_parse(sizes=(5000, 50000), number=5):
+    """ Time `utils.parse` and trace its peak memory use, parsing
+    whole documents and extracting a single target.
+
+    :param sizes: (optional) the payload sizes, in items
+    :param number: (optional) the number of runs per measurement
+    """
+    loop = asyncio.new_event_loop()
+    results = {}
+    try:
+        for kind, build, content_type in (
+                ('json', build_json, 'application/json'),
+                ('xml', build_xml, 'application/xml')):
+            for items in sizes:
+                response = Buffered(build(items), content_type)
+                result = results[f"{kind}_{items}"] = {
+                    'bytes': len(response.body)}
+
+                for mode, targets in (
+                        ('document', None), ('target', ['name'])):
+                    def parse():
+                        return loop.run_until_complete(
+                            utils.parse(response, targets=targets))
+
+                    start = time.perf_counter()
+                    for _ in range(number):
+                        parse()
+                    elapsed = (time.perf_counter() - start) / number
+
+                    tracemalloc.start()
+                    parse()
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+
+                    result[f"{mode}_ms"] = round(elapsed * 1000, 3)
+                    result[f"{mode}_peak_kb"] = round(peak / 1024, 1)
+    finally:
+        loop.close()
+
+    return results
+
+
+def bench(number=20):
+    """ Time both decoding paths on JSON and XML payloads.
+
+    :param number: (optional) the number of runs per measurement
+    """
+    results = {'backend': utils._json.__name__}
+    for kind, body, content_type in (
+            ('json', build_json(), 'application/json'),
+            ('xml', build_xml(), 'application/xml')):
+        before = min(timeit.repeat(
+            lambda: legacy(body), number=number, repeat=3)) / number
+        after = min(timeit.repeat(
+            lambda: utils.decode(body, content_type),
+            number=number, repeat=3)) / number
+
+        results[kind] = {
+            'bytes': len(body),
+            'legacy_ms': round(before * 1000, 3),
+            'decode_ms': round(after * 1000, 3),
+            'speedup': round(before / after, 2)}
+
+    results['parse'] = bench_parse()
+    return results
+
+
+if __name__ == '__main__':
+    print(json.dumps(bench(), indent=2))
@@ -0,0 +1,62 @@
+"""
+benchmarks.bench_profile
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+This module benchmarks the cost of profile storage: constructing a
+Profile and adding endpoints to it, as the number of stored
+endpoints grows.
+
+Usage:
+
+    $ python -m benchmarks.bench_profile
+"""
+
+import os
+import json
+import time
+import tempfile
+
+from ergal import utils
+from ergal import Profile
+
+
+def bench(counts=(10, 100, 1000)):
+    """ Time `add_endpoint` and `Profile` construction at each
+    endpoint count.
+
+    :param counts: (optional) the endpoint counts to measure
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in counts:
+            path = os.path.join(tmp, f"bench_{count}.db")
+            profile = Profile('bench', base='http://127.0.0.1', database=path)
+
+            start = time.perf_counter()
+            for i in range(count):
+                profile.add_endpoint(
+                    f"Endpoint {i}", f"/endpoint/{i}", 'GET',
+                    parse=True, targets=['data', 'meta.next'])
+            added = (time.perf_counter() - start) / count
+
+            start = time.perf_counter()
+            Profile('bench', database=path)
+            constructed = time.perf_counter() - start
+
+            start = time.perf_counter()
+            profile = Profile('bench', database=path)
+            profile.endpoints[f"Endpoint {count - 1}"]
+            loaded = time.perf_counter() - start
+
+            results[str(count)] = {
+                'add_endpoint_ms': round(added * 1000, 3),
+                'construct_ms': round(constructed * 1000, 3),
+                'construct_and_load_one_ms': round(loaded * 1000, 3)}
+
+            utils.get_db(path=path).close()
+
+    return results
+
+
+if __name__ == '__main__':
+    print(json.dumps(bench(), indent=2))
@@ -0,0 +1,141 @@
+"""
+benchmarks.server
+~~~~~~~~~~~~~~~~~
+
+This module implements a local asyncio HTTP/1.1 server used as a
+stand-in for remote APIs in the benchmarks, so that measurements
+do not depend on the network.
+
+Usage:
+
+    $ python -m benchmarks.server --port 8080
+"""
+
+import asyncio
+import argparse
+import urllib.parse
+
+from .bench_parse import build_json, build_xml
+
+
+class Server:
+    """ A local stand-in HTTP server with configurable latency and
+    payloads.
+
+    Every request is answered after `latency` seconds with a body of
+    `items` items. Routes:
+
+        /json               responds with a JSON document
+        /xml                responds with an XML document
+
+    Both routes accept `latency` and `items` query parameters, which
+    override the server's defaults for that request. Bodies are built
+    once per size and reused.
+
+    :param latency: (optional) the default response delay, in seconds
+    :param items: (optional) the default number of items per body
+    :param port: (optional) the port to listen on; a free port is
+                            picked by default
+    """
+    def __init__(self, latency=0.0, items=100, port=0):
+        self.latency = latency
+        self.items = items
+
+        self.host = '127.0.0.1'
+        self.port = port
+        self.requests = 0
+
+        self._bodies = {}
+        self._server = None
+
+    @property
+    def base(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def __aenter__(self):
+        self._server = await asyncio.start_server(
+            self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+        return self
+
+    async def __aexit__(self, *exc):
+        self._server.close()
+        await self._server.wait_closed()
+
+    def body(self, kind, items):
+        """ Get the cached body of a kind and size. """
+        if (kind, items) not in self._bodies:
+            build = build_xml if kind == 'xml' else build_json
+            self._bodies[(kind, items)] = build(items)
+
+        return self._bodies[(kind, items)]
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                _, target, _ = line.decode('latin-1').split(' ', 2)
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    k, v = line.decode('latin-1').split(':', 1)
+                    if k.strip().lower() == 'content-length':
+                        length = int(v)
+
+                if length:
+                    await reader.readexactly(length)
+
+                self.requests += 1
+                status, content_type, payload = await self.route(target)
+                writer.write((
+                    f"HTTP/1.1 {status}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    "\r\n").encode('latin-1') + payload)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, target):
+        """ Produce a (status, content type, body) triple for a
+        request target. """
+        url = urllib.parse.urlsplit(target)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        kind = url.path.strip('/')
+        if kind not in ('json', 'xml'):
+            return '404 Not Found', 'text/plain', b'Not Found'
+
+        latency = float(params.get('latency', self.latency))
+        if latency:
+            await asyncio.sleep(latency)
+
+        return (
+            '200 OK', f"application/{kind}",
+            self.body(kind, int(params.get('items', self.items))))
+
+
+async def serve(latency, items, port):
+    async with Server(latency=latency, items=items, port=port) as server:
+        print(f"Serving on {server.base}")
+        await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve benchmark payloads.')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--items', type=int, default=100)
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.latency, args.items, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -1,4 +1,5 @@
 __version__ = '1.1.2'
 
-from .profile import Profile
+from .profile import Profile, get_profile
 
+from .executor import Executor
@@ -0,0 +1,527 @@
+"""
+ergal.cache
+~~~~~~~~~~~
+
+This module implements the in-memory response cache used by
+the Profile interface, and the persistent store that backs it.
+
+:author: Elliott Maguire
+:copyright: (c) 2019 by Elliott Maguire
+"""
+
+import os
+import json
+import time
+import zlib
+import sqlite3
+import asyncio
+import hashlib
+import threading
+import collections
+import email.utils
+import concurrent.futures
+
+from . import utils
+
+import yarl
+import multidict
+
+
+class Entry:
+    """ A cached response.
+
+    :param response: a response object with its body read
+    :param ttl: the number of seconds the response stays fresh
+    :param key: (optional) the entry's cache key
+    """
+    __slots__ = ('response', 'data', 'expires', 'etag', 'modified', 'key')
+
+    def __init__(self, response, ttl, key=None):
+        self.response = response
+        self.key = key
+        self.data = None
+        self.etag = response.headers.get('ETag')
+        self.modified = response.headers.get('Last-Modified')
+        self.expires = time.monotonic() + ttl
+
+    @property
+    def fresh(self):
+        return time.monotonic() < self.expires
+
+    def conditions(self):
+        """ Get the headers used to revalidate the entry. """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.modified:
+            headers['If-Modified-Since'] = self.modified
+
+        return headers
+
+
+class Cache:
+    """ A bounded LRU cache of responses for a single endpoint.
+
+    Freshness is taken from the response's `Cache-Control` or
+    `Expires` headers, falling back to the configured `ttl`. Stale
+    entries are kept so they can be revalidated with `ETag` and
+    `Last-Modified` validators.
+
+    If a `store` is given, entries missing from memory can be looked
+    up in it with `restore`, and entries are written back to it with
+    `save`. `scope` namespaces the endpoint's entries in the store.
+
+    :param ttl: (optional) the default freshness lifetime, in seconds
+    :param size: (optional) the maximum number of entries
+    :param store: (optional) a persistent Store
+    :param scope: (optional) the endpoint's namespace in the store
+    """
+    def __init__(self, ttl=0, size=128, store=None, scope=''):
+        self.ttl = ttl
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.store = store
+        self.scope = scope
+
+    @staticmethod
+    def key(method, url, kwargs):
+        """ Build a cache key from the parts of a request.
+
+        Requests sent with different credentials get different keys.
+        The `Authorization` header is only kept as a digest.
+
+        :param method: the HTTP method
+        :param url: the formatted request URL
+        :param kwargs: the request's keyword arguments
+        """
+        params = kwargs.get('params') or {}
+
+        headers = []
+        for k, v in (kwargs.get('headers') or {}).items():
+            k, v = str(k).lower(), str(v)
+            if k == 'authorization':
+                v = hashlib.sha256(v.encode()).hexdigest()
+            headers.append((k, v))
+
+        return (
+            method, url,
+            tuple(sorted((str(k), str(v)) for k, v in params.items())),
+            tuple(sorted(headers)))
+
+    def get(self, key):
+        """ Get an entry, marking it as recently used.
+
+        :param key: a cache key
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+
+        return entry
+
+    async def restore(self, key):
+        """ Load an entry missing from memory from the store, off the
+        event loop. Returns None if the cache has no store or the
+        store has no usable entry.
+
+        :param key: a cache key
+        """
+        if self.store is None:
+            return None
+
+        entry = await asyncio.get_running_loop().run_in_executor(
+            None, self.store.get, self.scope, key)
+        if entry is not None:
+            self._add(key, entry)
+
+        return entry
+
+    def put(self, key, response):
+        """ Store a response, evicting the least recently used entry
+        if the cache is full. Returns the new entry, or None if the
+        response may not be stored.
+
+        :param key: a cache key
+        :param response: a response object with its body read
+        """
+        ttl = self.lifetime(response.headers)
+        if ttl is None:
+            self.entries.pop(key, None)
+            return None
+
+        entry = Entry(response, ttl, key)
+        self._add(key, entry)
+
+        return entry
+
+    def _add(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def save(self, entry, body):
+        """ Write an entry and its parse output back to the store, if
+        the cache has one.
+
+        :param entry: the entry, as returned by `put`
+        :param body: the response body, or None if it was not read
+                     whole (e.g. by a streaming parse)
+        """
+        if self.store is not None:
+            self.store.put(self.scope, entry, body)
+
+    def refresh(self, entry, response):
+        """ Renew an entry after a `304 Not Modified` response.
+
+        :param entry: the revalidated entry
+        :param response: the 304 response
+        """
+        ttl = self.lifetime(response.headers)
+        entry.expires = time.monotonic() + (ttl or 0)
+        entry.etag = response.headers.get('ETag', entry.etag)
+        entry.modified = response.headers.get(
+            'Last-Modified', entry.modified)
+        if self.store is not None:
+            self.store.refresh(self.scope, entry)
+
+    def clear(self):
+        """ Drop every entry. """
+        self.entries.clear()
+
+    def lifetime(self, headers):
+        """ Get a response's freshness lifetime in seconds.
+
+        Returns None if the response must not be stored at all.
+
+        :param headers: the response headers
+        """
+        directives = {}
+        for part in headers.get('Cache-Control', '').split(','):
+            k, _, v = part.strip().partition('=')
+            if k:
+                directives[k.lower()] = v.strip('"')
+
+        if 'no-store' in directives:
+            return None
+        if 'no-cache' in directives:
+            return 0
+        if 'max-age' in directives:
+            try:
+                return max(int(directives['max-age']), 0)
+            except ValueError:
+                return 0
+
+        if 'Expires' in headers:
+            try:
+                expires = email.utils.parsedate_to_datetime(
+                    headers['Expires'])
+                date = (
+                    email.utils.parsedate_to_datetime(headers['Date'])
+                    if 'Date' in headers else None)
+            except (TypeError, ValueError):
+                return 0
+
+            now = date.timestamp() if date else time.time()
+            return max(expires.timestamp() - now, 0)
+
+        return self.ttl
+
+
+STORE_SIZE = 64 << 20
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class Stored:
+    """ A response restored from a Store.
+
+    It stands in for an aiohttp.ClientResponse whose body has been
+    read, exposing the attributes and coroutines used on cached
+    responses, and unlike one it can be pickled.
+
+    :param method: the HTTP method
+    :param url: the response URL
+    :param status: the response status
+    :param headers: a list of (name, value) header pairs
+    :param body: the response body
+    """
+    def __init__(self, method, url, status, headers, body):
+        self.method = method
+        self.url = yarl.URL(url)
+        self.status = status
+        self.headers = multidict.CIMultiDictProxy(
+            multidict.CIMultiDict(headers))
+        self._body = body
+
+        mimetype, _, params = self.headers.get(
+            'Content-Type', 'application/octet-stream').partition(';')
+        self.content_type = mimetype.strip().lower()
+        self.charset = None
+        for param in params.split(';'):
+            k, _, v = param.strip().partition('=')
+            if k.lower() == 'charset':
+                self.charset = v.strip('"')
+
+    def __repr__(self):
+        return f"<Stored({self.url}) [{self.status}]>"
+
+    def __reduce__(self):
+        return Stored, (
+            self.method, str(self.url), self.status,
+            list(self.headers.items()), self._body)
+
+    async def read(self):
+        return self._body
+
+    async def text(self, encoding=None):
+        return self._body.decode(encoding or self.charset or 'utf-8')
+
+    async def json(self, loads=utils.loads, **kwargs):
+        return loads(self._body) if self._body else None
+
+    def release(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Store:
+    """ A persistent response cache in a SQLite database file.
+
+    Bodies are stored zlib-compressed alongside their parse output
+    and validators, under a digest of the endpoint's scope and the
+    request's cache key. Expiry times are wall-clock, so entries
+    stay fresh across restarts for the rest of their lifetime.
+
+    The file may be shared by any number of processes: it is opened
+    in WAL mode, and each write, along with the eviction of least
+    recently used entries beyond `size` bytes, is a single
+    transaction. Writes are made on a background thread.
+
+    :param path: the path of the database file
+    :param size: (optional) the maximum total size of the stored
+                            entries, in bytes
+    :param level: (optional) the zlib compression level of bodies
+    """
+    def __init__(self, path, size=STORE_SIZE, level=6):
+        self.path = path
+        self.size = size
+        self.level = level
+        self.ready = False
+
+        self.writer = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='ergal-store')
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.connections = []
+
+    def connect(self):
+        """ Get/create the current thread's connection. """
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            return db
+
+        db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA synchronous = NORMAL")
+
+        with self._lock:
+            if not self.ready:
+                with db:
+                    db.execute("""
+                        CREATE TABLE IF NOT EXISTS Response (
+                            key         TEXT    NOT NULL,
+                            method      TEXT    NOT NULL,
+                            url         TEXT    NOT NULL,
+                            status      INTEGER NOT NULL,
+                            headers     TEXT    NOT NULL,
+                            body        BLOB,
+                            data        TEXT,
+                            expires     REAL    NOT NULL,
+                            etag        TEXT,
+                            modified    TEXT,
+                            size        INTEGER NOT NULL,
+                            used        REAL    NOT NULL,
+
+                            PRIMARY KEY(key))""")
+                    db.execute("""
+                        CREATE INDEX IF NOT EXISTS ResponseUsed
+                        ON Response (used)""")
+                self.ready = True
+            self.connections.append(db)
+
+        self._local.db = db
+        return db
+
+    @staticmethod
+    def digest(scope, key):
+        """ Get the row key of a cache key within a scope. """
+        return hashlib.sha256(
+            json.dumps([scope, key]).encode()).hexdigest()
+
+    def get(self, scope, key):
+        """ Load an entry, or None if it is missing or stale without
+        validators to revalidate it with. The entry is marked as used
+        on the background thread.
+
+        This blocks on the database and decompresses the body, so it
+        should not be called on the event loop (see `Cache.restore`).
+
+        :param scope: the endpoint's namespace
+        :param key: a cache key
+        """
+        digest = self.digest(scope, key)
+        db = self.connect()
+        record = db.execute("""
+            SELECT      method, url, status, headers, body, data,
+                        expires, etag, modified
+            FROM        Response
+            WHERE       key = ?""", (digest,)).fetchone()
+        if record is None:
+            return None
+
+        method, url, status, headers, body, data, expires = record[:7]
+        etag, modified = record[7:]
+        now = time.time()
+        if expires <= now and not (etag or modified):
+            return None
+
+        self.writer.submit(self._use, digest, now)
+
+        response = Stored(
+            method, url, status, json.loads(headers),
+            zlib.decompress(body) if body is not None else b'')
+        entry = Entry(response, expires - now, key)
+        entry.etag, entry.modified = etag, modified
+        if data is not None:
+            entry.data = utils.loads(data)
+
+        return entry
+
+    def put(self, scope, entry, body):
+        """ Write an entry on the background thread. Returns a
+        concurrent.futures.Future resolved once it is committed.
+
+        :param scope: the endpoint's namespace
+        :param entry: the entry
+        :param body: the response body, or None if it was not read
+        """
+        response = entry.response
+        try:
+            data = json.dumps(entry.data) if entry.data is not None else None
+        except (TypeError, ValueError):
+            data = None
+        if body is None and data is None:
+            return None
+
+        record = (
+            self.digest(scope, entry.key),
+            getattr(response, 'method', 'GET'), str(response.url),
+            response.status, json.dumps([
+                (k, v) for k, v in response.headers.items()
+                if k.lower() not in ('content-encoding', 'content-length')]),
+            body, data, time.time() + (entry.expires - time.monotonic()),
+            entry.etag, entry.modified)
+
+        return self.writer.submit(self._put, record)
+
+    def _put(self, record):
+        body = record[5]
+        if body is not None:
+            body = zlib.compress(body, self.level)
+        record = record[:5] + (body,) + record[6:]
+        size = len(body or b'') + len(record[6] or '') + len(record[4])
+
+        db = self.connect()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("""
+                INSERT OR REPLACE INTO Response (
+                    key, method, url, status, headers, body, data,
+                    expires, etag, modified, size, used)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                record + (size, time.time()))
+
+            total = db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM Response").fetchone()[0]
+            if total > self.size:
+                evicted = []
+                for key, size in db.execute(
+                        "SELECT key, size FROM Response ORDER BY used"):
+                    if total <= self.size:
+                        break
+                    evicted.append((key,))
+                    total -= size
+                db.executemany("DELETE FROM Response WHERE key = ?", evicted)
+
+    def _use(self, digest, now):
+        db = self.connect()
+        with db:
+            db.execute(
+                "UPDATE Response SET used = ? WHERE key = ?", (now, digest))
+
+    def refresh(self, scope, entry):
+        """ Renew a stored entry's expiry and validators on the
+        background thread.
+
+        :param scope: the endpoint's namespace
+        :param entry: the revalidated entry
+        """
+        record = (
+            time.time() + (entry.expires - time.monotonic()),
+            entry.etag, entry.modified, time.time(),
+            self.digest(scope, entry.key))
+
+        return self.writer.submit(self._refresh, record)
+
+    def _refresh(self, record):
+        db = self.connect()
+        with db:
+            db.execute("""
+                UPDATE      Response
+                SET         expires = ?, etag = ?, modified = ?, used = ?
+                WHERE       key = ?""", record)
+
+    def flush(self):
+        """ Wait for every pending write to be committed. """
+        self.writer.submit(int).result()
+
+    def clear(self):
+        """ Drop every stored entry. """
+        self.flush()
+        db = self.connect()
+        with db:
+            db.execute("DELETE FROM Response")
+
+    def close(self):
+        """ Close every connection handed out for the file. """
+        self.flush()
+        with self._lock:
+            for db in self.connections:
+                db.close()
+
+            self.connections = []
+            self._local = threading.local()
+
+
+def get_store(path, size=STORE_SIZE):
+    """ Get the persistent response store of a file.
+
+    Stores are shared process-wide, one per file, and keep the size
+    they were first opened with.
+
+    :param path: the path of the database file
+    :param size: (optional) the maximum total size of the stored
+                            entries, in bytes
+    """
+    key = os.path.abspath(path)
+
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = Store(path, size=size)
+
+        return _stores[key]
@@ -0,0 +1,254 @@
+"""
+ergal.executor
+~~~~~~~~~~~~~~
+
+This module implements the multi-process executor used to fan
+very large batches of calls out over stored profiles.
+
+:author: Elliott Maguire
+:copyright: (c) 2019 by Elliott Maguire
+"""
+
+import os
+import pickle
+import asyncio
+import itertools
+import collections
+import multiprocessing
+import multiprocessing.util
+import concurrent.futures
+
+from . import utils
+from .cache import Stored
+from .profile import Result, get_profile
+
+import aiohttp
+
+
+_loop = None
+
+
+class Executor:
+    """ Fans a batch of calls out across a pool of worker processes.
+
+    Jobs are (profile name, endpoint name) pairs, or (profile name,
+    endpoint name, call kwargs) triples. They are consumed lazily
+    and sent to the workers in chunks of `chunk_size`. Each worker
+    runs its own event loop for its whole life, loads the profiles
+    it is asked for by name from the database (see `get_profile`),
+    never creating them, and keeps their connection pools open
+    between chunks; the calls of a chunk run concurrently.
+
+    At most `window` chunks are queued or running at once, and the
+    next one is only sent once a finished one has been handed back,
+    so the parent never holds more than `window` chunks of results
+    however large the batch is.
+
+    Results are `Result` tuples, indexed by the job's position in
+    the batch. Unparsed responses are returned as `cache.Stored`
+    responses with their body read, and errors are captured on the
+    result instead of aborting the batch.
+
+    Example:
+
+        >>> jobs = (('GitHub', 'User', {'pathvars': {'id': i}}) for i in ids)
+        >>> with Executor(processes=8) as executor:
+        ...     for result in executor.map(jobs):
+        ...         print(result.index, result.value or result.error)
+
+    :param processes: (optional) the number of worker processes, which
+                                 defaults to the number of CPUs
+    :param chunk_size: (optional) the number of jobs sent to a worker
+                                  at once, and run concurrently by it
+    :param window: (optional) the maximum number of chunks in flight,
+                              which defaults to twice the number of
+                              worker processes
+    :param database: (optional) the path of the database file
+    :param test: (optional) specifies whether or not the test
+                            database should be used.
+    """
+    def __init__(
+            self, processes=None, chunk_size=100, window=None,
+            database=None, test=False):
+        self.processes = processes or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.window = window or 2 * self.processes
+        self.database = os.path.abspath(
+            utils.get_db(path=database, test=test).path)
+        self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    def close(self):
+        """ Shut the worker processes down, closing their profiles. """
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.pool = None
+
+    def _pool(self):
+        """ Get/start the worker pool.
+
+        Workers are spawned rather than forked, so that they do not
+        inherit the parent's database connections or event loop.
+        """
+        if self.pool is None:
+            self.pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_start)
+
+        return self.pool
+
+    def _chunks(self, jobs):
+        jobs = enumerate(jobs)
+        while True:
+            chunk = [
+                (index,) + tuple(job)
+                for index, job in itertools.islice(jobs, self.chunk_size)]
+            if not chunk:
+                return
+
+            yield chunk
+
+    def map(self, jobs, ordered=True):
+        """ Run a batch of jobs, yielding their results.
+
+        :param jobs: an iterable of jobs
+        :param ordered: (optional) specifies whether results are
+                                   yielded in job order, or chunk by
+                                   chunk as they complete.
+        """
+        pool = self._pool()
+        pending = collections.deque() if ordered else set()
+        try:
+            for chunk in self._chunks(jobs):
+                future = pool.submit(_run, self.database, chunk)
+                if ordered:
+                    pending.append(future)
+                else:
+                    pending.add(future)
+
+                while len(pending) >= self.window:
+                    yield from _next(pending, ordered)
+
+            while pending:
+                yield from _next(pending, ordered)
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def amap(self, jobs, ordered=True):
+        """ Run a batch of jobs without blocking the event loop,
+        yielding their results.
+
+        :param jobs: an iterable of jobs
+        :param ordered: (optional) specifies whether results are
+                                   yielded in job order, or chunk by
+                                   chunk as they complete.
+        """
+        pool = self._pool()
+        pending = collections.deque()
+        try:
+            for chunk in self._chunks(jobs):
+                pending.append(asyncio.wrap_future(
+                    pool.submit(_run, self.database, chunk)))
+
+                while len(pending) >= self.window:
+                    for result in await _anext(pending, ordered):
+                        yield result
+
+            while pending:
+                for result in await _anext(pending, ordered):
+                    yield result
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _next(pending, ordered):
+    """ Wait for the next chunk of results. """
+    if ordered:
+        return pending.popleft().result()
+
+    done, _ = concurrent.futures.wait(
+        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+    results = []
+    for future in done:
+        pending.discard(future)
+        results += future.result()
+
+    return results
+
+
+async def _anext(pending, ordered):
+    """ Wait for the next chunk of results on the event loop. """
+    if ordered:
+        return await pending.popleft()
+
+    done, _ = await asyncio.wait(
+        pending, return_when=asyncio.FIRST_COMPLETED)
+    results = []
+    for future in done:
+        pending.remove(future)
+        results += future.result()
+
+    return results
+
+
+def _start():
+    """ Set a worker process up with its own event loop. """
+    global _loop
+    _loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(_loop)
+    multiprocessing.util.Finalize(None, _stop, exitpriority=10)
+
+
+def _stop():
+    """ Close the worker's profiles and event loop on exit. """
+    from .profile import _profiles
+
+    for profile in list(_profiles.values()):
+        _loop.run_until_complete(profile.close())
+    _loop.close()
+
+
+def _run(database, chunk):
+    """ Run a chunk of jobs in a worker process. """
+    return _loop.run_until_complete(_batch(database, chunk))
+
+
+async def _batch(database, chunk):
+    async def run(index, profile, name, kwargs=None):
+        try:
+            profile = get_profile(profile, database=database, create=False)
+            value = await profile.call(name, **dict(kwargs or {}))
+            if isinstance(value, aiohttp.ClientResponse):
+                value = Stored(
+                    value.method, str(value.url), value.status,
+                    list(value.headers.items()), await value.read())
+        except Exception as e:
+            return Result(index, name, None, _portable(e))
+
+        return Result(index, name, value, None)
+
+    return await asyncio.gather(*(run(*job) for job in chunk))
+
+
+def _portable(error):
+    """ Make sure an error can be sent back to the parent process. """
+    try:
+        pickle.loads(pickle.dumps(error))
+    except Exception:
+        return Exception(f"{type(error).__name__}: {error}")
+
+    return error
@@ -0,0 +1,194 @@
+"""
+ergal.limits
+~~~~~~~~~~~~
+
+This module implements the client-side rate limiting used by
+the Profile interface.
+
+:author: Elliott Maguire
+:copyright: (c) 2019 by Elliott Maguire
+"""
+
+import time
+import asyncio
+import collections
+import email.utils
+
+
+class Limiter:
+    """ A token bucket rate limiter with adaptive concurrency.
+
+    Calls take a token from a bucket refilled at `rate` tokens per
+    second, holding up to `burst` tokens. The number of calls in
+    flight is governed by an AIMD window: it grows by one call per
+    window's worth of successful responses, and halves whenever the
+    server answers `429 Too Many Requests` or `503 Service
+    Unavailable`. Until the first such answer the window is open,
+    unless `concurrency` is given.
+
+    `Retry-After`, `X-RateLimit-Remaining`/`X-RateLimit-Reset` and
+    `RateLimit-Remaining`/`RateLimit-Reset` headers pause the bucket
+    until the server is ready to accept calls again.
+
+    :param rate: (optional) the sustained number of calls per second
+    :param burst: (optional) the number of calls allowed at once
+                             after an idle period
+    :param concurrency: (optional) the maximum number of calls in flight
+    :param retries: (optional) the number of times a call answered
+                               with 429 or 503 is retried
+    """
+    def __init__(self, rate=None, burst=None, concurrency=None, retries=3):
+        self.rate = rate
+        self.burst = burst or max(1, rate or 1)
+        self.concurrency = concurrency
+        self.retries = retries
+
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.blocked = 0.0
+
+        self.window = float(concurrency) if concurrency else None
+        self.active = 0
+        self.waiters = collections.deque()
+
+    @property
+    def size(self):
+        """ The number of calls currently allowed in flight. """
+        return max(1, int(self.window)) if self.window else None
+
+    async def acquire(self):
+        """ Wait for a concurrency slot and a token. """
+        if self.waiters or (self.size and self.active >= self.size):
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self.release()
+                raise
+        else:
+            self.active += 1
+
+        delay = self._reserve()
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                self.release()
+                raise
+
+    def release(self, response=None):
+        """ Free a concurrency slot, adapting to the response.
+
+        Returns whether the call should be retried.
+
+        :param response: (optional) the response received
+        """
+        self.active -= 1
+
+        retry = False
+        if response is not None:
+            retry = self.feedback(response.status, response.headers)
+
+        self._wake()
+        return retry
+
+    def feedback(self, status, headers):
+        """ Adapt to a response's status and rate limit headers.
+
+        Returns whether the call was rejected for exceeding a limit.
+
+        :param status: the response's status code
+        :param headers: the response's headers
+        """
+        if status in (429, 503):
+            delay = retry_after(headers.get('Retry-After'))
+            self.pause(1.0 if delay is None else delay)
+            self.window = max(1.0, (self.window or self.active + 1) / 2)
+            return True
+
+        remaining = headers.get(
+            'X-RateLimit-Remaining', headers.get('RateLimit-Remaining'))
+        if remaining is not None and remaining.strip() in ('0', '0.0'):
+            delay = reset_after(headers.get(
+                'X-RateLimit-Reset', headers.get('RateLimit-Reset')))
+            self.pause(1.0 if delay is None else delay)
+
+        if self.window:
+            self.window += 1 / self.window
+            if self.concurrency:
+                self.window = min(self.window, float(self.concurrency))
+
+        return False
+
+    def pause(self, seconds):
+        """ Hold every call for at least `seconds`.
+
+        :param seconds: the number of seconds to pause for
+        """
+        self.blocked = max(self.blocked, time.monotonic() + seconds)
+
+    def _reserve(self):
+        """ Take a token, returning how long to wait before using it. """
+        now = time.monotonic()
+        delay = max(self.blocked - now, 0.0)
+        if not self.rate:
+            return delay
+
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens < 0:
+            delay = max(delay, -self.tokens / self.rate)
+
+        return delay
+
+    def _wake(self):
+        """ Hand free slots to waiting calls, in order. """
+        while self.waiters and not (self.size and self.active >= self.size):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.active += 1
+                waiter.set_result(None)
+
+
+def retry_after(value):
+    """ Parse a `Retry-After` header into seconds.
+
+    :param value: the header value, in seconds or as an HTTP date
+    """
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    return max(date.timestamp() - time.time(), 0.0)
+
+
+def reset_after(value):
+    """ Parse a rate limit reset header into seconds.
+
+    Values larger than a day are taken to be Unix timestamps, and
+    anything smaller to be a number of seconds.
+
+    :param value: the header value
+    """
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+
+    if value > 86400:
+        value -= time.time()
+
+    return max(value, 0.0)
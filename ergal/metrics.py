@@ -0,0 +1,320 @@
+"""
+ergal.metrics
+~~~~~~~~~~~~~
+
+This module implements the call instrumentation used by the
+Profile interface: per-attempt timings, latency histograms, and
+their export as JSON or Prometheus text.
+
+:author: Elliott Maguire
+:copyright: (c) 2019 by Elliott Maguire
+"""
+
+import time
+import bisect
+import collections
+
+import aiohttp
+
+
+EVENTS = (
+    'request_start', 'connection_acquired', 'first_byte',
+    'body_complete', 'parse_complete', 'error')
+
+PHASES = (
+    'queue', 'dns', 'connect', 'first_byte', 'download', 'parse', 'total')
+
+BOUNDS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Timing:
+    """ The timeline of a single request attempt.
+
+    Timestamps are taken from `time.perf_counter`, and are None for
+    the steps the attempt did not go through (e.g. `dns` and
+    `connect` when a pooled connection was reused).
+
+    :param name: the name of the endpoint
+    :param method: the HTTP method
+    """
+    __slots__ = (
+        'name', 'method', 'status', 'error', 'start',
+        'queued', 'dequeued', 'resolving', 'resolved',
+        'connecting', 'connected', 'acquired',
+        'first_byte', 'complete', 'parsed', 'hooks')
+
+    def __init__(self, name, method):
+        self.name = name
+        self.method = method
+        self.status = None
+        self.error = None
+        self.start = time.perf_counter()
+
+        self.queued = self.dequeued = None
+        self.resolving = self.resolved = None
+        self.connecting = self.connected = self.acquired = None
+        self.first_byte = self.complete = self.parsed = None
+        self.hooks = None
+
+    def phases(self):
+        """ Get the duration of each phase the attempt went through,
+        in seconds.
+
+        `connect` covers the TCP and TLS handshakes, excluding DNS
+        resolution, and `first_byte` runs from the start of the
+        attempt to the arrival of the response headers.
+        """
+        phases = {}
+        if self.dequeued is not None:
+            phases['queue'] = self.dequeued - self.queued
+        if self.resolved is not None:
+            phases['dns'] = self.resolved - self.resolving
+        if self.connected is not None:
+            phases['connect'] = (
+                self.connected - self.connecting - phases.get('dns', 0))
+        if self.first_byte is not None:
+            phases['first_byte'] = self.first_byte - self.start
+            if self.complete is not None:
+                phases['download'] = self.complete - self.first_byte
+        if self.parsed is not None:
+            phases['parse'] = self.parsed - self.complete
+
+        end = self.parsed or self.complete
+        if end is not None:
+            phases['total'] = end - self.start
+
+        return phases
+
+
+class Histogram:
+    """ A latency histogram with fixed bucket bounds.
+
+    :param bounds: (optional) the upper bounds of the buckets, in seconds
+    """
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """ Record a value.
+
+        :param value: the value, in seconds
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        """ Add another histogram's observations to this one. """
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q):
+        """ Estimate a quantile by interpolating within its bucket.
+
+        :param q: the quantile, between 0 and 1
+        """
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                low = self.bounds[i - 1] if i else 0.0
+                high = self.bounds[i] if i < len(self.bounds) else low
+                return low + (high - low) * (rank - seen) / count
+            seen += count
+
+        return self.bounds[-1]
+
+    def summary(self):
+        """ Get a dict of the histogram's count, mean and quantiles. """
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99)}
+
+
+class Metrics:
+    """ Per-endpoint call counters and phase latency histograms.
+
+    :param bounds: (optional) the histogram bucket bounds, in seconds
+    """
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        self.requests = collections.Counter()
+        self.errors = collections.Counter()
+        self.statuses = collections.Counter()
+        self.histograms = {}
+
+    def record(self, timing):
+        """ Record a finished attempt.
+
+        :param timing: the attempt's Timing
+        """
+        self.requests[timing.name] += 1
+        if timing.error is not None:
+            self.errors[timing.name] += 1
+        if timing.status is not None:
+            self.statuses[(timing.name, timing.status)] += 1
+
+        for phase, seconds in timing.phases().items():
+            self.observe(timing.name, phase, seconds)
+
+    def observe(self, name, phase, seconds):
+        """ Record the duration of a phase.
+
+        :param name: the name of the endpoint
+        :param phase: the name of the phase
+        :param seconds: the phase's duration
+        """
+        histogram = self.histograms.get((name, phase))
+        if histogram is None:
+            histogram = self.histograms[(name, phase)] = (
+                Histogram(self.bounds))
+        histogram.observe(seconds)
+
+    def stats(self):
+        """ Get a dict of the per-endpoint and overall statistics. """
+        endpoints = {}
+        overall = {}
+        for (name, phase), histogram in sorted(self.histograms.items()):
+            if name not in endpoints:
+                endpoints[name] = self._endpoint(name)
+            endpoints[name]['latency'][phase] = histogram.summary()
+
+            if phase not in overall:
+                overall[phase] = Histogram(self.bounds)
+            overall[phase].merge(histogram)
+
+        for name in self.requests:
+            if name not in endpoints:
+                endpoints[name] = self._endpoint(name)
+
+        return {
+            'requests': sum(self.requests.values()),
+            'errors': sum(self.errors.values()),
+            'latency': {k: v.summary() for k, v in overall.items()},
+            'endpoints': endpoints}
+
+    def _endpoint(self, name):
+        return {
+            'requests': self.requests[name],
+            'errors': self.errors[name],
+            'statuses': {
+                str(status): count
+                for (n, status), count in sorted(self.statuses.items())
+                if n == name},
+            'latency': {}}
+
+    def prometheus(self, profile, counters=None):
+        """ Render the metrics in the Prometheus text format.
+
+        :param profile: the name of the profile, used as a label
+        :param counters: (optional) a mapping of extra profile-wide
+                                    counters to export
+        """
+        labels = f'profile="{_escape(profile)}"'
+        lines = [
+            '# HELP ergal_requests_total Requests sent per endpoint.',
+            '# TYPE ergal_requests_total counter']
+        for name, count in sorted(self.requests.items()):
+            lines.append(
+                f'ergal_requests_total{{{labels},'
+                f'endpoint="{_escape(name)}"}} {count}')
+
+        lines += [
+            '# HELP ergal_errors_total Requests that raised per endpoint.',
+            '# TYPE ergal_errors_total counter']
+        for name, count in sorted(self.errors.items()):
+            lines.append(
+                f'ergal_errors_total{{{labels},'
+                f'endpoint="{_escape(name)}"}} {count}')
+
+        lines += [
+            '# HELP ergal_responses_total Responses per endpoint and status.',
+            '# TYPE ergal_responses_total counter']
+        for (name, status), count in sorted(self.statuses.items()):
+            lines.append(
+                f'ergal_responses_total{{{labels},'
+                f'endpoint="{_escape(name)}",status="{status}"}} {count}')
+
+        lines += [
+            '# HELP ergal_phase_seconds Request phase latencies.',
+            '# TYPE ergal_phase_seconds histogram']
+        for (name, phase), histogram in sorted(self.histograms.items()):
+            series = f'{labels},endpoint="{_escape(name)}",phase="{phase}"'
+            cumulative = 0
+            for bound, count in zip(
+                    self.bounds + (float('inf'),), histogram.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(
+                    f'ergal_phase_seconds_bucket{{{series},le="{le}"}} '
+                    f'{cumulative}')
+            lines.append(
+                f'ergal_phase_seconds_sum{{{series}}} {histogram.sum!r}')
+            lines.append(
+                f'ergal_phase_seconds_count{{{series}}} {histogram.count}')
+
+        if counters:
+            lines += [
+                '# HELP ergal_events_total Profile-wide call events.',
+                '# TYPE ergal_events_total counter']
+            for event, count in sorted(counters.items()):
+                lines.append(
+                    f'ergal_events_total{{{labels},'
+                    f'event="{_escape(event)}"}} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    """ Escape a Prometheus label value. """
+    return (
+        str(value).replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n'))
+
+
+def get_trace_config():
+    """ Create an aiohttp trace config that fills in the Timing passed
+    to a request as its `trace_request_ctx`. """
+    def stamp(*fields, event=None):
+        async def callback(session, context, params):
+            timing = context.trace_request_ctx
+            if type(timing) is not Timing:
+                return
+
+            now = time.perf_counter()
+            for field in fields:
+                setattr(timing, field, now)
+            if event is not None and timing.hooks is not None:
+                timing.hooks(event, timing)
+
+        return callback
+
+    config = aiohttp.TraceConfig()
+    config.on_connection_queued_start.append(stamp('queued'))
+    config.on_connection_queued_end.append(stamp('dequeued'))
+    config.on_dns_resolvehost_start.append(stamp('resolving'))
+    config.on_dns_resolvehost_end.append(stamp('resolved'))
+    config.on_connection_create_start.append(stamp('connecting'))
+    config.on_connection_create_end.append(
+        stamp('connected', 'acquired', event='connection_acquired'))
+    config.on_connection_reuseconn.append(
+        stamp('acquired', event='connection_acquired'))
+    config.on_request_end.append(stamp('first_byte', event='first_byte'))
+    config.freeze()
+
+    return config
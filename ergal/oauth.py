@@ -0,0 +1,151 @@
+"""
+ergal.oauth
+~~~~~~~~~~~
+
+This module implements the OAuth2 bearer token handling used by
+the Profile interface.
+
+:author: Elliott Maguire
+:copyright: (c) 2019 by Elliott Maguire
+"""
+
+import time
+import base64
+import asyncio
+import urllib.parse
+
+
+SKEW = 5.0
+
+
+class TokenSource:
+    """ Fetches, caches and refreshes OAuth2 access tokens.
+
+    Tokens are requested from `token_url` with the client credentials
+    grant, or with the refresh token grant if a `refresh_token` is
+    given (a rotated refresh token returned by the server replaces
+    it). The client credentials are sent with HTTP basic auth, or
+    the client identifier alone in the form if there is no secret.
+
+    A token is used until `SKEW` seconds before it expires. Once it
+    is within `leeway` seconds of expiring, a refresh is started in
+    the background while calls keep using it, so that calls rarely
+    wait on the token endpoint. Only one refresh is ever in flight;
+    concurrent calls that need a token wait on it.
+
+    :param token_url: the URL of the token endpoint
+    :param client_id: (optional) the client identifier
+    :param client_secret: (optional) the client secret
+    :param scope: (optional) the scope requested
+    :param refresh_token: (optional) a refresh token
+    :param leeway: (optional) the number of seconds before expiry at
+                              which a token is refreshed
+    :param token: (optional) a cached access token
+    :param expires: (optional) the cached token's expiry, as a Unix time
+    :param save: (optional) a coroutine function called with the source
+                            after every refresh, to persist its state
+    """
+    def __init__(
+            self, token_url, client_id=None, client_secret=None,
+            scope=None, refresh_token=None, leeway=60.0,
+            token=None, expires=None, save=None):
+        self.token_url = token_url
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.scope = scope
+        self.refresh_token = refresh_token
+        self.leeway = leeway
+
+        self.token = token
+        self.expires = expires or 0.0
+        self.refreshes = 0
+
+        self._save = save
+        self._flight = None
+
+    @property
+    def valid(self):
+        return self.token is not None and time.time() < self.expires - SKEW
+
+    async def get(self, session):
+        """ Get a valid access token, refreshing it if needed.
+
+        :param session: the aiohttp session used to reach the endpoint
+        """
+        if not self.valid:
+            return await self.refresh(session, self.token)
+
+        if time.time() >= self.expires - self.leeway:
+            self._refresh(session)
+
+        return self.token
+
+    async def refresh(self, session, stale):
+        """ Replace a token that was rejected or has expired.
+
+        If the current token is no longer `stale`, another refresh
+        has already replaced it, and it is returned as is.
+
+        :param session: the aiohttp session used to reach the endpoint
+        :param stale: the token to replace
+        """
+        if self.token != stale and self.valid:
+            return self.token
+
+        return await asyncio.shield(self._refresh(session))
+
+    def _refresh(self, session):
+        """ Get/start the refresh in flight. """
+        if self._flight is None:
+            self._flight = asyncio.ensure_future(self._fetch(session))
+            self._flight.add_done_callback(self._landed)
+
+        return self._flight
+
+    def _landed(self, flight):
+        self._flight = None
+        if not flight.cancelled():
+            flight.exception()
+
+    async def _fetch(self, session):
+        """ Request a new token from the token endpoint. """
+        if self.refresh_token:
+            data = {
+                'grant_type': 'refresh_token',
+                'refresh_token': self.refresh_token}
+        else:
+            data = {'grant_type': 'client_credentials'}
+        if self.scope:
+            data['scope'] = self.scope
+
+        headers = {'Accept': 'application/json'}
+        if self.client_secret is not None:
+            credentials = ':'.join(
+                urllib.parse.quote_plus(str(v or ''))
+                for v in (self.client_id, self.client_secret))
+            headers['Authorization'] = (
+                'Basic ' + base64.b64encode(credentials.encode()).decode())
+        elif self.client_id is not None:
+            data['client_id'] = self.client_id
+
+        async with session.post(
+                self.token_url, data=data, headers=headers) as response:
+            if response.status != 200:
+                raise Exception(
+                    f"oauth2: token request failed with {response.status}")
+            payload = await response.json(content_type=None)
+
+        try:
+            self.token = payload['access_token']
+        except (KeyError, TypeError):
+            raise Exception('oauth2: no access token in response')
+
+        self.expires = time.time() + float(payload.get('expires_in', 3600))
+        self.refresh_token = payload.get(
+            'refresh_token', self.refresh_token)
+        self.refreshes += 1
+
+        if self._save is not None:
+            await self._save(self)
+
+        return self.token
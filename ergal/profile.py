@@ -9,24 +9,107 @@ the user to manage their API profiles.
 :copyright: (c) 2019 by Elliott Maguire
 """
 
+import os
 import json
+import time
 import uuid
+import hashlib
+import asyncio
+import inspect
 import sqlite3
+import functools
+import threading
+import collections
+import collections.abc
 
 from . import utils
+from .cache import STORE_SIZE, Cache, get_store
+from .retry import Policy
+from .oauth import TokenSource
+from .limits import Limiter
+from .metrics import EVENTS, Timing, Metrics, get_trace_config
+from .template import Template
 
-import xmltodict as xtd
-import requests
-from requests.auth import HTTPDigestAuth
+import aiohttp
+
+
+_profiles = {}
+_profiles_lock = threading.Lock()
+
+
+def get_profile(
+        name, base=None, test=False, database=None, create=True, **kwargs):
+    """ Get a cached, already loaded profile.
+
+    Profiles are cached process-wide per database file and name. A
+    cached profile is returned as is unless its database row has
+    changed since it was loaded (including changes written by other
+    processes), in which case it is reloaded first. A cached profile
+    whose row has been deleted is dropped, and the profile is looked
+    up again as if it had never been loaded. Options other than
+    `base`, `test`, `database` and `create` only apply when the
+    profile is first constructed.
+
+    :param name: the name of the API profile
+    :param base: (optional) the base URL of the API, used if the
+                            profile does not exist yet
+    :param test: (optional) specifies whether or not the test
+                            database should be used.
+    :param database: (optional) the path of the database file
+    :param create: (optional) specifies whether or not a profile that
+                              does not exist yet is created; if not,
+                              an exception is raised instead.
+    """
+    key = (os.path.abspath(utils.get_db(path=database, test=test).path), name)
+
+    with _profiles_lock:
+        profile = _profiles.get(key)
+        if profile is not None and not profile.fresh():
+            try:
+                profile._get()
+            except Exception:
+                del _profiles[key]
+                profile = None
+
+        if profile is None:
+            profile = Profile(
+                name, base=base, test=test, database=database,
+                create=create, **kwargs)
+            _profiles[key] = profile
+
+    return profile
+
+
+Result = collections.namedtuple('Result', 'index name value error')
+Result.__doc__ = """ The outcome of a single call in a batch.
+
+:param index: the position of the call's spec in the batch
+:param name: the name of the endpoint called
+:param value: the value returned by the call, or None on error
+:param error: the exception raised by the call, or None on success
+"""
+
+
+Download = collections.namedtuple(
+    'Download', 'path size sha256 status resumed content_type')
+Download.__doc__ = """ The outcome of a call streamed to a file or sink.
+
+:param path: the path of the file written, or None for a sink
+:param size: the size of the whole body, in bytes
+:param sha256: the hex SHA-256 digest of the whole body
+:param status: the response's status code
+:param resumed: whether the body was appended to a partial file
+:param content_type: the response's media type
+"""
 
 
 class Profile:
     """ Enables API profile management.
 
     This class handles the creation/storage/management of API
-    profiles in a local SQLite3 database called `ergal.db`, unless
-    it is instantiated as a test instance, in which case the
-    database is called `ergal_test.db`.
+    profiles in a local SQLite3 database called `ergal.db` (or the
+    file given by `database`), unless it is instantiated as a test
+    instance, in which case the database is called `ergal_test.db`.
 
     :param name: a name for the API profile
     :param base: (optional) the base URL of the API
@@ -34,6 +117,39 @@ class Profile:
                             are printed on execution of certain methods.
     :param test: (optional) specifies whether or not the database
                             instance created should be a test instance.
+    :param pool_size: (optional) the maximum number of pooled connections
+                                 kept open to the base host.
+    :param keepalive: (optional) the number of seconds an idle pooled
+                                 connection is kept open.
+    :param dns_ttl: (optional) the number of seconds host lookups are
+                               kept in the DNS cache shared by every
+                               profile in the process; None gives each
+                               connection pool its own cache.
+    :param database: (optional) the path of the database file, which
+                                defaults to `utils.DATABASE`.
+    :param metrics: (optional) specifies whether or not call counters
+                               and latency histograms are kept.
+    :param parse_threshold: (optional) the body size, in bytes, from
+                                       which responses are parsed on a
+                                       worker pool; None parses every
+                                       body on the event loop.
+    :param parse_workers: (optional) the number of parse workers.
+    :param parse_processes: (optional) specifies whether or not the
+                                       parse workers are processes
+                                       rather than threads.
+    :param cache_path: (optional) the path of the persistent response
+                                  cache file, which defaults to the
+                                  database's path with a `.cache`
+                                  suffix before its extension.
+    :param cache_size: (optional) the maximum size of the persistent
+                                  response cache, in bytes.
+    :param create: (optional) specifies whether or not the profile is
+                              created if it does not exist yet; if not,
+                              an exception is raised instead.
+
+    Calls made through a profile share one keep-alive connection pool,
+    which should be released with `close` (or by using the profile as
+    an async context manager) once the profile is no longer needed.
 
     Example:
 
@@ -42,9 +158,32 @@ class Profile:
         >>> asyncio.run(profile.call('JSON'))
         <dict of response data>
     """
-    def __init__(self, name, base=None, logs=False, test=False):
+    def __init__(
+            self, name, base=None, logs=False, test=False,
+            pool_size=100, keepalive=15.0, dns_ttl=60.0, database=None,
+            metrics=True,
+            parse_threshold=utils.OFFLOAD_SIZE, parse_workers=4,
+            parse_processes=False, cache_path=None, cache_size=STORE_SIZE,
+            create=True):
         self.logs = logs
 
+        self.parse_threshold = parse_threshold
+        self.parse_workers = parse_workers
+        self.parse_processes = parse_processes
+        self._executor = None
+
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        self.dns_ttl = dns_ttl
+        self.session = None
+        self._loop = None
+        self._pinger = None
+        self._traced = False
+        self._keepers = set()
+
+        self.metrics = Metrics() if metrics else None
+        self.hooks = {}
+
         self.name = name if type(name) is str else 'default'
         self.id = (
             uuid.uuid5(uuid.NAMESPACE_DNS, self.name).hex
@@ -52,30 +191,180 @@ class Profile:
 
         self.base = base if type(base) is str else 'default'
         self.auth = {}
-        self.endpoints = {}
+        self.oauth = None
+        self.limits = {}
+        self.endpoints = Endpoints(self)
+        self.caches = {}
+        self.compiled = {}
+        self.flights = {}
+        self.limiters = {}
+        self.policies = {}
+        self.counters = collections.Counter()
+        self.version = None
+        self._snapshot = None
 
-        self.db, self.cursor = utils.get_db(test=test)
+        self.database = utils.get_db(path=database, test=test)
+
+        root, ext = os.path.splitext(self.database.path)
+        self.cache_path = cache_path or f"{root}.cache{ext}"
+        self.cache_size = cache_size
 
         try:
             self._get()
         except Exception as e:
-            if str(e) == 'get: no matching record':
-                self._create()
-            else:
+            if str(e) != 'get: no matching record':
                 raise Exception('get/create: unknown error occurred')
+            elif not create:
+                raise
+
+            self._create()
+
+    @property
+    def db(self):
+        """ The database connection of the current thread. """
+        return self.database.connect()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        """ Close the profile's connection pool.
+
+        Every session the profile opened on the running loop is
+        closed. Sessions left open on other loops are closed when
+        their loop shuts down (see `_session`).
+        """
+        loop = asyncio.get_running_loop()
+        if self._pinger is not None:
+            self._pinger.cancel()
+            self._pinger = None
+
+        keepers = [k for k in self._keepers if k.get_loop() is loop]
+        for keeper in keepers:
+            keeper.cancel()
+        await asyncio.gather(*keepers, return_exceptions=True)
+
+        stores = {c.store for c in self.caches.values() if c.store}
+        for store in stores:
+            await loop.run_in_executor(None, store.flush)
+
+        self.session = None
+        self._loop = None
+
+    def _session(self):
+        """ Get/create the pooled session for the running loop.
+
+        Sessions are bound to the loop they were created on, so a new
+        one is created if the profile is used from a different loop.
+        Sessions are only traced when metrics or hooks are enabled.
+
+        Each session is watched by a task that closes it once
+        cancelled, either by `close` or by the loop shutting down
+        (`asyncio.run` cancels every pending task before it closes
+        its loop), so that a session is never left open when the
+        profile moves on to another loop.
+        """
+        loop = asyncio.get_running_loop()
+        if (self.session is None or self.session.closed
+                or self._loop is not loop):
+            self._traced = self.metrics is not None or bool(self.hooks)
+            self.session = utils.get_session(
+                pool_size=self.pool_size, keepalive=self.keepalive,
+                trace_configs=[get_trace_config()] if self._traced else None,
+                dns_ttl=self.dns_ttl)
+            self._loop = loop
+
+            keeper = loop.create_task(_keep(self.session))
+            keeper.add_done_callback(self._keepers.discard)
+            self._keepers.add(keeper)
+
+        return self.session
+
+    async def warmup(self, connections=10, path='', ping=None):
+        """ Open pooled connections to the base host ahead of a burst
+        of calls.
+
+        The host is resolved (and cached), and `connections` HEAD
+        requests to `path` are sent at once, so that each opens (or
+        reuses) a pooled connection, handshakes included, which is
+        then left idle for the calls that follow. The requests are
+        not rate limited, retried or recorded in the metrics, and
+        their status does not matter.
+
+        If `ping` is given, the requests are repeated every `ping`
+        seconds until the profile is closed, so that the connections
+        are never idle for long enough to be closed; `ping` should be
+        shorter than the profile's `keepalive`.
+
+        Returns the number of requests that got a response.
+
+        :param connections: (optional) the number of connections to open
+        :param path: (optional) the path requested, relative to the base
+        :param ping: (optional) the interval between keep-alive pings,
+                                in seconds
+        """
+        if self.pool_size:
+            connections = min(connections, self.pool_size)
+
+        opened = await self._warm(connections, path)
+
+        if self._pinger is not None:
+            self._pinger.cancel()
+            self._pinger = None
+        if ping is not None:
+            self._pinger = asyncio.ensure_future(
+                self._ping(connections, path, ping))
+
+        return opened
+
+    async def _warm(self, connections, path):
+        session = self._session()
+
+        async def touch():
+            try:
+                async with session.head(
+                        self.base + path, allow_redirects=False) as response:
+                    await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                return False
+
+            return True
+
+        return sum(await asyncio.gather(*(
+            touch() for _ in range(connections))))
+
+    async def _ping(self, connections, path, interval):
+        while True:
+            await asyncio.sleep(interval)
+            await self._warm(connections, path)
 
     def _get(self):
-        """ Get an existing profile. """
-        sql = "SELECT * FROM Profile WHERE id = ?"
-        self.cursor.execute(sql, (self.id,))
+        """ Get an existing profile.
 
-        record = self.cursor.fetchone()
+        Endpoints are not read here; they are loaded one at a time
+        as they are first accessed through `endpoints`.
+        """
+        sql = """
+            SELECT      id, name, base, auth, version, limits
+            FROM        Profile
+            WHERE       id = ?"""
+        record = self.db.execute(sql, (self.id,)).fetchone()
         if record:
             self.id = record[0]
             self.name = record[1]
             self.base = record[2]
             self.auth = json.loads(record[3]) if record[3] else {}
-            self.endpoints = json.loads(record[4]) if record[4] else {}
+            self.oauth = None
+            self.version = record[4]
+            self.limits = json.loads(record[5]) if record[5] else {}
+            self.endpoints = Endpoints(self)
+            self.caches.clear()
+            self.compiled.clear()
+            self.limiters.clear()
+            self.policies.clear()
         else:
             raise Exception('get: no matching record')
 
@@ -85,97 +374,950 @@ class Profile:
     def _create(self):
         """ Create a new profile. """
         sql = "INSERT INTO Profile (id, name, base) VALUES (?, ?, ?)"
-        with self.db:
-            self.cursor.execute(sql, (self.id, self.name, self.base,))
+        with self.db as db:
+            db.execute(sql, (self.id, self.name, self.base,))
+        self.version = 0
 
         if self.logs:
             print(f"Profile for {self.name} created on {self.id}.")
 
+    def _touch(self, db):
+        """ Bump the profile's version within a write transaction.
+
+        If the new version is not the next one after the version last
+        read, another writer got in between, and the profile is marked
+        stale so that `get_profile` reloads it.
+
+        :param db: the connection holding the write transaction
+        """
+        db.execute(
+            "UPDATE Profile SET version = version + 1 WHERE id = ?",
+            (self.id,))
+        version = db.execute(
+            "SELECT version FROM Profile WHERE id = ?",
+            (self.id,)).fetchone()
+
+        self.database.changes += 1
+        if version and self.version is not None:
+            self.version = (
+                version[0] if version[0] == self.version + 1 else None)
+
+    def fresh(self):
+        """ Check whether the profile matches its database row.
+
+        `PRAGMA data_version` and the process-wide change counter
+        are checked first, so the row's version is only read when
+        some connection has committed since the last check.
+        """
+        db = self.db
+        snapshot = (
+            db, db.execute("PRAGMA data_version").fetchone()[0],
+            self.database.changes)
+        if snapshot == self._snapshot and self.version is not None:
+            return True
+
+        self._snapshot = snapshot
+        record = db.execute(
+            "SELECT version FROM Profile WHERE id = ?", (self.id,)).fetchone()
+
+        return bool(record) and record[0] == self.version
+
     def update(self):
         """ Update a profile's database entry. """
+        self._write(self._update())
+
+    async def aupdate(self):
+        """ Update a profile's database entry off the event loop.
+
+        See `Profile.awrite` for how the write is performed.
+        """
+        await self.awrite(self._update())
+
+    def delete(self):
+        """ Delete a profile's database entry. """
+        self._write(self._delete())
+
+    async def adelete(self):
+        """ Delete a profile's database entry off the event loop.
+
+        See `Profile.awrite` for how the write is performed.
+        """
+        await self.awrite(self._delete())
+
+    def _write(self, change):
+        """ Persist a change in a transaction on the current thread.
+
+        :param change: a (statements, log message, key) tuple
+        """
+        statements, message, _ = change
+        with self.db as db:
+            utils.execute(db, statements)
+
+        if self.logs:
+            print(message)
+
+    async def awrite(self, change):
+        """ Persist a change without blocking the event loop.
+
+        The change is run on the database's dedicated writer thread.
+        Changes queued while a transaction is being written are
+        committed together in the next transaction, in the order
+        they were made; a change to the profile row replaces any
+        queued, unwritten change to the same row, and is written after
+        every change queued before it. The await returns
+        once the change is committed and synced to disk.
+
+        :param change: a (statements, log message, key) tuple
+        """
+        statements, message, key = change
+        await asyncio.wrap_future(
+            self.database.submit(statements, key=key))
+
+        if self.logs:
+            print(message)
+
+    def _update(self):
+        self.compiled.clear()
+        self.oauth = None
+
         sql = """
             UPDATE      Profile
             SET         base = ?,
-                        auth = ?,
-                        endpoints = ?
+                        auth = ?
             WHERE       id = ?"""
-        with self.db:
-            self.cursor.execute(
-                sql, (
-                    self.base,
-                    json.dumps(self.auth),
-                    json.dumps(self.endpoints),
-                    self.id))
+        statements = [(sql, (self.base, json.dumps(self.auth), self.id))]
 
-        if self.logs:
-            print(f"Profile for {self.name} updated on {self.id}.")
+        removed, changed = self.endpoints.changes()
+        for name in removed:
+            statements += [
+                ("DELETE FROM Target WHERE profile = ? AND endpoint = ?",
+                 (self.id, name)),
+                ("DELETE FROM Endpoint WHERE profile = ? AND name = ?",
+                 (self.id, name))]
 
-    def delete(self):
-        """ Delete a profile's database entry. """
-        sql = "DELETE FROM Profile WHERE id = ?"
-        with self.db:
-            self.cursor.execute(sql, (self.id,))
+        sql = """
+            INSERT INTO Endpoint (profile, name, path, method, options)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (profile, name) DO UPDATE
+            SET         path = excluded.path,
+                        method = excluded.method,
+                        options = excluded.options"""
+        for name, endpoint in changed:
+            self.caches.pop(name, None)
+            self.limiters.pop(name, None)
+            self.policies.pop(name, None)
+            statements += [
+                (sql, (
+                    self.id, name, endpoint['path'], endpoint['method'],
+                    json.dumps(_options(endpoint)))),
+                ("DELETE FROM Target WHERE profile = ? AND endpoint = ?",
+                 (self.id, name)),
+                ("INSERT INTO Target (profile, endpoint, target) "
+                 "VALUES (?, ?, ?)",
+                 [(self.id, name, t) for t in endpoint.get('targets') or ()])]
 
-        if self.logs:
-            print(f"Profile for {self.name} deleted from {self.id}")
+        # Only a change to the profile row alone may replace a queued
+        # one; endpoint rows are only written by the change that saw
+        # them change.
+        return (
+            statements + [self._touch],
+            f"Profile for {self.name} updated on {self.id}.",
+            (self.id, 'Profile') if len(statements) == 1 else None)
+
+    def _delete(self):
+        self.database.changes += 1
+        self.version = None
+
+        return (
+            [("DELETE FROM Target WHERE profile = ?", (self.id,)),
+             ("DELETE FROM Endpoint WHERE profile = ?", (self.id,)),
+             ("DELETE FROM Profile WHERE id = ?", (self.id,))],
+            f"Profile for {self.name} deleted from {self.id}",
+            None)
 
     async def call(self, name, **kwargs):
         """ Call an endpoint.
 
+        The request is issued through the profile's pooled aiohttp
+        session, so concurrent calls (e.g. under `asyncio.gather`)
+        overlap and reuse keep-alive connections to the base host.
+        The returned response has its body read already.
+
+        Identical GET/HEAD calls (same endpoint, URL, params, headers
+        and credentials) made while one is already in flight share its
+        request and result; `counters['coalesced']` counts them.
+
+        Requests are paced by the profile's and the endpoint's rate
+        limits, if any (see `Profile.add_limit`), and retried or
+        hedged according to the endpoint's `retry` option, if any
+        (see `retry.Policy`). `counters` keeps the number of
+        `attempts` sent, and of `retries`, `hedges` and `hedges_won`.
+
+        If `stream_to` is given, the body is written to it instead
+        (see `Profile._download`) and a `Download` is returned.
+
         :param name: the name of the endpoint
         """
-        endpoint = self.endpoints[name]
-        url = self.base + endpoint['path']
-        targets = endpoint['targets'] if 'targets' in endpoint else None
-
-        if 'pathvars' in kwargs:
-            url = url.format(**kwargs['pathvars'])
-
-        if 'auth' in endpoint and endpoint['auth']:
-            if self.auth['method'] == 'headers':
-                kwargs['headers'] = {}
-                kwargs['headers'][self.auth['name']] = self.auth['value']
-            elif self.auth['method'] == 'params':
-                kwargs['params'] = {}
-                kwargs['params'][self.auth['name']] = self.auth['value']
-            elif self.auth['method'] == 'basic':
-                kwargs['auth'] = (
-                    self.auth['username'], self.auth['password'])
-            elif self.auth['method'] == 'digest':
-                kwargs['auth'] = HTTPDigestAuth(
-                    self.auth['username'], self.auth['password'])
-
-        for k in list(kwargs):
-            if k not in ('headers', 'params', 'data', 'body', 'auth'):
-                kwargs.pop(k)
-
-        response = getattr(requests, endpoint['method'].lower())(url, **kwargs)
-
-        if 'parse' in endpoint and endpoint['parse']:
-            data = await utils.parse(response, targets=targets)
+        if 'stream_to' in kwargs:
+            return await self._download(
+                name, kwargs.pop('stream_to'),
+                chunk_size=kwargs.pop('chunk_size', 65536),
+                resume=kwargs.pop('resume', True), **kwargs)
+
+        method, url, kwargs = self._prepare(name, kwargs)
+        key = Cache.key(method, url, kwargs)
+
+        cache, entry = self._cache(name), None
+        if cache is not None and method in ('GET', 'HEAD'):
+            entry = cache.get(key)
+            if entry is None and cache.store is not None:
+                entry = await cache.restore(key)
+            if entry is not None and entry.fresh:
+                return await self._cached(entry, name)
+
+        if method not in ('GET', 'HEAD'):
+            return await self._fetch(name, method, url, kwargs, key, entry)
+
+        flight = (name,) + key
+        if flight in self.flights:
+            self.counters['coalesced'] += 1
+            return await asyncio.shield(self.flights[flight])
+
+        task = asyncio.ensure_future(
+            self._fetch(name, method, url, kwargs, key, entry))
+        task.add_done_callback(lambda _: self.flights.pop(flight, None))
+        self.flights[flight] = task
+
+        return await asyncio.shield(task)
+
+    def _prepare(self, name, kwargs):
+        """ Build the method, URL and request keyword arguments of
+        a call.
+
+        :param name: the name of the endpoint
+        :param kwargs: the call's keyword arguments
+        """
+        template = self._template(name)
+        url, kwargs = template.build(kwargs)
+
+        return template.method, url, kwargs
+
+    async def _fetch(self, name, method, url, kwargs, key, entry):
+        """ Issue a prepared request and produce the call's result.
+
+        Identical concurrent GET/HEAD calls share a single `_fetch`,
+        so its result is handed to every caller of the flight.
+
+        :param name: the name of the endpoint
+        :param method: the HTTP method
+        :param url: the formatted request URL
+        :param kwargs: the request's keyword arguments
+        :param key: the request's cache key
+        :param entry: (optional) a stale cache entry to revalidate
+        """
+        template = self._template(name)
+        parse, targets = template.parse, template.targets
+        stream = template.stream
+        cache = self._cache(name) if method in ('GET', 'HEAD') else None
+
+        if entry is not None:
+            kwargs['headers'] = {
+                **(kwargs.get('headers') or {}), **entry.conditions()}
+
+        response, data, timing = await self._attempt(
+            name, method, url, kwargs,
+            functools.partial(utils.parse_stream, targets=targets)
+            if stream else None)
+        stream = data is not None
+
+        if cache is not None:
+            if response.status == 304 and entry is not None:
+                cache.refresh(entry, response)
+                return await self._cached(entry, name)
+
+            entry = None
+            if response.status == 200:
+                entry = cache.put(key, response)
+
+        if parse:
+            if not stream:
+                data = await self._parse(response, targets)
+            if timing is not None:
+                self._parsed(timing)
+            if entry is not None:
+                entry.data = data
+                cache.save(entry, None if stream else await response.read())
+
             return data
         else:
+            if entry is not None:
+                cache.save(entry, await response.read())
+
             return response
 
+    async def _download(self, name, sink, chunk_size, resume, **kwargs):
+        """ Stream a call's response body to a file or sink.
+
+        The body is written in `chunk_size` writes through a single
+        reused buffer, and hashed as it is written, so memory use is
+        independent of the size of the body. A sink is any object
+        with a `write` method, which may be a coroutine function,
+        and must consume the data before returning, as the buffer it
+        is handed is reused.
+
+        If `sink` is the path of an existing, partially written file
+        and `resume` is set, only the rest of the body is requested
+        with a `Range` header, and appended if the server answers
+        with the matching `206 Partial Content`; any other success
+        status rewrites the file. Downloads are paced by the rate
+        limits, but are not cached, coalesced, retried or hedged.
+
+        File writes, and the hashing of a resumed file's existing
+        part, run on the loop's default executor so that they do not
+        block the event loop.
+
+        :param name: the name of the endpoint
+        :param sink: a file path or an object with a `write` method
+        :param chunk_size: the size of each write, in bytes
+        :param resume: whether a partial file is resumed
+        """
+        method, url, kwargs = self._prepare(name, kwargs)
+
+        path = None
+        if isinstance(sink, (str, os.PathLike)):
+            path = os.fspath(sink)
+        offset = 0
+        if path is not None and resume and os.path.exists(path):
+            offset = os.path.getsize(path)
+        if offset:
+            # Ranges apply to the encoded body, so a resumed body must
+            # not be content-coded, like the decoded part on disk.
+            kwargs['headers'] = {
+                **(kwargs.get('headers') or {}),
+                'Range': f"bytes={offset}-", 'Accept-Encoding': 'identity'}
+
+        loop = asyncio.get_running_loop()
+
+        async def write(response):
+            resumed = (
+                offset and response.status == 206
+                and _range_start(response) == offset)
+
+            digest = hashlib.sha256()
+            if resumed:
+                digest = await loop.run_in_executor(
+                    None, _digest, path, chunk_size)
+
+            f = None
+            if path:
+                f = await loop.run_in_executor(
+                    None, open, path, 'ab' if resumed else 'wb')
+            buffer = memoryview(bytearray(chunk_size))
+            size, filled = 0, 0
+
+            def put(view):
+                digest.update(view)
+                f.write(view)
+
+            async def flush(view):
+                if f is not None:
+                    await loop.run_in_executor(None, put, view)
+                    return
+
+                digest.update(view)
+                result = sink.write(view)
+                if inspect.isawaitable(result):
+                    await result
+
+            try:
+                async for chunk in response.content.iter_any():
+                    chunk = memoryview(chunk)
+                    while chunk:
+                        n = min(len(chunk), chunk_size - filled)
+                        buffer[filled:filled + n] = chunk[:n]
+                        chunk, filled, size = chunk[n:], filled + n, size + n
+                        if filled == chunk_size:
+                            await flush(buffer)
+                            filled = 0
+                if filled:
+                    await flush(buffer[:filled])
+            finally:
+                if f is not None:
+                    await loop.run_in_executor(None, f.close)
+
+            return Download(
+                path, (offset if resumed else 0) + size, digest.hexdigest(),
+                response.status, bool(resumed), response.content_type)
+
+        response, download, _ = await self._request(
+            name, method, url, kwargs, write)
+        if download is not None:
+            return download
+        elif response.status == 416 and offset:
+            digest = await loop.run_in_executor(
+                None, _digest, path, chunk_size)
+            return Download(
+                path, offset, digest.hexdigest(), response.status, True, None)
+
+        raise Exception(
+            f"call: download failed with status {response.status}")
+
+    async def _attempt(self, name, method, url, kwargs, reader=None):
+        """ Issue a request under the endpoint's retry policy.
+
+        See `Profile._request` for arguments and return values.
+        """
+        policy = self._policy(name)
+        if policy is None or method not in policy.methods:
+            return await self._request(name, method, url, kwargs, reader)
+
+        policy.deposit()
+        attempt = 0
+        while True:
+            try:
+                result = await self._hedged(
+                    policy, name, method, url, kwargs, reader)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt >= policy.retries or not policy.withdraw():
+                    raise
+            else:
+                if (result[0].status not in policy.statuses
+                        or attempt >= policy.retries
+                        or not policy.withdraw()):
+                    return result
+
+            await asyncio.sleep(policy.delay(attempt))
+            attempt += 1
+            self.counters['retries'] += 1
+
+    async def _hedged(self, policy, name, method, url, kwargs, reader):
+        """ Issue a request, hedging it with a second one if it takes
+        longer than the policy's latency threshold.
+
+        The first request to succeed wins and the other is cancelled.
+        """
+        async def timed():
+            start = time.monotonic()
+            result = await self._request(name, method, url, kwargs, reader)
+            policy.observe(time.monotonic() - start)
+            return result
+
+        tasks = [asyncio.ensure_future(timed())]
+        try:
+            threshold = policy.threshold()
+            if threshold is not None:
+                await asyncio.wait(tasks, timeout=threshold)
+            if (threshold is not None and not tasks[0].done()
+                    and policy.withdraw()):
+                self.counters['hedges'] += 1
+                tasks.append(asyncio.ensure_future(timed()))
+
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in tasks:
+                    if task in done and task.exception() is None:
+                        if task is not tasks[0]:
+                            self.counters['hedges_won'] += 1
+                        return task.result()
+
+            return tasks[0].result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _request(self, name, method, url, kwargs, reader=None):
+        """ Issue a request under the endpoint's rate limits and read
+        its body.
+
+        A request answered with `429` or `503` is retried, up to the
+        limits' `retries`, once the pause the limiter took from the
+        response has passed; `counters['limited']` counts the retries.
+
+        Endpoints using `oauth2` authentication are sent with a bearer
+        token from the profile's `oauth.TokenSource`. A request answered
+        with `401` is retried once, with a refreshed token.
+
+        The body of a successful response is consumed by `reader`,
+        if given, instead of being buffered.
+
+        Returns the response, the output of `reader`, which is None
+        unless `reader` is given and the request succeeded, and the
+        request's `metrics.Timing`, which is None unless metrics or
+        hooks are enabled.
+
+        :param name: the name of the endpoint
+        :param method: the HTTP method
+        :param url: the formatted request URL
+        :param kwargs: the request's keyword arguments
+        :param reader: (optional) a coroutine function that consumes
+                               the body of a response
+        """
+        limiters = self._limiters(name)
+        oauth = self._template(name).oauth
+        attempt, renewed, request = 0, False, kwargs
+        while True:
+            acquired, response, data, timing = [], None, None, None
+            if oauth:
+                token = await self._oauth().get(self._session())
+                request = {**kwargs, 'headers': {
+                    **(kwargs.get('headers') or {}),
+                    'Authorization': f"Bearer {token}"}}
+
+            try:
+                for limiter in limiters:
+                    await limiter.acquire()
+                    acquired.append(limiter)
+
+                session = self._session()
+                if self._traced:
+                    timing = Timing(name, method)
+                    if self.hooks:
+                        timing.hooks = self._emit
+                        self._emit('request_start', timing)
+
+                # The response is not used as a context manager: releasing
+                # it on exit would stop `read` from serving the buffered body.
+                self.counters['attempts'] += 1
+                response = await session.request(
+                    method, url, trace_request_ctx=timing, **request)
+                if reader is not None and response.status < 300:
+                    try:
+                        data = await reader(response)
+                    finally:
+                        response.release()
+                else:
+                    await response.read()
+
+                if timing is not None:
+                    timing.status = response.status
+                    timing.complete = time.perf_counter()
+                    self._finish('body_complete', timing)
+            except BaseException as e:
+                if response is not None:
+                    response.close()
+                if timing is not None and isinstance(e, Exception):
+                    timing.error = e
+                    self._finish('error', timing)
+                raise
+            finally:
+                limited = [l for l in acquired if l.release(response)]
+
+            if oauth and response.status == 401 and not renewed:
+                renewed = True
+                await self._oauth().refresh(self._session(), token)
+                continue
+
+            if not any(attempt < l.retries for l in limited):
+                return response, data, timing
+
+            attempt += 1
+            self.counters['limited'] += 1
+
+    def on(self, event, callback):
+        """ Register a hook called on a call event.
+
+        The callback is called as `callback(event, timing)`, where
+        `timing` is the `metrics.Timing` of the request attempt, and
+        must not block. Events are emitted for every attempt:
+
+        - `request_start`: the request is about to be sent.
+        - `connection_acquired`: a new or pooled connection is ready.
+        - `first_byte`: the response headers have arrived.
+        - `body_complete`: the response body has been read.
+        - `parse_complete`: the response body has been parsed.
+        - `error`: the attempt raised an exception.
+
+        :param event: the name of the event
+        :param callback: a function taking the event name and timing
+        """
+        if event not in EVENTS:
+            raise Exception('on: unsupported event')
+
+        self.hooks.setdefault(event, []).append(callback)
+        if self.session is not None and not self._traced:
+            self.session = None
+
+    def off(self, event, callback):
+        """ Remove a hook registered with `Profile.on`.
+
+        :param event: the name of the event
+        :param callback: the registered callback
+        """
+        callbacks = self.hooks.get(event, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+        if not callbacks:
+            self.hooks.pop(event, None)
+
+    def stats(self):
+        """ Get the profile's call statistics.
+
+        The returned dict holds the number of requests and errors,
+        and summaries (count, mean, p50, p90, p99 in seconds) of the
+        latency of each request phase, overall and per endpoint,
+        along with the profile's `counters`.
+        """
+        stats = self.metrics.stats() if self.metrics is not None else {}
+        stats['profile'] = self.name
+        stats['counters'] = dict(self.counters)
+
+        return stats
+
+    def export(self, format='json'):
+        """ Export the profile's call statistics.
+
+        :param format: (optional) either `json`, for the output of
+                                  `Profile.stats` as JSON, or
+                                  `prometheus`, for the counters and
+                                  histograms in the Prometheus text
+                                  exposition format
+        """
+        if format == 'json':
+            return json.dumps(self.stats())
+        elif format == 'prometheus':
+            return (self.metrics or Metrics()).prometheus(
+                self.name, self.counters)
+        else:
+            raise Exception('export: unsupported format')
+
+    def _emit(self, event, timing):
+        """ Call the hooks registered for an event. """
+        for callback in self.hooks.get(event, ()):
+            callback(event, timing)
+
+    def _finish(self, event, timing):
+        """ Record a finished attempt and emit its final event. """
+        if self.metrics is not None:
+            self.metrics.record(timing)
+        if timing.hooks is not None:
+            self._emit(event, timing)
+
+    def _parsed(self, timing):
+        """ Record the parse of an attempt's response body. """
+        timing.parsed = time.perf_counter()
+        if self.metrics is not None:
+            self.metrics.observe(
+                timing.name, 'parse', timing.parsed - timing.complete)
+        if timing.hooks is not None:
+            self._emit('parse_complete', timing)
+
+    def _limiters(self, name):
+        """ Get the rate limiters of the profile and of an endpoint,
+        creating them from their stored limits on first use.
+
+        :param name: the name of the endpoint
+        """
+        limiters = []
+        for key, limits in (
+                (None, self.limits),
+                (name, self.endpoints[name].get('limit'))):
+            if not limits:
+                continue
+            if key not in self.limiters:
+                self.limiters[key] = Limiter(**limits)
+            limiters.append(self.limiters[key])
+
+        return limiters
+
+    def _policy(self, name):
+        """ Get/create the retry policy of an endpoint, if the
+        endpoint has retries enabled.
+
+        :param name: the name of the endpoint
+        """
+        options = self.endpoints[name].get('retry')
+        if not options:
+            return None
+
+        if name not in self.policies:
+            options = options if type(options) is dict else {}
+            self.policies[name] = Policy(**options)
+
+        return self.policies[name]
+
+    def _oauth(self):
+        """ Get/create the token source of the profile's `oauth2`
+        authentication details. """
+        if self.oauth is None:
+            self.oauth = TokenSource(
+                **{k: v for k, v in self.auth.items() if k in (
+                    'token_url', 'client_id', 'client_secret', 'scope',
+                    'refresh_token', 'leeway', 'token', 'expires')},
+                save=self._save_token)
+
+        return self.oauth
+
+    async def _save_token(self, source):
+        """ Store a refreshed token with the authentication details,
+        so that it is reused after a restart and by other processes.
+
+        :param source: the TokenSource that was refreshed
+        """
+        if source is not self.oauth:
+            return
+
+        self.auth = {
+            **self.auth, 'token': source.token, 'expires': source.expires}
+        if source.refresh_token:
+            self.auth['refresh_token'] = source.refresh_token
+
+        sql = "UPDATE Profile SET auth = ? WHERE id = ?"
+        await self.awrite((
+            [(sql, (json.dumps(self.auth), self.id))],
+            f"OAuth2 token for {self.name} refreshed on {self.id}.",
+            (self.id, 'token')))
+
+    def _cache(self, name):
+        """ Get/create the response cache of an endpoint, if the
+        endpoint has caching enabled.
+
+        :param name: the name of the endpoint
+        """
+        options = self.endpoints[name].get('cache')
+        if not options:
+            return None
+
+        if name not in self.caches:
+            options = options if type(options) is dict else {}
+            store = scope = None
+            if options.get('persist'):
+                store = get_store(self.cache_path, size=self.cache_size)
+                endpoint = self.endpoints[name]
+                scope = json.dumps([
+                    self.id, name, bool(endpoint.get('parse')),
+                    endpoint.get('targets'),
+                    self._fingerprint() if endpoint.get('auth') else None])
+
+            self.caches[name] = Cache(**{
+                k: v for k, v in options.items() if k in ('ttl', 'size')},
+                store=store, scope=scope)
+
+        return self.caches[name]
+
+    def _fingerprint(self):
+        """ Get a digest of the authentication details, leaving out
+        the `oauth2` tokens, which change on every refresh. """
+        auth = {
+            k: v for k, v in self.auth.items()
+            if k not in ('token', 'expires', 'refresh_token')}
+
+        return hashlib.sha256(
+            json.dumps(auth, sort_keys=True).encode()).hexdigest()
+
+    def _template(self, name):
+        """ Get the compiled request template of an endpoint.
+
+        Templates are rebuilt only after the endpoint, its targets,
+        the profile's authentication details or its base URL change.
+
+        :param name: the name of the endpoint
+        """
+        template = self.compiled.get(name)
+        if template is None:
+            template = self.compiled[name] = Template(
+                self.base, self.endpoints[name], self.auth)
+
+        return template
+
+    async def _parse(self, response, targets=None):
+        """ Parse a response, on the shared parse worker pool if its
+        body is at least `parse_threshold` bytes.
+
+        :param response: a response object with its body read
+        :param targets: (optional) a Targets object
+        """
+        if self.parse_threshold is None:
+            return await utils.parse(response, targets=targets)
+
+        if self._executor is None:
+            self._executor = utils.get_executor(
+                workers=self.parse_workers, processes=self.parse_processes)
+
+        return await utils.parse(
+            response, targets=targets, executor=self._executor,
+            threshold=self.parse_threshold)
+
+    async def _cached(self, entry, name):
+        """ Produce a call's return value from a cache entry.
+
+        The parse output is stored on the entry, so a response is
+        only parsed once however often it is served from the cache.
+        """
+        template = self._template(name)
+        if not template.parse:
+            return entry.response
+
+        if entry.data is None:
+            entry.data = await self._parse(entry.response, template.targets)
+
+        return entry.data
+
+    async def call_many(self, specs, limit=100):
+        """ Call endpoints in a bounded-concurrency batch.
+
+        Specs are consumed lazily and at most `limit` calls are in
+        flight at once, so memory stays flat however large the batch
+        is. Calls to the base host are further bounded by the
+        profile's `pool_size`. Results are yielded as they finish,
+        and errors are captured on the result instead of aborting
+        the batch.
+
+        Example:
+
+            >>> specs = (('User', {'pathvars': {'id': i}}) for i in ids)
+            >>> async for result in profile.call_many(specs, limit=50):
+            ...     print(result.index, result.value or result.error)
+
+        :param specs: an iterable of endpoint names or
+                      (name, call kwargs) pairs
+        :param limit: (optional) the maximum number of calls in flight
+        """
+        async def run(index, spec):
+            name = spec if type(spec) is str else spec[0]
+            try:
+                kwargs = {} if type(spec) is str else dict(spec[1])
+                value = await self.call(name, **kwargs)
+            except Exception as e:
+                return Result(index, name, None, e)
+
+            return Result(index, name, value, None)
+
+        pending = set()
+        try:
+            for index, spec in enumerate(specs):
+                pending.add(asyncio.ensure_future(run(index, spec)))
+                if len(pending) < limit:
+                    continue
+
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def paginate(self, name, prefetch=2, **kwargs):
+        """ Iterate over the items of a paginated endpoint.
+
+        The endpoint's `paginate` option declares how its pages are
+        addressed (see `docs/profile.md`). Items are yielded as each
+        page arrives, and a page is dropped once its items have been
+        yielded. Up to `prefetch` pages are requested ahead of the
+        one being consumed when pages are addressed by number or
+        offset; cursor and `Link` pages are requested one ahead, as
+        each depends on the page before it.
+
+        Example:
+
+            >>> async for user in profile.paginate('Users'):
+            ...     print(user['id'])
+
+        :param name: the name of the endpoint
+        :param prefetch: (optional) the number of pages requested ahead
+        """
+        options = self.endpoints[name].get('paginate')
+        if not options:
+            raise Exception('paginate: endpoint is not paginated')
+        elif type(options) is not dict:
+            options = {'type': options}
+
+        method, url, kwargs = self._prepare(name, kwargs)
+        kind = options.get('type')
+        if kind not in ('page', 'offset', 'cursor', 'link'):
+            raise Exception('paginate: unsupported pagination type')
+
+        items = options.get('items', 'data')
+        cursor = options.get('cursor')
+        targets = utils.Targets([items] + ([cursor] if cursor else []))
+        param = options.get('param', kind)
+
+        params = dict(kwargs.get('params') or {})
+        size, size_param = options.get('size'), options.get('size_param')
+        if kind == 'offset':
+            size, size_param = size or 100, size_param or 'limit'
+        if size and size_param:
+            params[size_param] = size
+
+        def fetch(url, params):
+            return asyncio.ensure_future(self._page(
+                name, method, url, {**kwargs, 'params': params}, targets))
+
+        tasks = collections.deque()
+        try:
+            if kind in ('page', 'offset'):
+                step = size if kind == 'offset' else 1
+                position = options.get('start', 0 if kind == 'offset' else 1)
+                while True:
+                    while len(tasks) <= prefetch:
+                        tasks.append(fetch(url, {**params, param: position}))
+                        position += step
+
+                    _, page = await tasks.popleft()
+                    values = page.get(items) or []
+                    for item in values:
+                        yield item
+
+                    if len(values) < (size or 1):
+                        break
+            else:
+                tasks.append(fetch(url, params))
+                while tasks:
+                    response, page = await tasks.popleft()
+                    if kind == 'cursor':
+                        following = page.get(cursor) and (
+                            url, {**params, param: page[cursor]})
+                    else:
+                        following = _following(response, params)
+
+                    if following and prefetch:
+                        tasks.append(fetch(*following))
+                    for item in page.get(items) or []:
+                        yield item
+                    if following and not prefetch:
+                        tasks.append(fetch(*following))
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _page(self, name, method, url, kwargs, targets):
+        """ Fetch and parse a page of a paginated endpoint.
+
+        Returns the response and the page's items and cursor.
+        """
+        response, _, timing = await self._attempt(name, method, url, kwargs)
+        if response.status >= 400:
+            raise Exception(
+                f"paginate: page request failed with status {response.status}")
+
+        page = await self._parse(response, targets)
+        if timing is not None:
+            self._parsed(timing)
+
+        return response, page
+
     def add_auth(self, method, **kwargs):
         """ Add authentication details.
 
         :param method: a supported authentication method
         """
-        auth = {'method': method}
+        self._write(self._add_auth(method, **kwargs))
 
-        for k, v in kwargs.items():
-            if k in ('name', 'value', 'username', 'password'):
-                auth[k] = v
+    async def aadd_auth(self, method, **kwargs):
+        """ Add authentication details off the event loop.
 
-        self.auth = auth
-        auth_str = json.dumps(self.auth)
-        sql = "UPDATE Profile SET auth = ? WHERE id = ?"
-        with self.db:
-            self.cursor.execute(sql, (auth_str, self.id,))
-
-        if self.logs:
-            print(f"Authentication details for {self.name} added on {self.id}.")
+        See `Profile.add_auth` for arguments and `Profile.awrite`
+        for how the write is performed.
+        """
+        await self.awrite(self._add_auth(method, **kwargs))
 
     def add_endpoint(self, name, path, method, **kwargs):
         """ Add an endpoint.
@@ -184,40 +1326,30 @@ class Profile:
         :param path: the path, from the base URL, to the endpoint
         :param method: a supported HTTP method
         """
-        endpoint = {'path': path,
-                    'method': method}
-
-        for key in kwargs:
-            if key in (
-                'headers', 'params', 'data', 'body',
-                'auth', 'parse', 'targets'):
-
-                endpoint[key] = kwargs[key]
-
-        self.endpoints[name] = endpoint
-        endpoints_str = json.dumps(self.endpoints)
+        self._write(self._add_endpoint(name, path, method, **kwargs))
 
-        sql = "UPDATE Profile SET endpoints = ? WHERE id = ?"
-        with self.db:
-            self.cursor.execute(sql, (endpoints_str, self.id,))
+    async def aadd_endpoint(self, name, path, method, **kwargs):
+        """ Add an endpoint off the event loop.
 
-        if self.logs:
-            print(f"Endpoint {name} for {self.name} added on {self.id}.")
+        See `Profile.add_endpoint` for arguments and `Profile.awrite`
+        for how the write is performed.
+        """
+        await self.awrite(self._add_endpoint(name, path, method, **kwargs))
 
     def del_endpoint(self, name):
         """ Delete an endpoint.
 
         :param name: the name of an endpoint
         """
-        del self.endpoints[name]
-        endpoints_str = json.dumps(self.endpoints)
+        self._write(self._del_endpoint(name))
 
-        sql = "UPDATE Profile SET endpoints = ? WHERE id = ?"
-        with self.db:
-            self.cursor.execute(sql, (endpoints_str, self.id,))
+    async def adel_endpoint(self, name):
+        """ Delete an endpoint off the event loop.
 
-        if self.logs:
-            print(f"Endpoint {name} for {self.name} deleted from {self.id}.")
+        See `Profile.del_endpoint` for arguments and `Profile.awrite`
+        for how the write is performed.
+        """
+        await self.awrite(self._del_endpoint(name))
 
     def add_target(self, endpoint, target):
         """ Add a data target.
@@ -225,21 +1357,15 @@ class Profile:
         :param endpoint: the name of the endpoint
         :param target: the name of the target field
         """
-        targets = (
-            self.endpoints[endpoint]['targets']
-            if 'targets' in self.endpoints[endpoint]
-            else [])
-
-        targets.append(target)
-        self.endpoints[endpoint]['targets'] = targets
-        endpoints_str = json.dumps(self.endpoints)
+        self._write(self._add_target(endpoint, target))
 
-        sql = "UPDATE Profile SET endpoints = ? WHERE id = ?"
-        with self.db:
-            self.cursor.execute(sql, (endpoints_str, self.id,))
+    async def aadd_target(self, endpoint, target):
+        """ Add a data target off the event loop.
 
-        if self.logs:
-            print(f"Target {target} for {endpoint} added on {self.id}.")
+        See `Profile.add_target` for arguments and `Profile.awrite`
+        for how the write is performed.
+        """
+        await self.awrite(self._add_target(endpoint, target))
 
     def del_target(self, endpoint, target):
         """ Delete a data target.
@@ -247,16 +1373,389 @@ class Profile:
         :param endpoint: the name of the endpoint
         :param target: the name of the target field
         """
+        self._write(self._del_target(endpoint, target))
+
+    async def adel_target(self, endpoint, target):
+        """ Delete a data target off the event loop.
+
+        See `Profile.del_target` for arguments and `Profile.awrite`
+        for how the write is performed.
+        """
+        await self.awrite(self._del_target(endpoint, target))
+
+    def add_limit(self, rate=None, endpoint=None, **kwargs):
+        """ Add a rate limit.
+
+        The limit applies to every call made through the profile, or
+        only to calls to `endpoint` if it is given; a call to an
+        endpoint with its own limit is paced by both. See
+        `limits.Limiter` for how limits are enforced.
+
+        Example:
+
+            >>> profile.add_limit(10, burst=20)
+            >>> profile.add_limit(1, endpoint='Search', concurrency=2)
+
+        :param rate: (optional) the sustained number of calls per second
+        :param endpoint: (optional) the name of the endpoint to limit
+        :param burst: (optional) the number of calls allowed at once
+                                 after an idle period
+        :param concurrency: (optional) the maximum number of calls in flight
+        :param retries: (optional) the number of times a call answered
+                                   with 429 or 503 is retried
+        """
+        self._write(self._add_limit(rate, endpoint, **kwargs))
+
+    async def aadd_limit(self, rate=None, endpoint=None, **kwargs):
+        """ Add a rate limit off the event loop.
+
+        See `Profile.add_limit` for arguments and `Profile.awrite`
+        for how the write is performed.
+        """
+        await self.awrite(self._add_limit(rate, endpoint, **kwargs))
+
+    def del_limit(self, endpoint=None):
+        """ Delete a rate limit.
+
+        :param endpoint: (optional) the name of the endpoint, if the
+                                    limit is an endpoint's
+        """
+        self._write(self._add_limit(None, endpoint))
+
+    async def adel_limit(self, endpoint=None):
+        """ Delete a rate limit off the event loop.
+
+        See `Profile.del_limit` for arguments and `Profile.awrite`
+        for how the write is performed.
+        """
+        await self.awrite(self._add_limit(None, endpoint))
+
+    def _add_auth(self, method, **kwargs):
+        auth = {'method': method}
+
+        for k, v in kwargs.items():
+            if k in (
+                    'name', 'value', 'username', 'password', 'token_url',
+                    'client_id', 'client_secret', 'scope', 'refresh_token',
+                    'leeway'):
+                auth[k] = v
+
+        self.auth = auth
+        self.oauth = None
+        self.caches.clear()
+        self.compiled.clear()
+
+        sql = "UPDATE Profile SET auth = ? WHERE id = ?"
+        return (
+            [(sql, (json.dumps(self.auth), self.id)), self._touch],
+            f"Authentication details for {self.name} added on {self.id}.",
+            (self.id, 'auth'))
+
+    def _add_limit(self, rate, endpoint=None, **kwargs):
+        limits = {'rate': rate} if rate else {}
+        for k, v in kwargs.items():
+            if k in ('burst', 'concurrency', 'retries'):
+                limits[k] = v
+
+        self.limiters.pop(endpoint, None)
+        if endpoint is None:
+            self.limits = limits
+            sql = "UPDATE Profile SET limits = ? WHERE id = ?"
+            return (
+                [(sql, (json.dumps(limits) if limits else None, self.id)),
+                 self._touch],
+                f"Rate limit for {self.name} set on {self.id}.",
+                (self.id, 'limits'))
+
+        options = self.endpoints[endpoint]
+        if limits:
+            options['limit'] = limits
+        else:
+            options.pop('limit', None)
+
+        sql = """
+            UPDATE      Endpoint
+            SET         options = ?
+            WHERE       profile = ? AND name = ?"""
+        return (
+            [(sql, (json.dumps(_options(options)), self.id, endpoint)),
+             self._touch],
+            f"Rate limit for {endpoint} set on {self.id}.",
+            None)
+
+    def _add_endpoint(self, name, path, method, **kwargs):
+        endpoint = {'path': path,
+                    'method': method}
+
+        for key in kwargs:
+            if key in (
+                'headers', 'params', 'data', 'body',
+                'auth', 'parse', 'targets', 'cache', 'stream',
+                'limit', 'retry', 'paginate', 'compress'):
+
+                endpoint[key] = kwargs[key]
+
+        self.endpoints[name] = endpoint
+        self.caches.pop(name, None)
+        self.compiled.pop(name, None)
+        self.limiters.pop(name, None)
+        self.policies.pop(name, None)
+
+        sql = """
+            INSERT OR REPLACE INTO Endpoint (
+                profile, name, path, method, options)
+            VALUES (?, ?, ?, ?, ?)"""
+        return (
+            [(sql, (
+                self.id, name, path, method,
+                json.dumps(_options(endpoint)))),
+             ("DELETE FROM Target WHERE profile = ? AND endpoint = ?",
+              (self.id, name)),
+             ("INSERT INTO Target (profile, endpoint, target) "
+              "VALUES (?, ?, ?)",
+              [(self.id, name, t) for t in endpoint.get('targets') or ()]),
+             self._touch],
+            f"Endpoint {name} for {self.name} added on {self.id}.",
+            None)
+
+    def _del_endpoint(self, name):
+        del self.endpoints[name]
+        self.endpoints.removed.discard(name)
+        self.caches.pop(name, None)
+        self.compiled.pop(name, None)
+        self.limiters.pop(name, None)
+        self.policies.pop(name, None)
+
+        return (
+            [("DELETE FROM Target WHERE profile = ? AND endpoint = ?",
+              (self.id, name)),
+             ("DELETE FROM Endpoint WHERE profile = ? AND name = ?",
+              (self.id, name)),
+             self._touch],
+            f"Endpoint {name} for {self.name} deleted from {self.id}.",
+            None)
+
+    def _add_target(self, endpoint, target):
+        options = self.endpoints[endpoint]
+        statements = []
+        if 'targets' not in options:
+            options['targets'] = []
+            sql = """
+                UPDATE      Endpoint
+                SET         options = ?
+                WHERE       profile = ? AND name = ?"""
+            statements.append(
+                (sql, (json.dumps(_options(options)), self.id, endpoint)))
+
+        options['targets'].append(target)
+        self.caches.pop(endpoint, None)
+        self.compiled.pop(endpoint, None)
+
+        statements += [
+            ("INSERT INTO Target (profile, endpoint, target) "
+             "VALUES (?, ?, ?)",
+             (self.id, endpoint, target)),
+            self._touch]
+        return (
+            statements,
+            f"Target {target} for {endpoint} added on {self.id}.",
+            None)
+
+    def _del_target(self, endpoint, target):
         targets = self.endpoints[endpoint]['targets']
         del targets[targets.index(target)]
 
-        self.endpoints[endpoint]['targets'] = targets
-        endpoints_str = json.dumps(self.endpoints)
+        self.caches.pop(endpoint, None)
+        self.compiled.pop(endpoint, None)
 
-        sql = "UPDATE Profile SET endpoints = ? WHERE id = ?"
-        with self.db:
-            self.cursor.execute(sql, (endpoints_str, self.id,))
+        sql = """
+            DELETE FROM Target
+            WHERE       rowid = (
+                SELECT      rowid
+                FROM        Target
+                WHERE       profile = ? AND endpoint = ? AND target = ?
+                ORDER BY    rowid
+                LIMIT       1)"""
+        return (
+            [(sql, (self.id, endpoint, target)), self._touch],
+            f"Target {target} for {endpoint} deleted from {self.id}.",
+            None)
 
-        if self.logs:
-            print(f"Target {target} for {endpoint} deleted from {self.id}.")
 
+class Endpoints(collections.abc.MutableMapping):
+    """ A lazily loaded mapping of a profile's endpoints.
+
+    Each endpoint is read from the database the first time it is
+    accessed, and endpoint names are only read when the mapping is
+    iterated. Assignment and deletion only affect the loaded state;
+    the Profile methods persist changes row by row, and
+    `Profile.update` persists any other change made to the loaded
+    endpoints, including deletions.
+
+    :param profile: the Profile the endpoints belong to
+    """
+    def __init__(self, profile):
+        self.profile = profile
+        self.loaded = {}
+        self.names = None
+        self.stored = {}
+        self.removed = set()
+
+    def __getitem__(self, name):
+        if name not in self.loaded:
+            self.loaded[name] = self._load(name)
+            self.stored[name] = json.dumps(self.loaded[name], sort_keys=True)
+
+        return self.loaded[name]
+
+    def __setitem__(self, name, endpoint):
+        if self.names is not None and name not in self:
+            self.names.append(name)
+
+        self.loaded[name] = endpoint
+        self.stored.pop(name, None)
+        self.removed.discard(name)
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+
+        self.loaded.pop(name, None)
+        self.stored.pop(name, None)
+        self.removed.add(name)
+        if self.names is not None:
+            self.names.remove(name)
+
+    def __contains__(self, name):
+        if name in self.loaded:
+            return True
+        elif self.names is not None:
+            return name in self.names
+
+        try:
+            self[name]
+        except KeyError:
+            return False
+
+        return True
+
+    def __iter__(self):
+        if self.names is None:
+            sql = "SELECT name FROM Endpoint WHERE profile = ? ORDER BY rowid"
+            self.names = [
+                r[0] for r in self.profile.db.execute(sql, (self.profile.id,))]
+
+        return iter(list(self.names))
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def changes(self):
+        """ Get the names deleted, and the loaded endpoints changed,
+        since they were read or last returned here, and mark them as
+        stored. """
+        removed, self.removed = self.removed, set()
+
+        changed = []
+        for name, endpoint in self.loaded.items():
+            snapshot = json.dumps(endpoint, sort_keys=True)
+            if self.stored.get(name) != snapshot:
+                self.stored[name] = snapshot
+                changed.append((name, endpoint))
+
+        return removed, changed
+
+    def _load(self, name):
+        """ Read an endpoint and its targets from the database. """
+        sql = """
+            SELECT      path, method, options
+            FROM        Endpoint
+            WHERE       profile = ? AND name = ?"""
+        record = self.profile.db.execute(
+            sql, (self.profile.id, name)).fetchone()
+        if not record:
+            raise KeyError(name)
+
+        endpoint = {'path': record[0], 'method': record[1]}
+        endpoint.update(json.loads(record[2]) if record[2] else {})
+        if 'targets' in endpoint:
+            sql = """
+                SELECT      target
+                FROM        Target
+                WHERE       profile = ? AND endpoint = ?
+                ORDER BY    rowid"""
+            endpoint['targets'] = [
+                r[0] for r in self.profile.db.execute(
+                    sql, (self.profile.id, name))]
+
+        return endpoint
+
+
+async def _keep(session):
+    """ Wait until cancelled, then close a session. """
+    try:
+        await asyncio.get_running_loop().create_future()
+    finally:
+        await session.close()
+
+
+def _digest(path, chunk_size):
+    """ Get a SHA-256 hash object fed with a file's contents. """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest
+
+
+def _range_start(response):
+    """ Get the first byte position of a `206` response's
+    `Content-Range`, if any. """
+    value = response.headers.get('Content-Range', '')
+    unit, _, spec = value.partition(' ')
+    if unit.strip() != 'bytes':
+        return None
+
+    try:
+        return int(spec.split('-', 1)[0])
+    except ValueError:
+        return None
+
+
+def _following(response, params):
+    """ Get the URL and query parameters of the page linked as
+    `rel="next"` by a response, if any.
+
+    Parameters already present in the link's query are dropped, so
+    they are not sent twice.
+    """
+    link = response.links.get('next')
+    if not link:
+        return None
+
+    url = link['url']
+    if not url.is_absolute():
+        url = response.url.join(url)
+
+    return str(url), {
+        k: v for k, v in params.items() if k not in url.query}
+
+
+def _options(endpoint):
+    """ Get the options column of an endpoint's database row.
+
+    Targets are stored in their own table, so only their presence
+    is recorded in the options.
+    """
+    options = {
+        k: v for k, v in endpoint.items() if k not in ('path', 'method')}
+    if options.get('targets') is not None:
+        options['targets'] = []
+    else:
+        options.pop('targets', None)
+
+    return options
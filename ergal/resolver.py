@@ -0,0 +1,121 @@
+"""
+ergal.resolver
+~~~~~~~~~~~~~~
+
+This module implements the shared DNS cache used by the
+Profile interface's connection pools.
+
+:author: Elliott Maguire
+:copyright: (c) 2019 by Elliott Maguire
+"""
+
+import time
+import socket
+import asyncio
+import threading
+import collections
+
+import aiohttp
+import aiohttp.abc
+
+
+class DNSCache:
+    """ A process-wide, bounded cache of DNS lookups.
+
+    Entries are shared by every session (and so every profile and
+    event loop) in the process, and expire after the TTL they were
+    stored with.
+
+    :param size: (optional) the maximum number of cached lookups
+    """
+    def __init__(self, size=1024):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Get the unexpired addresses of a lookup, or None.
+
+        :param key: a (host, port, family) tuple
+        """
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, hosts, ttl):
+        """ Store the addresses of a lookup.
+
+        :param key: a (host, port, family) tuple
+        :param hosts: the resolved addresses
+        :param ttl: the number of seconds the addresses are kept
+        """
+        with self._lock:
+            self.entries[key] = (time.monotonic() + ttl, hosts)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """ Drop every entry. """
+        with self._lock:
+            self.entries.clear()
+
+
+CACHE = DNSCache()
+
+
+class Resolver(aiohttp.abc.AbstractResolver):
+    """ An aiohttp resolver backed by a shared DNSCache.
+
+    Lookups missing from the cache are made with aiohttp's default
+    resolver, and concurrent lookups of the same host share one.
+
+    :param ttl: (optional) the number of seconds a lookup is cached
+    :param cache: (optional) the DNSCache, which defaults to the
+                             process-wide `CACHE`
+    """
+    def __init__(self, ttl=60.0, cache=None):
+        self.ttl = ttl
+        self.cache = cache if cache is not None else CACHE
+
+        self.lookups = 0
+
+        self._resolver = None
+        self._flights = {}
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        key = (host, port, family)
+        hosts = self.cache.get(key)
+        if hosts is not None:
+            return list(hosts)
+
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = asyncio.ensure_future(
+                self._lookup(key))
+            flight.add_done_callback(lambda _: self._flights.pop(key, None))
+
+        return list(await asyncio.shield(flight))
+
+    async def _lookup(self, key):
+        if self._resolver is None:
+            self._resolver = aiohttp.DefaultResolver()
+
+        self.lookups += 1
+        hosts = await self._resolver.resolve(*key)
+        self.cache.put(key, hosts, self.ttl)
+
+        return hosts
+
+    async def close(self):
+        if self._resolver is not None:
+            await self._resolver.close()
@@ -0,0 +1,102 @@
+"""
+ergal.retry
+~~~~~~~~~~~
+
+This module implements the retry and hedging policy used by
+the Profile interface.
+
+:author: Elliott Maguire
+:copyright: (c) 2019 by Elliott Maguire
+"""
+
+import random
+import collections
+
+
+IDEMPOTENT = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE')
+
+
+class Policy:
+    """ A retry and hedging policy for a single endpoint.
+
+    Failed attempts (connection errors, timeouts and responses with
+    one of `statuses`) are retried after a delay drawn uniformly
+    between zero and `backoff * 2 ** attempt`, capped at `cap`
+    seconds ("full jitter").
+
+    Retries and hedges are paid for from a budget: every call adds
+    `budget` tokens to it, up to `reserve`, and every retry or hedge
+    takes a whole token, so they stay a bounded fraction of the
+    traffic when the server is failing.
+
+    If `hedge` is given, a second request is sent when the first has
+    been in flight for longer than that percentile of the endpoint's
+    recent latencies, and whichever answers first is used.
+
+    :param retries: (optional) the maximum number of retries per call
+    :param backoff: (optional) the base delay between retries, in seconds
+    :param cap: (optional) the maximum delay between retries, in seconds
+    :param methods: (optional) the HTTP methods that may be retried
+                               or hedged
+    :param statuses: (optional) the response statuses that are retried
+    :param budget: (optional) the retry tokens earned per call
+    :param reserve: (optional) the maximum number of retry tokens held
+    :param hedge: (optional) the latency percentile after which a
+                             hedged request is sent
+    :param window: (optional) the number of recent latencies kept
+    """
+    def __init__(
+            self, retries=2, backoff=0.1, cap=10.0, methods=IDEMPOTENT,
+            statuses=(502, 503, 504), budget=0.2, reserve=10,
+            hedge=None, window=100):
+        self.retries = retries
+        self.backoff = backoff
+        self.cap = cap
+        self.methods = frozenset(m.upper() for m in methods)
+        self.statuses = frozenset(statuses)
+        self.budget = budget
+        self.reserve = reserve
+        self.hedge = hedge
+
+        self.tokens = float(reserve)
+        self.latencies = collections.deque(maxlen=window)
+
+    def delay(self, attempt):
+        """ Get the delay before a retry.
+
+        :param attempt: the number of retries made so far
+        """
+        return random.uniform(0, min(self.cap, self.backoff * 2 ** attempt))
+
+    def deposit(self):
+        """ Earn retry tokens for a call. """
+        self.tokens = min(float(self.reserve), self.tokens + self.budget)
+
+    def withdraw(self):
+        """ Spend a retry token, returning whether one was available. """
+        if self.tokens < 1:
+            return False
+
+        self.tokens -= 1
+        return True
+
+    def observe(self, seconds):
+        """ Record the latency of an attempt.
+
+        :param seconds: the attempt's duration
+        """
+        self.latencies.append(seconds)
+
+    def threshold(self):
+        """ Get the latency after which a hedged request is sent.
+
+        Returns None if hedging is disabled or too few latencies have
+        been recorded yet.
+        """
+        if self.hedge is None or len(self.latencies) < 10:
+            return None
+
+        latencies = sorted(self.latencies)
+        index = int(len(latencies) * self.hedge / 100)
+
+        return latencies[min(index, len(latencies) - 1)]
@@ -0,0 +1,485 @@
+"""
+ergal.stream
+~~~~~~~~~~~~
+
+This module implements the incremental JSON and XML parsers used
+to extract data targets from response bodies as they arrive.
+
+Both parsers are fed the body in chunks and only materialize the
+values matched by the targets, so their memory use is bounded by
+the size of the targets rather than the size of the document. The
+values they produce match those of `utils.extract` run on the fully
+decoded document, including xmltodict's grouping of repeated XML
+elements.
+
+:author: Elliott Maguire
+:copyright: (c) 2019 by Elliott Maguire
+"""
+
+import re
+import json
+from xml.parsers import expat
+
+
+def _child(node, key):
+    """ Get the trie entry of a key, matching list indexes as
+    either ints or strs. """
+    if not node:
+        return None
+
+    child = node.get(key)
+    if child is None and type(key) is int:
+        child = node.get(str(key))
+
+    return child
+
+
+class JSONStream:
+    """ An incremental JSON target extractor.
+
+    :param targets: a utils.Targets object
+    """
+    WHITESPACE = re.compile(rb'[ \t\n\r]*')
+    CHARACTERS = re.compile(rb'[^"\\]*(?:\\.[^"\\]*)*', re.S)
+    TOKEN = re.compile(rb'[^ \t\n\r,:\]}]+')
+    SCALAR = re.compile(
+        rb'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?'
+        rb'|true|false|null')
+
+    def __init__(self, targets):
+        self.targets = targets
+        self.found = {}
+        self.claimed = set()
+        self.remaining = len(targets)
+
+        self.buffer = bytearray()
+        self.offset = 0
+        self.pos = 0
+
+        # frames: [is_object, trie node, key, expecting_key, captures]
+        self.stack = []
+        self.captures = 0
+
+        # the string being scanned: [start, is_key, targets]
+        self.string = None
+
+    @property
+    def done(self):
+        return not (
+            self.remaining or self.captures
+            or (self.string and (self.string[1] or self.string[2])))
+
+    def feed(self, chunk):
+        """ Feed a chunk of the document.
+
+        :param chunk: a bytes-like object
+        """
+        self.buffer += chunk
+        self._run(final=False)
+
+    def close(self):
+        """ Finish parsing and return the extracted targets. """
+        self._run(final=True)
+        if not self.done and self.stack:
+            raise ValueError('stream: incomplete JSON document')
+
+        return {
+            name: self.found[name]
+            for name in self.targets.names if name in self.found}
+
+    def _enter(self, start):
+        """ Claim the targets matched by the value starting at `start`.
+
+        Returns the claimed targets and the trie node below the value.
+        """
+        if not self.stack:
+            root = [self.targets.root] if self.targets.root else []
+            if self.buffer[start - self.offset] == ord('['):
+                targets, node = self._match('data', self.targets.trie)
+                return root + targets, node
+            return root, self.targets.trie
+
+        frame = self.stack[-1]
+        return self._match(frame[2], frame[1])
+
+    def _match(self, key, node):
+        matched = []
+
+        target = self.targets.keys.get(key) if type(key) is str else None
+        if target is not None and target not in self.claimed:
+            matched.append(target)
+
+        child = _child(node, key)
+        if child is not None:
+            if child[0] is not None and child[0] not in self.claimed:
+                matched.append(child[0])
+            child = child[1]
+
+        for target in matched:
+            self.claimed.add(target)
+            self.remaining -= 1
+
+        return matched, child
+
+    def _store(self, targets, value):
+        for target in targets:
+            if target == self.targets.root and type(value) is list:
+                self.found[target] = {'data': value}
+            else:
+                self.found[target] = value
+
+    def _run(self, final):
+        """ Parse as much of the buffer as possible.
+
+        A string that is cut off by the end of the buffer is resumed
+        from where its scan stopped, rather than rescanned, and only
+        kept in the buffer if it is a key or a matched value.
+        """
+        buffer = self.buffer
+        pos = self.pos - self.offset
+
+        while not self.done:
+            frame = self.stack[-1] if self.stack else None
+
+            if self.string is None:
+                pos = self.WHITESPACE.match(buffer, pos).end()
+                if pos >= len(buffer):
+                    break
+
+                c = buffer[pos]
+                if c == 0x22:  # "
+                    key = frame is not None and frame[0] and frame[3]
+                    targets = (
+                        None if key else self._enter(self.offset + pos)[0])
+                    self.string = [self.offset + pos, key, targets]
+                    pos += 1
+                elif c == 0x7b or c == 0x5b:  # { [
+                    targets, node = self._enter(self.offset + pos)
+                    self.stack.append([
+                        c == 0x7b, node, None if c == 0x7b else 0,
+                        c == 0x7b,
+                        (targets, self.offset + pos) if targets else None])
+                    if targets:
+                        self.captures += 1
+                    pos += 1
+                    continue
+                elif c == 0x7d or c == 0x5d:  # } ]
+                    if not self.stack:
+                        raise ValueError('stream: invalid JSON document')
+
+                    frame = self.stack.pop()
+                    pos += 1
+                    if frame[4]:
+                        targets, start = frame[4]
+                        self._store(targets, json.loads(
+                            buffer[start - self.offset:pos]))
+                        self.captures -= 1
+                    continue
+                elif c == 0x2c:  # ,
+                    if frame is None:
+                        raise ValueError('stream: invalid JSON document')
+                    elif frame[0]:
+                        frame[3] = True
+                    else:
+                        frame[2] += 1
+                    pos += 1
+                    continue
+                elif c == 0x3a:  # :
+                    pos += 1
+                    continue
+                else:
+                    match = self.TOKEN.match(buffer, pos)
+                    if match is None and final:
+                        raise ValueError('stream: invalid JSON document')
+                    elif match is None or (
+                            match.end() == len(buffer) and not final):
+                        break
+                    elif not self.SCALAR.fullmatch(match.group()):
+                        raise ValueError('stream: invalid JSON document')
+
+                    pos = match.end()
+                    targets, _ = self._enter(self.offset + match.start())
+                    if targets:
+                        self._store(targets, json.loads(match.group()))
+                    continue
+
+            # The scan stops at the closing quote, or before an escape
+            # cut off by the end of the buffer, where it resumes.
+            pos = self.CHARACTERS.match(buffer, pos).end()
+            if pos >= len(buffer) or buffer[pos] != 0x22:
+                if final:
+                    raise ValueError('stream: invalid JSON document')
+                break
+
+            pos += 1
+            start, key, targets = self.string
+            self.string = None
+            if key:
+                frame[2] = json.loads(buffer[start - self.offset:pos])
+                frame[3] = False
+            elif targets:
+                self._store(
+                    targets, json.loads(buffer[start - self.offset:pos]))
+
+        keep = pos
+        if self.string and (self.string[1] or self.string[2]):
+            keep = min(keep, self.string[0] - self.offset)
+        for frame in self.stack:
+            if frame[4]:
+                keep = min(keep, frame[4][1] - self.offset)
+                break
+
+        del buffer[:keep]
+        self.offset += keep
+        self.pos = self.offset + (pos - keep)
+
+
+class XMLStream:
+    """ An incremental XML target extractor.
+
+    Values are built the way `xmltodict.parse` builds them: attributes
+    are prefixed with `@`, text is stored under `#text` alongside
+    attributes or children, and repeated sibling elements are
+    collected into a list, placed under the first of them.
+
+    A later sibling can turn an element's value into a list, or move
+    a match ahead in document order, so matches are only settled once
+    their parent element closes; unlike `JSONStream`, the document
+    is always read to the end of its root element.
+
+    :param targets: a utils.Targets object
+    """
+    def __init__(self, targets):
+        self.targets = targets
+        self.found = None
+        self.cdata = '#text' in targets.keys
+
+        self.parser = expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self._start
+        self.parser.EndElementHandler = self._end
+        self.parser.CharacterDataHandler = self._data
+        self.parser.EntityDeclHandler = _forbid_entities
+
+        self.top = _Element(
+            None, {}, [targets.trie] if targets.trie else [],
+            targets.root is not None, None)
+        self.stack = [self.top]
+
+    @property
+    def done(self):
+        return self.found is not None or not len(self.targets)
+
+    def feed(self, chunk):
+        """ Feed a chunk of the document.
+
+        :param chunk: a bytes-like object
+        """
+        self.parser.Parse(bytes(chunk), False)
+
+    def close(self):
+        """ Finish parsing and return the extracted targets. """
+        if not self.done:
+            self.parser.Parse(b'', True)
+
+        found = self.found or {}
+        return {
+            name: found[name]
+            for name in self.targets.names if name in found}
+
+    def _start(self, tag, attrs):
+        parent = self.stack[-1]
+        group = parent.groups.get(tag)
+        if group is None:
+            group = parent.groups[tag] = _Group()
+        index = group.count
+        group.count += 1
+
+        # The element's value is addressed as `tag` while it has no
+        # siblings of the same name, and as `tag[index]` otherwise.
+        build = parent.build or tag in self.targets.keys
+        nodes = []
+        for node in parent.nodes:
+            child = node.get(tag)
+            if child is None:
+                continue
+            elif child[0] is not None:
+                build = True
+
+            item = _child(child[1], index)
+            if item is not None:
+                if item[0] is not None:
+                    build = True
+                if item[1]:
+                    _add(nodes, item[1])
+            if child[1] and not index:
+                _add(nodes, child[1])
+
+        text = build or self.cdata or any('#text' in n for n in nodes)
+        if attrs:
+            attrs = {'@' + k: v for k, v in attrs.items()}
+
+        self.stack.append(_Element(
+            tag, attrs, nodes, build, [] if text else None))
+
+    def _data(self, data):
+        element = self.stack[-1]
+        if element.text is not None:
+            element.text.append(data)
+
+    def _end(self, tag):
+        element = self.stack.pop()
+        parent = self.stack[-1]
+        group = parent.groups[tag]
+        index = group.count - 1
+
+        self._settle(element)
+        if element.bare:
+            for k, v in element.bare.items():
+                group.bare.setdefault(k, v)
+        if element.build or element.paths:
+            group.members.append((index, element))
+
+        if parent is self.top:
+            self._settle(self.top)
+            self.found = {**self.top.bare}
+            self.found.update(self.top.paths.get(id(self.targets.trie), ()))
+            if self.targets.root is not None:
+                self.found[self.targets.root] = self.top.value
+
+    def _settle(self, element):
+        """ Build a closed element's value, if it is needed, and the
+        matches found within it, the way `utils.extract` finds them
+        in the value. """
+        keys = self.targets.keys
+        text = element.text and ''.join(element.text).strip() or None
+        attrs, groups = element.attrs, element.groups
+        nested = bool(attrs or groups)
+
+        element.attrs = element.groups = element.text = None
+        if not nested:
+            element.value = text
+            element.bare = element.paths = _EMPTY
+            return
+
+        if element.build:
+            element.value = dict(attrs)
+            for tag, group in groups.items():
+                element.value[tag] = group.value()
+            if text:
+                element.value['#text'] = text
+
+        bare = {}
+        if keys:
+            for k, v in attrs.items():
+                if k in keys:
+                    bare.setdefault(k, v)
+            for tag, group in groups.items():
+                if tag in keys:
+                    bare.setdefault(tag, group.value())
+                for k, v in group.bare.items():
+                    bare.setdefault(k, v)
+            if text and '#text' in keys:
+                bare.setdefault('#text', text)
+
+        paths = {}
+        for node in element.nodes:
+            found = {}
+            for k, v in attrs.items():
+                child = node.get(k)
+                if child is not None and child[0] is not None:
+                    found[child[0]] = v
+
+            for tag, group in groups.items():
+                child = node.get(tag)
+                if child is None:
+                    continue
+                elif child[0] is not None:
+                    found[child[0]] = group.value()
+
+                if not child[1]:
+                    continue
+                elif group.count == 1:
+                    for _, member in group.members:
+                        found.update(member.paths.get(id(child[1]), ()))
+                    continue
+
+                for index, member in group.members:
+                    item = _child(child[1], index)
+                    if item is None:
+                        continue
+                    elif item[0] is not None:
+                        found[item[0]] = member.value
+                    if item[1]:
+                        found.update(member.paths.get(id(item[1]), ()))
+
+            child = node.get('#text') if text else None
+            if child is not None and child[0] is not None:
+                found[child[0]] = text
+
+            if found:
+                paths[id(node)] = found
+
+        element.bare = bare
+        element.paths = paths
+
+
+class _Element:
+    """ The parse state of an XML element.
+
+    `nodes` are the trie nodes the element's value may be addressed
+    by, which depend on whether it ends up with same-named siblings.
+    Once the element closes, `value`, `bare` and `paths` hold its
+    value (if any target needs it) and the targets matched within
+    it, by bare key and by trie node.
+    """
+    __slots__ = (
+        'tag', 'attrs', 'nodes', 'build', 'text', 'groups',
+        'value', 'bare', 'paths')
+
+    def __init__(self, tag, attrs, nodes, build, text):
+        self.tag = tag
+        self.attrs = attrs
+        self.nodes = nodes
+        self.build = build
+        self.text = text
+        self.groups = {}
+        self.value = None
+        self.bare = None
+        self.paths = None
+
+
+class _Group:
+    """ The closed children of an element sharing a tag.
+
+    Only the children holding a needed value or a path match are
+    kept, along with their index; the bare key matches of all of
+    them are merged in document order.
+    """
+    __slots__ = ('count', 'members', 'bare')
+
+    def __init__(self):
+        self.count = 0
+        self.members = []
+        self.bare = {}
+
+    def value(self):
+        """ Get the group's value, as `xmltodict` stores it. """
+        if self.count == 1:
+            return self.members[0][1].value
+
+        return [member.value for _, member in self.members]
+
+
+_EMPTY = {}
+
+
+def _add(nodes, node):
+    """ Add a trie node to a list, unless it is already in it. """
+    if not any(n is node for n in nodes):
+        nodes.append(node)
+
+
+def _forbid_entities(*args):
+    """ Reject entity declarations, as `xmltodict.parse` does. """
+    raise ValueError("entities are disabled")
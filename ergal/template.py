@@ -0,0 +1,157 @@
+"""
+ergal.template
+~~~~~~~~~~~~~~
+
+This module implements the compiled request templates used by
+the Profile interface.
+
+:author: Elliott Maguire
+:copyright: (c) 2019 by Elliott Maguire
+"""
+
+import gzip
+import base64
+import string
+
+from . import utils
+
+import aiohttp
+
+
+class Template:
+    """ A compiled endpoint.
+
+    Everything about a request that does not change between calls
+    is worked out once: the URL template and whether it has any
+    path variables, the endpoint's static headers, params and body
+    merged with the profile's authentication details, and the
+    compiled data targets. Building a request then only merges in
+    the call's own arguments. `oauth2` bearer tokens change over
+    time, so they are added to each request by the profile instead.
+
+    The static `headers` and `params` dicts are shared by every
+    request built without call-specific ones, and must not be
+    modified.
+
+    An endpoint's `compress` option, either True or a dict, sets
+    the `Accept-Encoding` header from its `accept` list of codings
+    (by default, every coding that can be decoded), and gzips
+    request bodies of at least `threshold` bytes at `level`.
+
+    :param base: the base URL of the API
+    :param endpoint: the endpoint's dict of options
+    :param auth: the profile's authentication details
+    """
+    __slots__ = (
+        'method', 'url', 'fields', 'headers', 'params', 'data',
+        'middlewares', 'parse', 'stream', 'targets',
+        'threshold', 'level', 'oauth')
+
+    def __init__(self, base, endpoint, auth):
+        self.method = endpoint['method'].upper()
+        self.url = base + endpoint['path']
+        self.fields = any(
+            field is not None
+            for _, field, _, _ in string.Formatter().parse(self.url))
+
+        self.headers = dict(endpoint.get('headers') or {})
+        self.params = dict(endpoint.get('params') or {})
+        self.data = endpoint.get('data', endpoint.get('body'))
+        self.middlewares = None
+        self.oauth = False
+
+        method = auth.get('method') if endpoint.get('auth') else None
+        if method == 'headers':
+            self.headers[auth['name']] = auth['value']
+        elif method == 'params':
+            self.params[auth['name']] = auth['value']
+        elif method == 'basic':
+            self.headers['Authorization'] = _basic(
+                (auth['username'], auth['password']))
+        elif method == 'digest':
+            self.middlewares = (aiohttp.DigestAuthMiddleware(
+                auth['username'], auth['password']),)
+        elif method == 'oauth2':
+            self.oauth = True
+
+        compress = endpoint.get('compress')
+        compress = compress if type(compress) is dict else (
+            {} if compress else None)
+        self.threshold = self.level = None
+        if compress is not None:
+            available = utils.get_encodings()
+            accept = [
+                e for e in compress.get('accept', available)
+                if e in available]
+            if accept and not any(
+                    k.lower() == 'accept-encoding' for k in self.headers):
+                self.headers['Accept-Encoding'] = ', '.join(accept)
+
+            self.threshold = compress.get('threshold')
+            self.level = compress.get('level', 6)
+
+        self.parse = bool(endpoint.get('parse'))
+        targets = endpoint.get('targets') if self.parse else None
+        self.targets = (
+            utils.Targets(targets) if targets is not None else None)
+        self.stream = self.targets is not None and bool(endpoint.get('stream'))
+
+    def build(self, kwargs):
+        """ Build the URL and request keyword arguments of a call.
+
+        :param kwargs: the call's keyword arguments
+        """
+        url = self.url
+        if self.fields and 'pathvars' in kwargs:
+            url = url.format(**kwargs['pathvars'])
+
+        request = {}
+
+        headers = kwargs.get('headers')
+        if headers:
+            request['headers'] = {**self.headers, **headers}
+        elif self.headers:
+            request['headers'] = self.headers
+
+        params = kwargs.get('params')
+        if params:
+            request['params'] = {**self.params, **params}
+        elif self.params:
+            request['params'] = self.params
+
+        data = kwargs.get('data', kwargs.get('body', self.data))
+        if (self.threshold is not None and type(data) in (str, bytes)
+                and len(data) >= self.threshold):
+            if type(data) is str:
+                data = data.encode()
+            data = gzip.compress(data, compresslevel=self.level)
+            request['headers'] = {
+                **request.get('headers', {}), 'Content-Encoding': 'gzip'}
+        if data is not None:
+            request['data'] = data
+
+        auth = kwargs.get('auth')
+        if auth is not None:
+            request['headers'] = {
+                **request.get('headers', {}), 'Authorization': _basic(auth)}
+        if self.middlewares is not None:
+            request['middlewares'] = self.middlewares
+
+        return url, request
+
+
+def _basic(auth):
+    """ Encode basic authentication credentials as an `Authorization`
+    header value, the way `aiohttp.BasicAuth` encodes them.
+
+    :param auth: a (login, password[, encoding]) tuple, or an object
+                 with an `encode` method such as `aiohttp.BasicAuth`
+    """
+    if type(auth) is not tuple:
+        return auth.encode()
+
+    login, password, *encoding = auth
+    encoding = encoding[0] if encoding else 'latin1'
+    credentials = f"{login}:{password}".encode(encoding)
+
+    return 'Basic ' + base64.b64encode(credentials).decode(encoding)
@@ -9,67 +9,644 @@ Profile interface.
 :copyright: (c) 2019 by Elliott Maguire
 """
 
+import os
+import re
 import json
-import types
+import mmap
+import atexit
 import sqlite3
+import asyncio
+import threading
+import concurrent.futures
 
+import aiohttp
+import aiohttp.compression_utils
 import xmltodict
 
+from .stream import JSONStream, XMLStream
+from .resolver import Resolver
+
+try:
+    import orjson as _json
+except ImportError:
+    try:
+        import ujson as _json
+    except ImportError:
+        _json = json
+
+
+def loads(body):
+    """ Deserialize a JSON document.
+
+    The fastest available backend is used: orjson, then ujson, then
+    the standard library's json module. Documents the backend rejects
+    (such as ones holding `NaN` or `Infinity`) are retried with the
+    json module, so anything it accepts is decoded, and invalid input
+    always raises a ValueError. orjson decodes integers that do not
+    fit in 64 bits as floats.
+
+    :param body: a str or bytes-like object
+    """
+    if _json is not json:
+        try:
+            return _json.loads(body)
+        except ValueError:
+            pass
+
+    if type(body) is memoryview:
+        body = body.tobytes()
+
+    return json.loads(body)
+
+
+DATABASE = os.environ.get('ERGAL_DB', 'ergal.db')
+
+OFFLOAD_SIZE = 1 << 20
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+class Database:
+    """ Manages connections to a single SQLite database file.
+
+    The schema is created (and migrated) once per file, and every
+    thread is handed its own connection, opened in WAL mode so that
+    readers never block the writer.
+
+    :param path: the path of the database file
+    """
+    def __init__(self, path):
+        self.path = path
+        self.ready = False
+        self.changes = 0
+        self.connections = []
+
+        self.pending = []
+        self.writer = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='ergal-writer')
+        self._scheduled = False
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """ Get/create the current thread's connection. """
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            try:
+                # raises if the connection has been closed
+                db.total_changes  # pylint: disable=pointless-statement
+                return db
+            except sqlite3.ProgrammingError:
+                pass
+
+        db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA synchronous = NORMAL")
+        db.execute("PRAGMA cache_size = -8192")
+        db.execute("PRAGMA temp_store = MEMORY")
+
+        with self._lock:
+            if not self.ready:
+                create(db)
+                self.ready = True
+            self.connections.append(db)
+
+        self._local.db = db
+        return db
+
+    def submit(self, statements, key=None):
+        """ Queue statements for the writer thread.
+
+        Statements queued before the writer picks them up are run in
+        one transaction, in order. If `key` matches a queued, unwritten
+        change, that change is dropped and these statements are queued
+        last in its place, so they still run after every change made
+        before them. Returns a concurrent.futures.Future resolved once the
+        transaction is committed.
+
+        :param statements: a list of statements (see `execute`)
+        :param key: (optional) a key identifying the state written
+        """
+        future = concurrent.futures.Future()
+        with self._lock:
+            futures = [future]
+            for change in self.pending:
+                if key is not None and change[0] == key:
+                    self.pending.remove(change)
+                    futures = change[2] + futures
+                    break
+
+            self.pending.append([key, statements, futures])
+
+            if not self._scheduled:
+                self._scheduled = True
+                self.writer.submit(self._flush)
+
+        return future
+
+    def _flush(self):
+        """ Write every queued change in a single transaction. """
+        with self._lock:
+            changes, self.pending = self.pending, []
+            self._scheduled = False
+
+        futures = [f for change in changes for f in change[2]]
+        try:
+            db = self.connect()
+            db.execute("PRAGMA synchronous = FULL")
+            with db:
+                for change in changes:
+                    execute(db, change[1])
+        except BaseException as e:
+            for future in futures:
+                future.set_exception(e)
+        else:
+            for future in futures:
+                future.set_result(None)
+
+    def close(self):
+        """ Close every connection handed out for the file. """
+        with self._lock:
+            for db in self.connections:
+                db.close()
+
+            self.connections = []
+            self.ready = False
 
-def get_db(test=False):
-    """ Get/create a database connection.
 
-    If a local ergal.db file exists, a connection
-    is established and returned, otherwise a new
-    database is created and the connection is returned.
+_executors = {}
+_executors_lock = threading.Lock()
 
+
+def get_executor(workers=4, processes=False):
+    """ Get a shared parse worker pool.
+
+    Pools are shared process-wide, one per size and kind. Thread
+    pools keep the event loop responsive while a large body is
+    parsed; process pools also parse several bodies in parallel,
+    at the cost of copying each body to a worker process.
+
+    :param workers: (optional) the number of workers in the pool
+    :param processes: (optional) specifies whether or not the pool
+                                 runs its workers in processes.
+    """
+    key = (workers, processes)
+
+    with _executors_lock:
+        if key not in _executors:
+            if processes:
+                _executors[key] = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=workers)
+            else:
+                _executors[key] = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=workers, thread_name_prefix='ergal-parse')
+
+        return _executors[key]
+
+
+@atexit.register
+def _shutdown():
+    """ Shut the shared parse worker pools down on exit. """
+    with _executors_lock:
+        executors = list(_executors.values())
+        _executors.clear()
+
+    for executor in executors:
+        executor.shutdown()
+
+
+def get_db(path=None, test=False):
+    """ Get the connection manager of a database file.
+
+    Managers are shared process-wide, one per file. The file is
+    `path` if given, otherwise `ergal_test.db` for test instances
+    and `DATABASE` (`ergal.db`, or the `ERGAL_DB` environment
+    variable) for everything else.
+
+    :param path: (optional) the path of the database file
     :param test: (optional) determines whether or not a test database
-                            should be created.
+                            should be used.
     """
-    file = 'ergal_test.db' if test else 'ergal.db'
-    db = sqlite3.connect(file)
-    cursor = db.cursor()
+    path = path or ('ergal_test.db' if test else DATABASE)
+    key = os.path.abspath(path)
 
-    db.execute("""
-        CREATE TABLE IF NOT EXISTS Profile (
-            id          TEXT    NOT NULL,
-            name        TEXT    NOT NULL,
-            base        TEXT    NOT NULL,
-            auth        TEXT,
-            endpoints   TEXT,
+    with _databases_lock:
+        if key not in _databases:
+            _databases[key] = Database(path)
 
-            PRIMARY KEY(id))""")
+        return _databases[key]
 
-    return db, cursor
 
+def execute(db, statements):
+    """ Run a list of statements on a connection.
 
-async def parse(response, targets=None):
-    """ Parse response data.
+    Each statement is either an (sql, params) pair, executed once
+    (or once per item if params is a list), or a callable that is
+    passed the connection.
+
+    :param db: a database connection
+    :param statements: a list of statements
+    """
+    for statement in statements:
+        if callable(statement):
+            statement(db)
+        elif type(statement[1]) is list:
+            db.executemany(*statement)
+        else:
+            db.execute(*statement)
+
+
+def create(db):
+    """ Create the database schema and migrate any legacy data.
+
+    :param db: a database connection
+    """
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS Profile (
+                id          TEXT    NOT NULL,
+                name        TEXT    NOT NULL,
+                base        TEXT    NOT NULL,
+                auth        TEXT,
+                version     INTEGER NOT NULL DEFAULT 0,
+                limits      TEXT,
+
+                PRIMARY KEY(id))""")
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS Endpoint (
+                profile     TEXT    NOT NULL,
+                name        TEXT    NOT NULL,
+                path        TEXT    NOT NULL,
+                method      TEXT    NOT NULL,
+                options     TEXT,
+
+                PRIMARY KEY(profile, name))""")
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS Target (
+                profile     TEXT    NOT NULL,
+                endpoint    TEXT    NOT NULL,
+                target      TEXT    NOT NULL)""")
+        db.execute("""
+            CREATE INDEX IF NOT EXISTS TargetEndpoint
+            ON Target (profile, endpoint)""")
+
+        migrate(db)
+    except BaseException:
+        db.rollback()
+        raise
+
+    db.commit()
+
+
+def migrate(db):
+    """ Bring a database created by an earlier version up to date.
+
+    Profiles gain version and limits columns, and endpoints stored
+    as a JSON blob on the Profile table are moved into the Endpoint
+    and Target tables.
+
+    :param db: a database connection
+    """
+    columns = [r[1] for r in db.execute("PRAGMA table_info(Profile)")]
+    if 'version' not in columns:
+        db.execute("""
+            ALTER TABLE Profile
+            ADD COLUMN  version INTEGER NOT NULL DEFAULT 0""")
+    if 'limits' not in columns:
+        db.execute("ALTER TABLE Profile ADD COLUMN limits TEXT")
+    if 'endpoints' not in columns:
+        return
+
+    records = db.execute("""
+        SELECT      id, endpoints
+        FROM        Profile
+        WHERE       endpoints IS NOT NULL""").fetchall()
+
+    for profile, endpoints in records:
+        for name, endpoint in json.loads(endpoints or '{}').items():
+            options = {
+                k: v for k, v in endpoint.items()
+                if k not in ('path', 'method')}
+            targets = options.get('targets')
+            if targets is not None:
+                options['targets'] = []
+
+            db.execute("""
+                INSERT OR REPLACE INTO Endpoint (
+                    profile, name, path, method, options)
+                VALUES (?, ?, ?, ?, ?)""", (
+                    profile, name, endpoint['path'], endpoint['method'],
+                    json.dumps(options)))
+            db.execute(
+                "DELETE FROM Target WHERE profile = ? AND endpoint = ?",
+                (profile, name))
+            db.executemany(
+                "INSERT INTO Target (profile, endpoint, target) "
+                "VALUES (?, ?, ?)",
+                ((profile, name, t) for t in targets or ()))
+
+        db.execute(
+            "UPDATE Profile SET endpoints = NULL WHERE id = ?", (profile,))
+
+
+def get_encodings():
+    """ Get the response content codings that can be decoded, in
+    order of preference.
+
+    gzip and deflate are always available; zstd and brotli are
+    available when aiohttp has their decoders installed.
+    """
+    encodings = []
+    if getattr(aiohttp.compression_utils, 'HAS_ZSTD', False):
+        encodings.append('zstd')
+    if getattr(aiohttp.compression_utils, 'HAS_BROTLI', False):
+        encodings.append('br')
+
+    return encodings + ['gzip', 'deflate']
+
+
+def get_session(
+        pool_size=100, keepalive=15.0, trace_configs=None, dns_ttl=None):
+    """ Create a pooled HTTP session.
+
+    The session keeps connections alive between requests, so calls
+    to the same host skip the TCP/TLS handshake after the first.
+    It must be created (and closed) from within a running loop.
+
+    If `dns_ttl` is given, host lookups go through the process-wide
+    `resolver.CACHE`, shared by every session, instead of a cache
+    private to the session.
+
+    :param pool_size: (optional) the maximum number of connections
+                                 kept open per host.
+    :param keepalive: (optional) the number of seconds an idle
+                                 connection is kept open.
+    :param trace_configs: (optional) a list of aiohttp.TraceConfig
+                                     objects.
+    :param dns_ttl: (optional) the number of seconds host lookups are
+                               cached in the shared DNS cache.
+    """
+    resolver = None
+    if dns_ttl is not None:
+        resolver = Resolver(ttl=dns_ttl)
+
+    connector = aiohttp.TCPConnector(
+        limit=0,
+        limit_per_host=pool_size,
+        keepalive_timeout=keepalive,
+        resolver=resolver,
+        use_dns_cache=resolver is None)
+
+    return aiohttp.ClientSession(
+        connector=connector, trace_configs=trace_configs)
+
+
+class Targets:
+    """ A compiled set of data targets.
+
+    Targets are either bare keys, matched at any depth, or paths
+    matched from the root of the document. A target is a path if it
+    starts with `$` or contains `.` or `[`, e.g. `slideshow.author`
+    or `$.slideshow.slides[0].title`. Bare keys are held in a dict
+    and paths in a trie, so `extract` checks each node in O(1).
 
-    :param response: a requests.Response object
     :param targets: a list of data targets
     """
+    __slots__ = ('names', 'keys', 'trie', 'root')
+
+    SEGMENT = re.compile(r"""\[(\d+)\]|\[['"](.*?)['"]\]|([^.\[\]]+)""")
+
+    def __init__(self, targets):
+        self.names = list(dict.fromkeys(targets))
+        self.keys = {}
+        self.trie = {}
+        self.root = None
+
+        for target in self.names:
+            if not (target.startswith('$') or '.' in target or '[' in target):
+                self.keys[target] = target
+                continue
+
+            segments = [
+                int(index) if index else quoted or key
+                for index, quoted, key in self.SEGMENT.findall(
+                    target[1:] if target.startswith('$') else target)]
+            if not segments:
+                self.root = target
+                continue
+
+            node = self.trie
+            for segment in segments[:-1]:
+                node = node.setdefault(segment, [None, {}])[1]
+            node.setdefault(segments[-1], [None, {}])[0] = target
+
+    def __len__(self):
+        return len(self.names)
+
+
+def _items(value):
+    """ Iterate over the (key, value) pairs of a container. """
+    if type(value) is dict:
+        return iter(value.items())
+    elif type(value) is list:
+        return enumerate(value)
+    else:
+        return iter(())
+
+
+def extract(data, targets):
+    """ Extract target values from decoded data.
+
+    The document is walked once, depth first in document order, and
+    the walk stops as soon as every target has been found. A bare
+    key takes the value of its first occurrence.
+
+    :param data: a decoded document
+    :param targets: a Targets object or a list of data targets
+    """
+    if type(targets) is not Targets:
+        targets = Targets(targets)
+
+    found = {}
+    if targets.root is not None:
+        found[targets.root] = data
+
+    keys = len(targets.keys)
+    remaining = len(targets) - len(found)
+    stack = [(_items(data), targets.trie)]
+    while stack and remaining:
+        items, node = stack[-1]
+        for k, v in items:
+            target = targets.keys.get(k) if keys else None
+            if target is not None and target not in found:
+                found[target] = v
+                keys -= 1
+                remaining -= 1
+
+            child = node.get(k) if node else None
+            if child is None and node and type(k) is int:
+                child = node.get(str(k))
+
+            if child is not None:
+                if child[0] is not None and child[0] not in found:
+                    found[child[0]] = v
+                    remaining -= 1
+                child = child[1]
+
+            if not remaining:
+                break
+            elif (child or keys) and type(v) in (dict, list):
+                stack.append((_items(v), child))
+                break
+        else:
+            stack.pop()
+
+    return {name: found[name] for name in targets.names if name in found}
+
+
+def decode(body, content_type=None, charset=None):
+    """ Decode a response body.
+
+    The decoder is chosen from the content type, and the body is
+    decoded straight from bytes unless it declares a charset other
+    than UTF-8. Bodies of any other content type are decoded as JSON,
+    falling back to XML.
+
+    :param body: a bytes-like object
+    :param content_type: (optional) the body's media type
+    :param charset: (optional) the body's charset
+    """
+    if charset and charset.lower().replace('_', '-') not in (
+            'utf-8', 'utf8', 'ascii', 'us-ascii'):
+        body = bytes(body).decode(charset)
+
+    content_type = content_type or ''
+    if 'json' in content_type:
+        return loads(body)
+    elif 'xml' in content_type:
+        return xmltodict.parse(body)
+
     try:
-        data = json.loads(response.text)
-    except json.JSONDecodeError:
-        data = xmltodict.parse(response.text)
+        return loads(body)
+    except ValueError:
+        return xmltodict.parse(body)
+
+
+async def parse(response, targets=None, executor=None,
+                threshold=OFFLOAD_SIZE):
+    """ Parse response data.
+
+    If no targets are given, the whole decoded document is returned;
+    an empty list of targets extracts nothing. Bodies of at least
+    `threshold` bytes are parsed on `executor`, if one is given, so
+    that decoding them does not stall the event loop; only the
+    extracted targets are sent back from the worker. Smaller bodies
+    are parsed inline.
+
+    :param response: an aiohttp.ClientResponse object
+    :param targets: (optional) a Targets object or a list of data targets
+    :param executor: (optional) a concurrent.futures.Executor to parse
+                                large bodies on
+    :param threshold: (optional) the body size, in bytes, from which
+                                 bodies are parsed on the executor
+    """
+    body = await response.read()
+    if executor is not None and len(body) >= threshold:
+        return await asyncio.get_running_loop().run_in_executor(
+            executor, _parse, body,
+            response.content_type, response.charset, targets)
+
+    return _parse(body, response.content_type, response.charset, targets)
+
+
+def _parse(body, content_type, charset, targets):
+    """ Decode a body and extract its targets. """
+    data = decode(body, content_type, charset)
 
     if type(data) is list:
         data = {'data': data}
 
-    output = {}
-    async def search(d):
-        for k, v in d.items():
-            if k in targets:
-                output[k] = None
-                yield v
-            elif type(v) is dict:
-                async for i in search(v):
-                    output[i] = None
-                    yield i
+    if targets is None:
+        return data
+
+    return extract(data, targets)
+
+
+async def parse_stream(response, targets, size=65536):
+    """ Parse response data incrementally.
+
+    The body is read in chunks of `size` bytes and fed to an
+    incremental parser that keeps only the values matched by the
+    targets. Reading stops as soon as every target has been found.
+
+    :param response: an aiohttp.ClientResponse object
+    :param targets: a Targets object or a list of data targets
+    :param size: (optional) the chunk size, in bytes
+    """
+    if type(targets) is not Targets:
+        targets = Targets(targets)
+
+    parser = None
+    async for chunk in response.content.iter_chunked(size):
+        if parser is None:
+            xml = (
+                'xml' in response.content_type
+                or 'json' not in response.content_type
+                and chunk.lstrip()[:1] == b'<')
+            parser = XMLStream(targets) if xml else JSONStream(targets)
+
+        parser.feed(chunk)
+        if parser.done:
+            break
+
+    return parser.close() if parser is not None else {}
+
+
+def parse_file(path, targets=None, content_type=None, size=65536):
+    """ Parse a response body saved to a file.
+
+    The file is memory-mapped rather than read into memory. With
+    targets, it is fed to the incremental parsers one chunk at a
+    time, so only the matched values are materialized and reading
+    stops once every target has been found; without targets, the
+    whole document is decoded straight from the mapping.
+
+    :param path: the path of the file
+    :param targets: (optional) a Targets object or a list of data targets
+    :param content_type: (optional) the body's media type, which is
+                                    sniffed from the body if not given
+    :param size: (optional) the chunk size, in bytes
+    """
+    if targets is not None and type(targets) is not Targets:
+        targets = Targets(targets)
+
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return {}
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as body:
+            content_type = content_type or ''
+            xml = (
+                'xml' in content_type
+                or 'json' not in content_type
+                and body[:1024].lstrip()[:1] == b'<')
 
-    for k, v in zip(output, [i async for i in search(data)]):
-        output[k] = v
+            if targets is not None:
+                parser = XMLStream(targets) if xml else JSONStream(targets)
+                for start in range(0, len(body), size):
+                    parser.feed(body[start:start + size])
+                    if parser.done:
+                        break
 
-    return output
+                return parser.close()
 
+            view = memoryview(body)
+            try:
+                return _parse(
+                    view, 'application/xml' if xml else content_type,
+                    None, None)
+            finally:
+                view.release()
@@ -0,0 +1,213 @@
+"""
+tests.server
+~~~~~~~~~~~~
+
+This module implements a minimal asyncio HTTP/1.1 server used as a
+local stand-in for remote APIs in the test suite.
+"""
+
+import gzip
+import json
+import asyncio
+import urllib.parse
+from http import HTTPStatus
+
+
+class Server:
+    """ A local stand-in HTTP server.
+
+    Routes are matched on the first path segment:
+
+        /delay/<seconds>    sleeps, then responds with JSON
+        /json               responds with a JSON document
+        /xml                responds with an XML document
+        /echo               echoes the request as JSON
+        /etag               responds with JSON and an ETag, honoring
+                            If-None-Match with a 304
+        /fresh/<seconds>    responds with JSON and a Cache-Control
+                            max-age of the given seconds
+        /limited/<count>    responds with a 429 and a Retry-After of
+                            0.1 seconds to the first `count` requests,
+                            then with JSON
+        /flaky/<count>      responds with a 502 to the first `count`
+                            requests, then with JSON
+        /items/<count>      responds with a page of `count` numbered
+                            items, selected by the `page`, `offset` or
+                            `cursor` params and sized by `limit`, with
+                            the next page's cursor and Link header
+        /download/<size>    responds with `size` bytes of binary data,
+                            honoring `Range: bytes=<start>-` requests
+        /stall/<nth>        responds with JSON, after a one second
+                            stall on every `nth` request
+        /gzip               responds with gzipped JSON if the request
+                            accepts gzip, else with plain JSON
+        /token              issues a new OAuth2 access token, which
+                            becomes the only one `/protected` accepts
+        /protected          responds with JSON if the request carries
+                            the current bearer token, else with a 401
+
+    :param json_body: (optional) the document served on `/json`
+    :param xml_body: (optional) the document served on `/xml`
+    """
+    def __init__(self, json_body=None, xml_body=None):
+        self.json_body = json_body or {
+            'slideshow': {'author': 'Yours Truly', 'title': 'Sample'}}
+        self.xml_body = xml_body or (
+            '<slideshow><author>Yours Truly</author></slideshow>')
+
+        self.host = '127.0.0.1'
+        self.port = None
+        self.requests = []
+        self.connections = 0
+        self.token = None
+        self.tokens = 0
+
+        self._server = None
+
+    @property
+    def base(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def __aenter__(self):
+        self._server = await asyncio.start_server(
+            self._handle, self.host, 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+        return self
+
+    async def __aexit__(self, *exc):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                method, target, _ = line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    k, v = line.decode('latin-1').split(':', 1)
+                    headers[k.strip().lower()] = v.strip()
+
+                length = int(headers.get('content-length', 0))
+                body = await reader.readexactly(length) if length else b''
+
+                url = urllib.parse.urlsplit(target)
+                request = {
+                    'method': method,
+                    'path': url.path,
+                    'params': dict(urllib.parse.parse_qsl(url.query)),
+                    'headers': headers,
+                    'body': body.decode('latin-1')}
+                self.requests.append(request)
+
+                status, headers, payload = await self.route(request)
+                headers['Content-Length'] = len(payload)
+                writer.write((
+                    f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                    + ''.join(f"{k}: {v}\r\n" for k, v in headers.items())
+                    + "\r\n").encode('latin-1')
+                    + (payload if method != 'HEAD' else b''))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, request):
+        """ Produce a (status, headers, body) triple for a request. """
+        segments = request['path'].strip('/').split('/')
+        headers = {'Content-Type': 'application/json'}
+
+        if segments[0] == 'delay':
+            await asyncio.sleep(float(segments[1]))
+            return 200, headers, json.dumps(
+                {'delay': float(segments[1])}).encode()
+        elif segments[0] == 'json':
+            return 200, headers, json.dumps(self.json_body).encode()
+        elif segments[0] == 'xml':
+            headers['Content-Type'] = 'application/xml'
+            return 200, headers, self.xml_body.encode()
+        elif segments[0] == 'echo':
+            return 200, headers, json.dumps(request).encode()
+        elif segments[0] == 'etag':
+            headers['ETag'] = '"v1"'
+            if request['headers'].get('if-none-match') == '"v1"':
+                return 304, headers, b''
+            return 200, headers, json.dumps(self.json_body).encode()
+        elif segments[0] == 'limited':
+            seen = sum(r['path'] == request['path'] for r in self.requests)
+            if seen <= int(segments[1]):
+                headers['Retry-After'] = '0.1'
+                return 429, headers, b'{}'
+            return 200, headers, json.dumps(self.json_body).encode()
+        elif segments[0] == 'flaky':
+            seen = sum(r['path'] == request['path'] for r in self.requests)
+            if seen <= int(segments[1]):
+                return 502, headers, b'{}'
+            return 200, headers, json.dumps(self.json_body).encode()
+        elif segments[0] == 'stall':
+            seen = sum(r['path'] == request['path'] for r in self.requests)
+            if not seen % int(segments[1]):
+                await asyncio.sleep(1)
+            return 200, headers, json.dumps(self.json_body).encode()
+        elif segments[0] == 'items':
+            params = request['params']
+            limit = int(params.get('limit', 10))
+            if 'page' in params:
+                start = (int(params['page']) - 1) * limit
+            else:
+                start = int(params.get('offset', params.get('cursor', 0)))
+
+            end = min(start + limit, int(segments[1]))
+            following = str(end) if end < int(segments[1]) else None
+            if following:
+                headers['Link'] = (
+                    f'<{request["path"]}?offset={end}&limit={limit}>; '
+                    'rel="next"')
+            return 200, headers, json.dumps({
+                'data': list(range(start, end)),
+                'meta': {'next': following}}).encode()
+        elif segments[0] == 'download':
+            body = bytes(i % 251 for i in range(int(segments[1])))
+            headers['Content-Type'] = 'application/octet-stream'
+            spec = request['headers'].get('range', '')
+            if not spec.startswith('bytes='):
+                return 200, headers, body
+
+            start = int(spec[6:].split('-')[0])
+            if start >= len(body):
+                return 416, headers, b''
+            headers['Content-Range'] = (
+                f"bytes {start}-{len(body) - 1}/{len(body)}")
+            return 206, headers, body[start:]
+        elif segments[0] == 'gzip':
+            payload = json.dumps(self.json_body).encode()
+            if 'gzip' in request['headers'].get('accept-encoding', ''):
+                headers['Content-Encoding'] = 'gzip'
+                payload = gzip.compress(payload)
+            return 200, headers, payload
+        elif segments[0] == 'token':
+            self.tokens += 1
+            self.token = f"token-{self.tokens}"
+            return 200, headers, json.dumps({
+                'access_token': self.token, 'token_type': 'bearer',
+                'expires_in': 3600}).encode()
+        elif segments[0] == 'protected':
+            expected = f"Bearer {self.token}"
+            if request['headers'].get('authorization') != expected:
+                return 401, headers, b'{}'
+            return 200, headers, json.dumps(self.json_body).encode()
+        elif segments[0] == 'fresh':
+            headers['Cache-Control'] = f"max-age={segments[1]}"
+            return 200, headers, json.dumps(self.json_body).encode()
+        else:
+            headers['Content-Type'] = 'text/plain'
+            return 404, headers, b'Not Found'
@@ -0,0 +1,100 @@
+"""
+tests.test_cache
+~~~~~~~~~~~~~~~~
+
+This module implements unit tests for the cache module.
+"""
+
+import os
+import types
+import asyncio
+import tempfile
+
+from ergal.cache import Cache, Store, Stored
+
+
+def build_response(**headers):
+    return types.SimpleNamespace(headers=headers)
+
+
+class TestCache:
+    """ All tests for the cache module and Cache class. """
+    def test_lifetime(self):
+        cache = Cache(ttl=30)
+
+        assert cache.lifetime({}) == 30
+        assert cache.lifetime({'Cache-Control': 'max-age=60'}) == 60
+        assert cache.lifetime({'Cache-Control': 'no-cache'}) == 0
+        assert cache.lifetime({'Cache-Control': 'no-store'}) is None
+        assert cache.lifetime({
+            'Date': 'Mon, 01 Jan 2024 00:00:00 GMT',
+            'Expires': 'Mon, 01 Jan 2024 00:02:00 GMT'}) == 120
+
+    def test_lru(self):
+        cache = Cache(ttl=30, size=2)
+
+        cache.put('a', build_response())
+        cache.put('b', build_response())
+        cache.get('a')
+        cache.put('c', build_response())
+
+        assert list(cache.entries) == ['a', 'c']
+
+    def test_conditions(self):
+        cache = Cache()
+
+        entry = cache.put('a', build_response(
+            ETag='"v1"', **{'Last-Modified': 'yesterday'}))
+        assert not entry.fresh
+        assert entry.conditions() == {
+            'If-None-Match': '"v1"',
+            'If-Modified-Since': 'yesterday'}
+
+    def test_key(self):
+        a = Cache.key('GET', '/a', {'params': {'x': 1, 'y': 2}})
+        b = Cache.key('GET', '/a', {'params': {'y': 2, 'x': 1}})
+        c = Cache.key('GET', '/a', {'headers': {'Accept': 'text/xml'}})
+
+        assert a == b
+        assert a != c
+
+        alice = Cache.key(
+            'GET', '/a', {'headers': {'Authorization': 'Basic YWxpY2U6cHcx'}})
+        bob = Cache.key(
+            'GET', '/a', {'headers': {'authorization': 'Basic Ym9iOnB3Mg=='}})
+        assert alice != bob
+        assert alice != Cache.key('GET', '/a', {})
+        assert 'YWxpY2U6cHcx' not in repr(alice)
+
+    def test_store(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = Store(os.path.join(tmp, 'cache.db'), size=4096)
+            cache = Cache(ttl=30, store=store, scope='a')
+
+            body = b'{"data": "' + os.urandom(1500).hex().encode() + b'"}'
+            response = Stored(
+                'GET', 'http://local/a', 200,
+                [('Content-Type', 'application/json')], body)
+            entry = cache.put('a', response)
+            entry.data = {'data': 'x'}
+            cache.save(entry, body)
+            store.flush()
+
+            assert Cache(store=store, scope='a').get('a') is None
+            restored = asyncio.run(
+                Cache(store=store, scope='a').restore('a'))
+            assert restored.fresh
+            assert restored.data == {'data': 'x'}
+            assert restored.response.content_type == 'application/json'
+            assert store.get('b', 'a') is None
+
+            for key in 'bcd':
+                cache.save(cache.put(key, response), body)
+            store.flush()
+
+            total, = store.connect().execute(
+                "SELECT SUM(size) FROM Response").fetchone()
+            assert total <= 4096
+            assert store.get('a', 'a') is None
+            assert store.get('a', 'd') is not None
+            store.close()
@@ -0,0 +1,67 @@
+"""
+tests.test_executor
+~~~~~~~~~~~~~~~~~~~
+
+This module implements unit tests for the executor module.
+"""
+
+import os
+import asyncio
+import tempfile
+
+from ergal import utils
+from ergal.executor import Executor
+from ergal.profile import Profile
+
+from .server import Server
+
+
+class TestExecutor:
+    """ All tests for the executor module and Executor class. """
+    def test_amap(self):
+        async def run(path):
+            async with Server() as server:
+                profile = Profile('local', base=server.base, database=path)
+                profile.add_endpoint(
+                    'JSON', '/json', 'GET', parse=True, targets=['author'])
+                profile.add_endpoint('Echo', '/echo', 'POST')
+
+                jobs = []
+                for i in range(10):
+                    if i % 2:
+                        jobs.append(('local', 'Echo', {'body': str(i)}))
+                    else:
+                        jobs.append(('local', 'JSON'))
+                jobs.append(('local', 'Missing'))
+                jobs.append(('unknown', 'JSON'))
+
+                async with Executor(
+                        processes=2, chunk_size=3, window=2,
+                        database=path) as executor:
+                    results = [r async for r in executor.amap(iter(jobs))]
+
+                    unordered = [
+                        r async for r in executor.amap(jobs, ordered=False)]
+
+                assert [r.index for r in results] == list(range(12))
+                assert sorted(r.index for r in unordered) == list(range(12))
+                for result in results[:10]:
+                    if result.index % 2:
+                        assert result.value.status == 200
+                        request = await result.value.json()
+                        assert request['body'] == str(result.index)
+                    else:
+                        assert result.value == {'author': 'Yours Truly'}
+                assert results[10].error is not None
+                assert 'no matching record' in str(results[11].error)
+
+                db = utils.get_db(path=path).connect()
+                sql = "SELECT 1 FROM Profile WHERE name = 'unknown'"
+                assert db.execute(sql).fetchone() is None
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'ergal.db')
+            try:
+                asyncio.run(run(path))
+            finally:
+                utils.get_db(path=path).close()
@@ -0,0 +1,82 @@
+"""
+tests.test_limits
+~~~~~~~~~~~~~~~~~
+
+This module implements unit tests for the limits module.
+"""
+
+import time
+import asyncio
+
+from ergal.limits import Limiter, retry_after, reset_after
+
+
+class TestLimits:
+    """ All tests for the limits module and Limiter class. """
+    def test_retry_after(self):
+        assert retry_after(None) is None
+        assert retry_after('120') == 120
+        assert retry_after('Mon, 01 Jan 2024 00:00:00 GMT') == 0
+        assert retry_after('soon') is None
+
+        assert reset_after('30') == 30
+        assert 29 < reset_after(str(time.time() + 30)) <= 30
+        assert reset_after(None) is None
+
+    def test_rate(self):
+        async def run():
+            limiter = Limiter(rate=20, burst=2)
+            start = time.monotonic()
+            for _ in range(4):
+                await limiter.acquire()
+                limiter.release()
+
+            return time.monotonic() - start
+
+        assert asyncio.run(run()) >= 0.09
+
+    def test_window(self):
+        limiter = Limiter(concurrency=8)
+
+        assert limiter.feedback(429, {'Retry-After': '0'})
+        assert limiter.size == 4
+        assert not limiter.feedback(200, {})
+        assert limiter.window == 4.25
+
+        for _ in range(100):
+            limiter.feedback(200, {})
+        assert limiter.size == 8
+
+        limiter = Limiter()
+        assert limiter.size is None
+        limiter.active = 6
+        limiter.feedback(503, {})
+        assert limiter.size == 3
+        assert limiter.blocked > time.monotonic()
+
+    def test_quota(self):
+        limiter = Limiter()
+
+        limiter.feedback(200, {
+            'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '30'})
+        assert limiter.blocked - time.monotonic() > 29
+        assert limiter.size is None
+
+    def test_concurrency(self):
+        async def run():
+            limiter = Limiter(concurrency=2)
+            active = peak = 0
+
+            async def task():
+                nonlocal active, peak
+                await limiter.acquire()
+                active += 1
+                peak = max(peak, active)
+                await asyncio.sleep(0.01)
+                active -= 1
+                limiter.release()
+
+            await asyncio.gather(*(task() for _ in range(6)))
+            return peak, limiter.active
+
+        assert asyncio.run(run()) == (2, 0)
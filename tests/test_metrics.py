@@ -0,0 +1,61 @@
+"""
+tests.test_metrics
+~~~~~~~~~~~~~~~~~~
+
+This module implements unit tests for the metrics module.
+"""
+
+from ergal.metrics import Timing, Histogram, Metrics
+
+
+class TestMetrics:
+    """ All tests for the metrics module. """
+    def test_histogram(self):
+        histogram = Histogram(bounds=(1.0, 2.0, 4.0))
+        for value in (0.5, 1.5, 1.5, 3.0, 8.0):
+            histogram.observe(value)
+
+        assert histogram.counts == [1, 2, 1, 1]
+        assert histogram.count == 5
+        assert histogram.sum == 14.5
+        assert histogram.quantile(0.5) == 1.75
+        assert histogram.quantile(1.0) == 4.0
+        assert Histogram().quantile(0.5) is None
+
+    def test_phases(self):
+        timing = Timing('JSON', 'GET')
+        timing.start = 0.0
+        timing.connecting, timing.resolving = 0.0, 0.0
+        timing.resolved, timing.connected = 0.25, 1.0
+        timing.first_byte, timing.complete = 2.0, 3.0
+
+        assert timing.phases() == {
+            'dns': 0.25, 'connect': 0.75, 'first_byte': 2.0,
+            'download': 1.0, 'total': 3.0}
+
+    def test_prometheus(self):
+        metrics = Metrics(bounds=(0.1, 1.0))
+        timing = Timing('Say "hi"', 'GET')
+        timing.status = 200
+        timing.first_byte = timing.start + 0.05
+        timing.complete = timing.start + 0.5
+        metrics.record(timing)
+
+        text = metrics.prometheus('local', {'coalesced': 2})
+        series = 'profile="local",endpoint="Say \\"hi\\""'
+        assert f'ergal_requests_total{{{series}}} 1' in text
+        assert (
+            f'ergal_responses_total{{{series},status="200"}} 1' in text)
+        assert (
+            f'ergal_phase_seconds_bucket{{{series},phase="total",'
+            'le="0.1"} 0') in text
+        assert (
+            f'ergal_phase_seconds_bucket{{{series},phase="total",'
+            'le="+Inf"} 1') in text
+        assert 'ergal_events_total{profile="local",event="coalesced"} 2' in (
+            text)
+
+        stats = metrics.stats()
+        assert stats['requests'] == 1
+        assert stats['endpoints']['Say "hi"']['statuses'] == {'200': 1}
+        assert stats['latency']['first_byte']['count'] == 1
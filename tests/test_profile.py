@@ -6,23 +6,36 @@ This module implements unit tests for the profile module.
 """
 
 import os
+import gzip
+import json
+import time
+import uuid
+import hashlib
 import asyncio
+import sqlite3
+import threading
+import tempfile
 import collections
 
-from ergal.profile import Profile
+from ergal import utils
+from ergal.cache import get_store
+from ergal.profile import Profile, get_profile
 
-import requests
+from .server import Server
+
+import aiohttp
+import pytest
 
 
 def async_test(f):
     def wrapper(*args, **kwargs):
-        coro = asyncio.coroutine(f)
-        future = coro(*args, **kwargs)
-
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(future)
-
-        os.remove('ergal_test.db')
+        try:
+            asyncio.run(f(*args, **kwargs))
+        finally:
+            utils.get_db(test=True).close()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists('ergal_test.db' + suffix):
+                    os.remove('ergal_test.db' + suffix)
 
     return wrapper
 
@@ -60,6 +73,21 @@ class TestProfile:
         profile = Profile('httpbin', test=True)
         assert profile.base == 'http://httpbin.org'
 
+        for name in ('A', 'B', 'C'):
+            profile.add_endpoint(name, f"/{name.lower()}", 'GET')
+        profile = Profile('httpbin', test=True)
+        profile.endpoints['A']['path'] = '/changed'
+        profile.endpoints['A']['targets'] = ['author']
+        del profile.endpoints['B']
+        profile.endpoints['D'] = {'path': '/d', 'method': 'GET'}
+        profile.update()
+
+        profile = Profile('httpbin', test=True)
+        assert list(profile.endpoints) == ['A', 'C', 'D']
+        assert profile.endpoints['A'] == {
+            'path': '/changed', 'method': 'GET', 'targets': ['author']}
+        assert profile.endpoints['D'] == {'path': '/d', 'method': 'GET'}
+
         profile.db.close()
 
     @async_test
@@ -85,24 +113,24 @@ class TestProfile:
         profile.add_target('JSON', 'author')
 
         response = await profile.call('GET')
-        assert type(response) is requests.models.Response
-        assert response.status_code == 200
+        assert type(response) is aiohttp.ClientResponse
+        assert response.status == 200
 
         response = await profile.call('POST')
-        assert type(response) is requests.models.Response
-        assert response.status_code == 200
+        assert type(response) is aiohttp.ClientResponse
+        assert response.status == 200
 
         response = await profile.call('PUT')
-        assert type(response) is requests.models.Response
-        assert response.status_code == 200
+        assert type(response) is aiohttp.ClientResponse
+        assert response.status == 200
 
         response = await profile.call('PATCH')
-        assert type(response) is requests.models.Response
-        assert response.status_code == 200
+        assert type(response) is aiohttp.ClientResponse
+        assert response.status == 200
 
         response = await profile.call('DELETE')
-        assert type(response) is requests.models.Response
-        assert response.status_code == 200
+        assert type(response) is aiohttp.ClientResponse
+        assert response.status == 200
 
         data = await profile.call('JSON')
         assert type(data) is dict
@@ -110,6 +138,644 @@ class TestProfile:
 
         profile.db.close()
 
+    @async_test
+    async def test_call_concurrent(self):
+        async with Server() as server:
+            profile = Profile('local', base=server.base, test=True)
+            profile.add_endpoint('Delay', '/delay/{seconds}', 'GET')
+
+            start = time.monotonic()
+            await profile.call('Delay', pathvars={'seconds': 0.5})
+            single = time.monotonic() - start
+
+            start = time.monotonic()
+            responses = await asyncio.gather(*(
+                profile.call('Delay', pathvars={'seconds': 0.5})
+                for _ in range(20)))
+            total = time.monotonic() - start
+
+            assert all(r.status == 200 for r in responses)
+            assert total < single * 2
+
+            await profile.close()
+            profile.db.close()
+
+    @async_test
+    async def test_call_pooled(self):
+        async with Server() as server:
+            async with Profile(
+                    'local', base=server.base, test=True,
+                    pool_size=2) as profile:
+                profile.add_endpoint('JSON', '/json', 'GET')
+
+                for _ in range(5):
+                    await profile.call('JSON')
+                assert server.connections == 1
+
+                await asyncio.gather(*(
+                    profile.call('JSON', params={'i': i}) for i in range(10)))
+                assert server.connections == 2
+
+            assert profile.session is None
+            profile.db.close()
+
+    def test_call_loops(self):
+        sessions = []
+
+        async def run():
+            async with Server() as server:
+                profile = get_profile('local', base=server.base, test=True)
+                profile.base = server.base
+                profile.update()
+                profile.add_endpoint('JSON', '/json', 'GET')
+
+                await profile.call('JSON')
+                sessions.append(profile.session)
+
+        try:
+            for _ in range(3):
+                asyncio.run(run())
+        finally:
+            utils.get_db(test=True).close()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists('ergal_test.db' + suffix):
+                    os.remove('ergal_test.db' + suffix)
+
+        assert len({id(session) for session in sessions}) == 3
+        assert all(session.closed for session in sessions)
+
+    @async_test
+    async def test_call_no_targets(self):
+        async with Server() as server:
+            async with Profile(
+                    'local', base=server.base, test=True) as profile:
+                profile.add_endpoint('JSON', '/json', 'GET', parse=True)
+                profile.add_endpoint(
+                    'Stream', '/json', 'GET', parse=True, stream=True,
+                    targets=['author'])
+                profile.add_target('JSON', 'author')
+
+                assert await profile.call('JSON') == {'author': 'Yours Truly'}
+                assert await profile.call('Stream') == {
+                    'author': 'Yours Truly'}
+
+                profile.del_target('JSON', 'author')
+                profile.del_target('Stream', 'author')
+                assert await profile.call('JSON') == {}
+                assert await profile.call('Stream') == {}
+
+                # reloaded from the database
+                profile.endpoints.clear()
+                assert profile.endpoints['JSON']['targets'] == []
+                assert await profile.call('JSON') == {}
+
+                profile.add_endpoint('JSON', '/json', 'GET', parse=True)
+                assert 'slideshow' in await profile.call('JSON')
+
+            profile.db.close()
+
+    @async_test
+    async def test_call_request(self):
+        async with Server() as server:
+            profile = Profile('local', base=server.base, test=True)
+            profile.add_auth('headers', name='X-Key', value='secret')
+            profile.add_endpoint('Echo', '/echo', 'POST', auth=True)
+
+            response = await profile.call(
+                'Echo', params={'q': '1'}, body='payload')
+            request = await response.json()
+            assert request['method'] == 'POST'
+            assert request['params'] == {'q': '1'}
+            assert request['headers']['x-key'] == 'secret'
+            assert request['body'] == 'payload'
+
+            profile.add_endpoint(
+                'Static', '/echo', 'POST', auth=True,
+                headers={'Accept': 'application/json'},
+                params={'v': '2'}, body='static')
+            response = await profile.call(
+                'Static', headers={'X-Trace': 'abc'}, params={'q': '1'})
+            request = await response.json()
+            assert request['params'] == {'v': '2', 'q': '1'}
+            assert request['headers']['accept'] == 'application/json'
+            assert request['headers']['x-trace'] == 'abc'
+            assert request['headers']['x-key'] == 'secret'
+            assert request['body'] == 'static'
+
+            template = profile.compiled['Static']
+            await profile.call('Static')
+            assert profile.compiled['Static'] is template
+
+            profile.add_auth('params', name='key', value='secret')
+            response = await profile.call('Static')
+            request = await response.json()
+            assert request['params'] == {'v': '2', 'key': 'secret'}
+            assert 'x-key' not in request['headers']
+
+            await profile.close()
+            profile.db.close()
+
+    @async_test
+    async def test_call_compressed(self):
+        async with Server() as server:
+            async with Profile(
+                    'local', base=server.base, test=True) as profile:
+                profile.add_endpoint(
+                    'Gzip', '/gzip', 'GET', compress={'accept': ['gzip']},
+                    parse=True, targets=['author'], stream=True)
+                profile.add_endpoint(
+                    'Echo', '/echo', 'POST', compress={'threshold': 1024})
+
+                data = await profile.call('Gzip')
+                assert data == {'author': 'Yours Truly'}
+                request = server.requests[-1]
+                assert request['headers']['accept-encoding'] == 'gzip'
+
+                await profile.call('Echo', body='small')
+                request = server.requests[-1]
+                assert 'content-encoding' not in request['headers']
+                assert request['body'] == 'small'
+
+                body = 'x' * 4096
+                await profile.call('Echo', body=body)
+                request = server.requests[-1]
+                assert request['headers']['content-encoding'] == 'gzip'
+                assert int(request['headers']['content-length']) < 100
+                assert gzip.decompress(
+                    request['body'].encode('latin-1')).decode() == body
+
+    @async_test
+    async def test_call_oauth2(self):
+        async with Server() as server:
+            async with Profile(
+                    'local', base=server.base, test=True) as profile:
+                profile.add_auth(
+                    'oauth2', token_url=server.base + '/token',
+                    client_id='id', client_secret='secret', scope='read')
+                profile.add_endpoint(
+                    'Protected', '/protected', 'POST', auth=True,
+                    parse=True, targets=['author'])
+
+                results = await asyncio.gather(*(
+                    profile.call('Protected') for _ in range(10)))
+                assert all(r == {'author': 'Yours Truly'} for r in results)
+                assert server.tokens == 1
+                request = server.requests[0]
+                assert request['path'] == '/token'
+                assert 'grant_type=client_credentials' in request['body']
+                assert request['headers']['authorization'].startswith(
+                    'Basic ')
+
+                server.token = 'revoked'
+                results = await asyncio.gather(*(
+                    profile.call('Protected') for _ in range(5)))
+                assert all(r == {'author': 'Yours Truly'} for r in results)
+                assert server.tokens == 2
+
+            restarted = Profile('local', base=server.base, test=True)
+            assert restarted.auth['token'] == 'token-2'
+            await restarted.call('Protected')
+            assert server.tokens == 2
+            await restarted.close()
+
+            restarted.oauth.expires = time.time() + 30
+            await restarted.call('Protected')
+            await asyncio.sleep(0.1)
+            assert server.tokens == 3
+            assert restarted.oauth.token == 'token-3'
+
+            await restarted.close()
+            profile.db.close()
+
+    @async_test
+    async def test_warmup(self):
+        async with Server() as server:
+            async with Profile(
+                    'local', base=server.base, test=True,
+                    keepalive=0.3) as profile:
+                profile.add_endpoint('Delay', '/delay/{seconds}', 'GET')
+
+                assert await profile.warmup(connections=4, ping=0.1) == 4
+                assert server.connections == 4
+
+                await asyncio.sleep(0.6)
+                assert server.connections == 4
+                assert len(server.requests) > 8
+
+                await profile.warmup(connections=4)
+                assert profile._pinger is None
+                await asyncio.gather(*(
+                    profile.call('Delay', pathvars={'seconds': 0.05})
+                    for i in range(3)))
+                assert server.connections <= 5
+
+            profile.db.close()
+
+    @async_test
+    async def test_call_coalesced(self):
+        async with Server() as server:
+            async with Profile(
+                    'local', base=server.base, test=True) as profile:
+                profile.add_endpoint('Delay', '/delay/{seconds}', 'GET')
+                profile.add_endpoint('Echo', '/echo', 'POST')
+
+                responses = await asyncio.gather(*(
+                    profile.call('Delay', pathvars={'seconds': 0.2})
+                    for _ in range(10)))
+                assert all(r is responses[0] for r in responses)
+                assert len(server.requests) == 1
+                assert profile.counters['coalesced'] == 9
+
+                await profile.call('Delay', pathvars={'seconds': 0.2})
+                assert len(server.requests) == 2
+
+                await asyncio.gather(*(
+                    profile.call('Echo') for _ in range(3)))
+                assert len(server.requests) == 5
+
+                alice, bob = await asyncio.gather(
+                    profile.call(
+                        'Delay', pathvars={'seconds': 0.1},
+                        auth=('alice', 'pw1')),
+                    profile.call(
+                        'Delay', pathvars={'seconds': 0.1},
+                        auth=('bob', 'pw2')))
+                assert alice is not bob
+                assert len(server.requests) == 7
+                assert {
+                    r['headers']['authorization']
+                    for r in server.requests[-2:]} == {
+                        'Basic YWxpY2U6cHcx', 'Basic Ym9iOnB3Mg=='}
+
+            profile.db.close()
+
+    @async_test
+    async def test_call_stream(self):
+        async with Server(json_body={
+                'padding': ['x' * 100] * 10000,
+                'slideshow': {'author': 'Yours Truly'}}) as server:
+            async with Profile(
+                    'local', base=server.base, test=True) as profile:
+                profile.add_endpoint(
+                    'JSON', '/json', 'GET',
+                    parse=True, stream=True, targets=['slideshow.author'])
+                profile.add_endpoint(
+                    'XML', '/xml', 'GET',
+                    parse=True, stream=True, targets=['author'])
+
+                assert await profile.call('JSON') == {
+                    'slideshow.author': 'Yours Truly'}
+                assert await profile.call('XML') == {'author': 'Yours Truly'}
+
+            profile.db.close()
+
+    @async_test
+    async def test_call_many(self):
+        async with Server() as server:
+            async with Profile(
+                    'local', base=server.base, test=True) as profile:
+                profile.add_endpoint('Delay', '/delay/{seconds}', 'GET')
+
+                specs = [
+                    ('Delay', {'pathvars': {'seconds': 0.5}}),
+                    ('Delay', {'pathvars': {'seconds': 0.1}}),
+                    'Missing',
+                    ('Delay', {'pathvars': {'seconds': 0.1}})]
+                results = [r async for r in profile.call_many(specs, limit=2)]
+
+                assert [r.index for r in results] == [1, 2, 3, 0]
+                assert type(results[1].error) is KeyError
+                assert results[1].value is None
+                assert all(
+                    r.value.status == 200 for r in results if not r.error)
+
+            profile.db.close()
+
+    @async_test
+    async def test_call_cached(self):
+        async with Server() as server:
+            async with Profile(
+                    'local', base=server.base, test=True) as profile:
+                profile.add_endpoint(
+                    'Fresh', '/fresh/60', 'GET',
+                    parse=True, targets=['author'], cache=True)
+                profile.add_endpoint(
+                    'ETag', '/etag', 'GET',
+                    parse=True, targets=['author'], cache={'size': 1})
+
+                first = await profile.call('Fresh')
+                assert await profile.call('Fresh') is first
+                assert len(server.requests) == 1
+
+                first = await profile.call('ETag')
+                assert await profile.call('ETag') is first
+                assert len(server.requests) == 3
+                assert server.requests[-1]['headers']['if-none-match'] == '"v1"'
+
+                profile.add_target('ETag', 'title')
+                assert 'title' in await profile.call('ETag')
+                assert len(server.requests) == 4
+
+                profile.add_endpoint('Echo', '/fresh/60', 'GET', cache=True)
+                await profile.call('Echo', auth=('alice', 'pw1'))
+                await profile.call('Echo', auth=('bob', 'pw2'))
+                assert len(server.requests) == 6
+                assert server.requests[-1]['headers'][
+                    'authorization'] == 'Basic Ym9iOnB3Mg=='
+
+            profile.db.close()
+
+    @async_test
+    async def test_call_persisted(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'cache.db')
+            async with Server() as server:
+                async with Profile(
+                        'local', base=server.base, test=True,
+                        cache_path=path) as profile:
+                    profile.add_endpoint(
+                        'Fresh', '/fresh/60', 'GET', parse=True,
+                        targets=['author'], cache={'persist': True})
+                    profile.add_endpoint(
+                        'Raw', '/fresh/60', 'GET',
+                        cache={'persist': True})
+
+                    await profile.call('Fresh')
+                    await profile.call('Raw', params={'raw': '1'})
+                    assert len(server.requests) == 2
+
+                async with Profile(
+                        'local', base=server.base, test=True,
+                        cache_path=path) as restarted:
+                    assert await restarted.call('Fresh') == {
+                        'author': 'Yours Truly'}
+                    response = await restarted.call(
+                        'Raw', params={'raw': '1'})
+                    assert response.status == 200
+                    assert (await response.json())['slideshow'][
+                        'author'] == 'Yours Truly'
+                    assert len(server.requests) == 2
+
+                    restarted.add_target('Fresh', 'title')
+                    assert 'title' in await restarted.call('Fresh')
+                    assert len(server.requests) == 3
+
+                    restarted.add_auth('headers', name='X-Key', value='a')
+                    restarted.add_endpoint(
+                        'Secret', '/fresh/60', 'GET', auth=True,
+                        cache={'persist': True})
+                    await restarted.call('Secret')
+                    assert len(server.requests) == 4
+                    restarted.caches.clear()
+                    await restarted.call('Secret')
+                    assert len(server.requests) == 4
+
+                    restarted.add_auth('headers', name='X-Key', value='b')
+                    await restarted.call('Secret')
+                    assert len(server.requests) == 5
+
+                get_store(path).close()
+            profile.db.close()
+
+    @async_test
+    async def test_call_limited(self):
+        async with Server() as server:
+            async with Profile(
+                    'local', base=server.base, test=True) as profile:
+                profile.add_limit(50, burst=1)
+                profile.add_endpoint(
+                    'Limited', '/limited/2', 'GET',
+                    parse=True, targets=['author'],
+                    limit={'concurrency': 4})
+
+                start = time.monotonic()
+                assert await profile.call('Limited') == {
+                    'author': 'Yours Truly'}
+                assert time.monotonic() - start >= 0.2
+                assert len(server.requests) == 3
+                assert profile.counters['limited'] == 2
+                assert profile.limiters['Limited'].window == 2.0
+
+                start = time.monotonic()
+                await asyncio.gather(*(
+                    profile.call('Limited', params={'i': i})
+                    for i in range(5)))
+                assert time.monotonic() - start >= 0.08
+
+            profile.db.close()
+
+        profile = Profile('local', test=True)
+        assert profile.limits == {'rate': 50, 'burst': 1}
+        assert profile.endpoints['Limited']['limit'] == {'concurrency': 4}
+
+        profile.del_limit()
+        profile.del_limit(endpoint='Limited')
+        profile.db.close()
+
+        profile = Profile('local', test=True)
+        assert profile.limits == {}
+        assert 'limit' not in profile.endpoints['Limited']
+
+        profile.db.close()
+
+    @async_test
+    async def test_call_retried(self):
+        async with Server() as server:
+            async with Profile(
+                    'local', base=server.base, test=True) as profile:
+                profile.add_endpoint(
+                    'Flaky', '/flaky/2', 'GET',
+                    parse=True, retry={'backoff': 0.01})
+                profile.add_endpoint(
+                    'Budget', '/flaky/3', 'GET',
+                    retry={'retries': 5, 'reserve': 1, 'backoff': 0})
+                profile.add_endpoint(
+                    'Post', '/flaky/1', 'POST', retry=True)
+
+                assert await profile.call('Flaky') == server.json_body
+                assert profile.counters['attempts'] == 3
+                assert profile.counters['retries'] == 2
+
+                assert (await profile.call('Budget')).status == 502
+                assert profile.counters['attempts'] == 5
+
+                assert (await profile.call('Post')).status == 502
+                assert profile.counters['attempts'] == 6
+
+            profile.db.close()
+
+    @async_test
+    async def test_call_hedged(self):
+        async with Server() as server:
+            async with Profile(
+                    'local', base=server.base, test=True) as profile:
+                profile.add_endpoint(
+                    'Stall', '/stall/11', 'GET', retry={'hedge': 90})
+
+                for _ in range(10):
+                    await profile.call('Stall')
+                assert profile.counters['hedges'] == 0
+
+                start = time.monotonic()
+                assert (await profile.call('Stall')).status == 200
+                assert time.monotonic() - start < 0.5
+                assert profile.counters['hedges'] == 1
+                assert profile.counters['hedges_won'] == 1
+                assert profile.counters['attempts'] == 12
+
+            profile.db.close()
+
+    @async_test
+    async def test_paginate(self):
+        async with Server() as server:
+            async with Profile(
+                    'local', base=server.base, test=True) as profile:
+                profile.add_endpoint(
+                    'Pages', '/items/25', 'GET',
+                    paginate={'type': 'page', 'size': 10})
+                profile.add_endpoint(
+                    'Offsets', '/items/25', 'GET',
+                    paginate={'type': 'offset', 'size': 5})
+                profile.add_endpoint(
+                    'Cursors', '/items/25', 'GET',
+                    paginate={'type': 'cursor', 'cursor': 'meta.next'})
+                profile.add_endpoint('Links', '/items/25', 'GET',
+                                     paginate='link')
+                profile.add_endpoint('Plain', '/items/25', 'GET')
+
+                for name in ('Pages', 'Offsets', 'Cursors', 'Links'):
+                    server.requests.clear()
+                    items = [i async for i in profile.paginate(
+                        name, params={'limit': 10})]
+                    assert items == list(range(25))
+
+                assert len(server.requests) == 3
+                assert server.requests[-1]['params'] == {
+                    'offset': '20', 'limit': '10'}
+
+                server.requests.clear()
+                pages = profile.paginate('Offsets', prefetch=3)
+                assert await pages.__anext__() == 0
+                await asyncio.sleep(0.05)
+                assert len(server.requests) == 4
+                await pages.aclose()
+
+                try:
+                    await profile.paginate('Plain').__anext__()
+                    assert False
+                except Exception as e:
+                    assert str(e) == 'paginate: endpoint is not paginated'
+
+            profile.db.close()
+
+    @async_test
+    async def test_call_instrumented(self):
+        events = []
+        async with Server() as server:
+            async with Profile(
+                    'local', base=server.base, test=True) as profile:
+                profile.add_endpoint(
+                    'JSON', '/json', 'GET', parse=True, targets=['author'])
+
+                await profile.call('JSON')
+                profile.on('request_start', lambda e, t: events.append(e))
+                for event in ('connection_acquired', 'first_byte',
+                              'body_complete', 'parse_complete'):
+                    profile.on(event, lambda e, t: events.append((e, t)))
+                await profile.call('JSON')
+
+                assert events[0] == 'request_start'
+                assert [e for e, _ in events[1:]] == [
+                    'connection_acquired', 'first_byte',
+                    'body_complete', 'parse_complete']
+                timing = events[-1][1]
+                assert timing.name == 'JSON' and timing.status == 200
+                assert 'download' in timing.phases()
+
+                stats = profile.stats()
+                assert stats['requests'] == 2
+                assert stats['counters']['attempts'] == 2
+                endpoint = stats['endpoints']['JSON']
+                assert endpoint['statuses'] == {'200': 2}
+                assert endpoint['latency']['total']['count'] == 2
+                assert endpoint['latency']['parse']['count'] == 2
+                assert endpoint['latency']['connect']['count'] == 1
+
+                assert json.loads(profile.export())['requests'] == 2
+                assert (
+                    'ergal_requests_total{profile="local",endpoint="JSON"} 2'
+                    in profile.export('prometheus'))
+
+            profile.db.close()
+
+            async with Profile(
+                    'local', base=server.base, test=True,
+                    metrics=False) as profile:
+                await profile.call('JSON')
+                assert not profile.session.trace_configs
+                assert 'requests' not in profile.stats()
+
+            profile.db.close()
+
+    @async_test
+    async def test_call_stream_to(self):
+        body = bytes(i % 251 for i in range(10123))
+        tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(tmp.name, 'export.bin')
+
+        class Sink:
+            def __init__(self):
+                self.chunks = []
+
+            async def write(self, view):
+                self.chunks.append(bytes(view))
+
+        async with Server() as server:
+            async with Profile(
+                    'local', base=server.base, test=True) as profile:
+                profile.add_endpoint('Export', '/download/10123', 'GET')
+                profile.add_endpoint('JSON', '/json', 'GET')
+
+                download = await profile.call(
+                    'Export', stream_to=path, chunk_size=1000)
+                assert download.size == len(body)
+                assert download.sha256 == hashlib.sha256(body).hexdigest()
+                assert not download.resumed
+                with open(path, 'rb') as f:
+                    assert f.read() == body
+
+                with open(path, 'r+b') as f:
+                    f.truncate(4000)
+                download = await profile.call(
+                    'Export', stream_to=path, chunk_size=1000)
+                assert server.requests[-1]['headers']['range'] == (
+                    'bytes=4000-')
+                assert download.status == 206 and download.resumed
+                assert download.size == len(body)
+                assert download.sha256 == hashlib.sha256(body).hexdigest()
+                with open(path, 'rb') as f:
+                    assert f.read() == body
+
+                download = await profile.call('Export', stream_to=path)
+                assert download.status == 416 and download.size == len(body)
+
+                sink = Sink()
+                download = await profile.call(
+                    'Export', stream_to=sink, chunk_size=4096)
+                assert download.path is None
+                assert [len(c) for c in sink.chunks] == [4096, 4096, 1931]
+                assert b''.join(sink.chunks) == body
+
+                download = await profile.call(
+                    'JSON', stream_to=os.path.join(tmp.name, 'data.json'))
+                assert utils.parse_file(
+                    download.path, targets=['author'],
+                    content_type=download.content_type) == {
+                        'author': 'Yours Truly'}
+
+            profile.db.close()
+        tmp.cleanup()
+
     @async_test
     async def test_add_auth(self):
         profile = build_profile()
@@ -124,7 +790,7 @@ class TestProfile:
             'Bearer', '/bearer', 'GET',
             auth=True)
         response = await profile.call('Bearer')
-        assert response.status_code == 200
+        assert response.status == 200
 
         del profile
         profile = build_profile()
@@ -139,7 +805,7 @@ class TestProfile:
             'Digest', '/digest-auth/auth/user/pass', 'GET',
             auth=True)
         response = await profile.call('Digest')
-        assert response.status_code == 200
+        assert response.status == 200
 
         profile.db.close()
 
@@ -197,3 +863,171 @@ class TestProfile:
                 'method': 'GET',
                 'targets': []}}
 
+
+    @async_test
+    async def test_endpoints_lazy(self):
+        profile = build_profile()
+        profile.add_endpoint('GET', '/get', 'GET')
+        profile.add_endpoint('JSON', '/json', 'GET', targets=['author'])
+        profile.db.close()
+
+        profile = build_profile()
+        assert profile.endpoints.loaded == {}
+        assert profile.endpoints['JSON'] == {
+            'path': '/json', 'method': 'GET', 'targets': ['author']}
+        assert list(profile.endpoints.loaded) == ['JSON']
+        assert list(profile.endpoints) == ['GET', 'JSON']
+        assert 'Missing' not in profile.endpoints
+
+        profile.db.close()
+
+    @async_test
+    async def test_migrate(self):
+        endpoints = {
+            'GET': {'path': '/get', 'method': 'GET'},
+            'JSON': {
+                'path': '/json', 'method': 'GET',
+                'parse': True, 'targets': ['author', 'title']}}
+
+        db = sqlite3.connect('ergal_test.db')
+        with db:
+            db.execute("""
+                CREATE TABLE Profile (
+                    id          TEXT    NOT NULL,
+                    name        TEXT    NOT NULL,
+                    base        TEXT    NOT NULL,
+                    auth        TEXT,
+                    endpoints   TEXT,
+
+                    PRIMARY KEY(id))""")
+            db.execute(
+                "INSERT INTO Profile VALUES (?, ?, ?, ?, ?)", (
+                    uuid.uuid5(uuid.NAMESPACE_DNS, 'httpbin').hex,
+                    'httpbin', 'https://httpbin.org', None,
+                    json.dumps(endpoints)))
+        db.close()
+
+        profile = build_profile()
+        assert profile.endpoints == endpoints
+
+        profile.del_target('JSON', 'author')
+        profile.db.close()
+
+        profile = build_profile()
+        assert profile.endpoints['JSON']['targets'] == ['title']
+
+        profile.db.close()
+
+    @async_test
+    async def test_database(self):
+        profile = build_profile()
+        assert profile.database is utils.get_db(test=True)
+        assert profile.db is profile.db
+        assert profile.db.execute("PRAGMA journal_mode").fetchone() == (
+            'wal',)
+
+        connections = []
+        def worker():
+            connections.append(profile.db)
+            assert profile.endpoints == {}
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        assert connections[0] is not profile.db
+
+        profile.db.close()
+        assert profile.db.execute("SELECT 1").fetchone() == (1,)
+
+    def test_database_path(self, tmp_path):
+        path = str(tmp_path / 'custom.db')
+        profile = Profile('httpbin', base='https://httpbin.org', database=path)
+        profile.add_endpoint('GET', '/get', 'GET')
+
+        assert os.path.exists(path)
+        assert Profile('httpbin', database=path).endpoints == {
+            'GET': {'path': '/get', 'method': 'GET'}}
+
+        utils.get_db(path=path).close()
+
+    @async_test
+    async def test_get_profile(self):
+        profile = get_profile('httpbin', base='https://httpbin.org', test=True)
+        assert get_profile('httpbin', test=True) is profile
+
+        other = build_profile()
+        other.add_endpoint('GET', '/get', 'GET')
+        assert not profile.fresh()
+        assert get_profile('httpbin', test=True) is profile
+        assert 'GET' in profile.endpoints
+        assert profile.fresh()
+
+        db = sqlite3.connect('ergal_test.db')
+        with db:
+            db.execute(
+                "UPDATE Profile SET base = ?, version = version + 1",
+                ('http://httpbin.org',))
+        db.close()
+
+        assert get_profile('httpbin', test=True).base == 'http://httpbin.org'
+
+        profile.add_endpoint('JSON', '/json', 'GET')
+        assert profile.fresh()
+
+        db = sqlite3.connect('ergal_test.db')
+        with db:
+            db.execute("DELETE FROM Profile")
+        db.close()
+
+        with pytest.raises(Exception):
+            get_profile('httpbin', test=True, create=False)
+        db = sqlite3.connect('ergal_test.db')
+        assert db.execute("SELECT COUNT(*) FROM Profile").fetchone() == (0,)
+        db.close()
+
+        fresh = get_profile('httpbin', base='http://new', test=True)
+        assert fresh is not profile
+        assert fresh.base == 'http://new'
+
+        fresh.delete()
+        with pytest.raises(Exception):
+            get_profile('httpbin', test=True, create=False)
+
+        with pytest.raises(Exception):
+            Profile('missing', test=True, create=False)
+
+    @async_test
+    async def test_awrite(self):
+        profile = build_profile()
+
+        await asyncio.gather(*(
+            profile.aadd_endpoint(f"E{i}", f"/e/{i}", 'GET')
+            for i in range(20)))
+        await profile.aadd_target('E0', 'author')
+        await profile.aadd_auth('headers', name='X-Key', value='secret')
+
+        db = sqlite3.connect('ergal_test.db')
+        assert db.execute("SELECT COUNT(*) FROM Endpoint").fetchone() == (20,)
+        assert db.execute("SELECT target FROM Target").fetchall() == [
+            ('author',)]
+        db.close()
+
+        futures = []
+        for base in ('http://a', 'http://b', 'http://c'):
+            profile.base = base
+            futures.append(profile.aupdate())
+        await asyncio.gather(*futures)
+
+        assert Profile('httpbin', test=True).base == 'http://c'
+
+        # hold the writer so that the changes below are queued together
+        profile.database.writer.submit(time.sleep, 0.2)
+        await asyncio.gather(
+            profile.aadd_auth('headers', name='X-Key', value='A'),
+            profile.aupdate(),
+            profile.aadd_auth('headers', name='X-Key', value='B'))
+
+        assert Profile('httpbin', test=True).auth['value'] == 'B'
+
+        await profile.adel_endpoint('E1')
+        await profile.adelete()
+        assert Profile('httpbin', test=True).endpoints == {}
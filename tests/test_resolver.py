@@ -0,0 +1,49 @@
+"""
+tests.test_resolver
+~~~~~~~~~~~~~~~~~~~
+
+This module implements unit tests for the resolver module.
+"""
+
+import time
+import socket
+import asyncio
+
+from ergal.resolver import DNSCache, Resolver
+
+
+class TestResolver:
+    """ All tests for the resolver module and Resolver class. """
+    def test_cache(self):
+        cache = DNSCache(size=2)
+
+        cache.put('a', ['1'], 60)
+        cache.put('b', ['2'], 0)
+        assert cache.get('a') == ['1']
+        assert cache.get('b') is None
+
+        cache.put('c', ['3'], 60)
+        assert list(cache.entries) == ['a', 'c']
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_resolve(self):
+        async def run():
+            cache = DNSCache()
+            first = Resolver(ttl=60, cache=cache)
+            results = await asyncio.gather(*(
+                first.resolve('localhost', 80, socket.AF_INET)
+                for _ in range(5)))
+            assert all(r == results[0] for r in results)
+            assert results[0][0]['host'] == '127.0.0.1'
+            assert first.lookups == 1
+            await first.close()
+
+            second = Resolver(ttl=60, cache=cache)
+            start = time.monotonic()
+            assert await second.resolve(
+                'localhost', 80, socket.AF_INET) == results[0]
+            assert time.monotonic() - start < 0.01
+            assert second.lookups == 0
+            await second.close()
+
+        asyncio.run(run())
@@ -0,0 +1,52 @@
+"""
+tests.test_retry
+~~~~~~~~~~~~~~~~
+
+This module implements unit tests for the retry module.
+"""
+
+from ergal.retry import Policy
+
+
+class TestRetry:
+    """ All tests for the retry module and Policy class. """
+    def test_delay(self):
+        policy = Policy(backoff=1, cap=4)
+
+        assert all(0 <= policy.delay(0) <= 1 for _ in range(100))
+        assert all(0 <= policy.delay(10) <= 4 for _ in range(100))
+        assert max(policy.delay(10) for _ in range(100)) > 1
+
+    def test_budget(self):
+        policy = Policy(budget=0.5, reserve=2)
+
+        assert policy.withdraw()
+        assert policy.withdraw()
+        assert not policy.withdraw()
+
+        policy.deposit()
+        assert not policy.withdraw()
+        policy.deposit()
+        assert policy.withdraw()
+
+        for _ in range(10):
+            policy.deposit()
+        assert policy.tokens == 2
+
+    def test_threshold(self):
+        policy = Policy(hedge=90, window=20)
+        assert Policy().threshold() is None
+
+        for i in range(9):
+            policy.observe(i)
+        assert policy.threshold() is None
+
+        for i in range(9, 40):
+            policy.observe(i)
+        assert policy.threshold() == 38
+
+    def test_methods(self):
+        policy = Policy(methods=['get'])
+
+        assert 'GET' in policy.methods
+        assert 'POST' not in Policy().methods
@@ -0,0 +1,185 @@
+"""
+tests.test_stream
+~~~~~~~~~~~~~~~~~
+
+This module implements unit tests for the stream module.
+"""
+
+import json
+import random
+
+from ergal import utils
+from ergal.stream import JSONStream, XMLStream
+
+import pytest
+import xmltodict
+
+
+JSON = json.dumps({
+    'slideshow': {
+        'author': 'Yours \"Truly\"',
+        'date': 'date of publication',
+        'slides': [
+            {'title': 'Wake up', 'type': 'all', 'n': -1.5e3},
+            {'title': 'Overview', 'items': ['a', 'b'], 'ok': True,
+             'none': None}]},
+    'author': 'Top Level',
+    'count': 12}, indent=2).encode()
+
+XML = b"""<?xml version="1.0"?>
+<slideshow title="Sample" author="Attr Author">
+    <author>Yours Truly</author>
+    <slide type="all"><title>Wake up</title></slide>
+    <slide type="all">
+        <title>Overview</title>
+        <item>a</item>
+        <item>b<em>!</em></item>
+        <empty/>
+    </slide>
+</slideshow>"""
+
+TARGETS = [
+    ['author'],
+    ['title', 'items', 'count'],
+    ['slideshow.slides[1]', 'slideshow.slides.0.n', '$.author'],
+    ['slideshow', 'slides', 'none', 'ok'],
+    ['$'],
+    ['missing', 'slideshow.missing']]
+
+XML_TARGETS = [
+    ['author', '@author'],
+    ['slide', 'title'],
+    ['slideshow.slide[1].item', 'slideshow.@title', 'empty'],
+    ['slideshow.slide', 'em', 'type'],
+    ['$'],
+    ['missing', 'slideshow.missing']]
+
+
+def fuzz_element(rng, depth):
+    tag = rng.choice('abk')
+    attrs = ''.join(
+        f' {name}="{rng.randint(0, 9)}"'
+        for name in 'xy' if rng.random() < 0.2)
+
+    parts = []
+    for _ in range(rng.randint(0, 3) if depth < 4 else 0):
+        if rng.random() < 0.3:
+            parts.append(rng.choice(['1', ' ', ' u ']))
+        parts.append(fuzz_element(rng, depth + 1))
+    if rng.random() < 0.4:
+        parts.append(rng.choice(['2', 'v', ' ']))
+
+    if not parts and rng.random() < 0.5:
+        return f"<{tag}{attrs}/>"
+    return f"<{tag}{attrs}>{''.join(parts)}</{tag}>"
+
+
+def fuzz_target(rng):
+    if rng.random() < 0.3:
+        return rng.choice(['a', 'b', 'k', 'r', '@x', '#text', '$'])
+
+    segments = ['r'] if rng.random() < 0.7 else []
+    for _ in range(rng.randint(1, 3)):
+        segment = rng.choice(['a', 'b', 'k', '@x', '#text'])
+        if rng.random() < 0.3:
+            segment += f"[{rng.randint(0, 2)}]"
+        segments.append(segment)
+
+    return ('$.' if rng.random() < 0.2 else '') + '.'.join(segments)
+
+
+def run(parser, document, size):
+    for i in range(0, len(document), size):
+        parser.feed(document[i:i + size])
+        if parser.done:
+            break
+
+    return parser.close()
+
+
+class TestStream:
+    """ All tests for the stream module. """
+    def test_json(self):
+        data = json.loads(JSON)
+        for targets in TARGETS:
+            expected = utils.extract(data, targets)
+            for size in (1, 7, len(JSON)):
+                parser = JSONStream(utils.Targets(targets))
+                assert run(parser, JSON, size) == expected
+
+    def test_json_list(self):
+        document = b'[{"id": 1}, {"id": 2}]'
+        for targets in (['id'], ['data[1].id'], ['data'], ['$']):
+            expected = utils.extract({'data': json.loads(document)}, targets)
+            parser = JSONStream(utils.Targets(targets))
+            assert run(parser, document, 3) == expected
+
+    def test_json_buffer(self):
+        document = json.dumps({
+            'padding': ['x' * 100] * 1000, 'author': 'Yours Truly'}).encode()
+        parser = JSONStream(utils.Targets(['author']))
+
+        for i in range(0, len(document), 1024):
+            parser.feed(document[i:i + 1024])
+            assert len(parser.buffer) < 2048
+
+        assert parser.close() == {'author': 'Yours Truly'}
+
+    def test_json_long_string(self):
+        blob = 'x\\"' * (1 << 20)
+        document = json.dumps({'blob': blob, 'want': 1}).encode()
+
+        parser = JSONStream(utils.Targets(['want']))
+        for i in range(0, len(document), 65536):
+            parser.feed(document[i:i + 65536])
+            assert len(parser.buffer) <= 65536
+        assert parser.close() == {'want': 1}
+
+        parser = JSONStream(utils.Targets(['blob', 'want']))
+        for i in range(0, len(document), 65535):
+            parser.feed(document[i:i + 65535])
+        assert parser.close() == {'blob': blob, 'want': 1}
+
+    def test_json_invalid(self):
+        for document in (b',', b'}', b']', b'{"a": 1}}', b'[1],', b'"a'):
+            parser = JSONStream(utils.Targets(['missing']))
+            with pytest.raises(ValueError):
+                run(parser, document, 1)
+
+    def test_xml(self):
+        data = xmltodict.parse(XML)
+        for targets in XML_TARGETS:
+            expected = utils.extract(data, targets)
+            for size in (1, 7, len(XML)):
+                parser = XMLStream(utils.Targets(targets))
+                assert run(parser, XML, size) == expected
+
+    def test_xml_fuzz(self):
+        rng = random.Random(0)
+        for _ in range(2000):
+            children = ''.join(
+                fuzz_element(rng, 1) for _ in range(rng.randint(0, 4)))
+            document = f"<r>{children}</r>".encode()
+            targets = list(dict.fromkeys(
+                fuzz_target(rng) for _ in range(rng.randint(1, 4))))
+
+            expected = utils.extract(xmltodict.parse(document), targets)
+            for size in (1, 5, len(document)):
+                parser = XMLStream(utils.Targets(targets))
+                assert run(parser, document, size) == expected, document
+
+    def test_xml_siblings(self):
+        for document, targets, expected in (
+                (b'<r><a/><k>1</k><a><k>2</k></a></r>', ['k'], {'k': '2'}),
+                (b'<r><a><b>1</b></a><a/></r>', ['r.a.b'], {}),
+                (b'<r><a><b>1</b></a></r>', ['r.a[0].b'], {}),
+                (b'<r><a><b>1</b></a><a/></r>', ['r.a[0].b'],
+                 {'r.a[0].b': '1'})):
+            parser = XMLStream(utils.Targets(targets))
+            assert run(parser, document, 1) == expected
+
+    def test_early_exit(self):
+        parser = JSONStream(utils.Targets(['author']))
+        parser.feed(b'{"author": "Yours Truly", "rest": [')
+        assert parser.done
+        assert parser.close() == {'author': 'Yours Truly'}
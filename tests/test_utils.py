@@ -0,0 +1,94 @@
+"""
+tests.test_utils
+~~~~~~~~~~~~~~~~
+
+This module implements unit tests for the utils module.
+"""
+
+import json
+import asyncio
+
+from ergal import utils
+
+import pytest
+
+
+DOCUMENT = {
+    'slideshow': {
+        'author': 'Yours Truly',
+        'slides': [
+            {'title': 'Wake up', 'author': 'Slide Author'},
+            {'title': 'Overview', 'items': ['a', 'b']}]},
+    'author': 'Top Level'}
+
+
+class TestUtils:
+    """ All tests for the utils module. """
+    def test_targets(self):
+        targets = utils.Targets([
+            'author', 'slideshow.author', '$.slideshow.slides[1].title',
+            '$', 'author'])
+
+        assert len(targets) == 4
+        assert targets.keys == {'author': 'author'}
+        assert targets.root == '$'
+        assert targets.trie['slideshow'][1]['author'][0] == 'slideshow.author'
+        assert targets.trie['slideshow'][1]['slides'][1][1][1]['title'][0] == (
+            '$.slideshow.slides[1].title')
+
+    def test_extract(self):
+        assert utils.extract(DOCUMENT, ['author']) == {
+            'author': 'Yours Truly'}
+        assert utils.extract(DOCUMENT, ['title', 'items']) == {
+            'title': 'Wake up', 'items': ['a', 'b']}
+        assert utils.extract(DOCUMENT, [
+            'slideshow.slides[0].author',
+            'slideshow.slides.1.title',
+            '$.author',
+            'missing.path']) == {
+                'slideshow.slides[0].author': 'Slide Author',
+                'slideshow.slides.1.title': 'Overview',
+                '$.author': 'Top Level'}
+
+    def test_extract_nested(self):
+        assert utils.extract(DOCUMENT, ['slideshow', 'slides']) == {
+            'slideshow': DOCUMENT['slideshow'],
+            'slides': DOCUMENT['slideshow']['slides']}
+
+    def test_decode(self):
+        assert utils.decode(b'{"a": [1, 2]}', 'application/json') == {
+            'a': [1, 2]}
+        assert utils.decode(b'<a><b>1</b></a>', 'text/xml') == {
+            'a': {'b': '1'}}
+        assert utils.decode(memoryview(b'[1]')) == [1]
+        assert utils.decode(b'<a>1</a>', 'text/plain') == {'a': '1'}
+        assert utils.decode(
+            '{"a": "\u00e9"}'.encode('latin-1'),
+            'application/json', 'ISO-8859-1') == {'a': '\u00e9'}
+
+        value = utils.decode(memoryview(b'[NaN, 1]'), 'application/json')
+        assert value[0] != value[0] and value[1] == 1
+        with pytest.raises(ValueError):
+            utils.loads(b'{"a": ')
+
+    def test_parse_offload(self):
+        class Response:
+            content_type = 'application/json'
+            charset = None
+
+            async def read(self):
+                return json.dumps(DOCUMENT).encode()
+
+        async def parse(executor, threshold):
+            return await utils.parse(
+                Response(), targets=utils.Targets(['author']),
+                executor=executor, threshold=threshold)
+
+        for processes in (False, True):
+            executor = utils.get_executor(workers=1, processes=processes)
+            assert executor is utils.get_executor(
+                workers=1, processes=processes)
+
+            for threshold in (0, 1 << 20):
+                assert asyncio.run(parse(executor, threshold)) == {
+                    'author': 'Yours Truly'}